@@ -23,15 +23,41 @@ import textwrap
 import time
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
-from tqdm import tqdm
-
-from dbuild.docker_utils import list_modules
-from dbuild.verb import verbs, verb_arguments, VerbException
+from dbuild.build_log import DEFAULT_BUILD_LOG_KEEP, prune_build_logs
+from dbuild.docker_utils import (list_modules, load_config, load_dockerfile,
+                                 get_base_images, get_module_dependencies,
+                                 get_repositories, strip_image_tag,
+                                 get_dependents, dependency_levels,
+                                 invalidate_module, enable_parse_cache,
+                                 new_run_id, SubprocessException,
+                                 DEFAULT_PRUNE_KEEP)
+from dbuild.estimate import (load_durations, print_estimate,
+                             record_durations)
+from dbuild.git_utils import get_changed_modules, is_git_repository
+from dbuild.journal import Journal
+from dbuild.profiling import (enable_profiling, profiled,
+                              profiled_function)
+from dbuild.pull import ImagePuller, NullPuller, DEFAULT_PULL_WORKERS
+from dbuild.registry import DEFAULT_MIRROR_WORKERS
+from dbuild.render import (OUTPUT_JSONL, OUTPUT_MODES, OUTPUT_PROGRESS,
+                           JsonRenderer, PlainRenderer, ProgressRenderer,
+                           text_stream)
+from dbuild.scheduler import (AutoscalingWorkerLimit, FairQueue,
+                              ResourceBudget, WorkerLimit, cpu_count,
+                              module_priority, parse_size, priority_override,
+                              worker_count)
+from dbuild.verb import (verbs, verb_arguments, VerbException,
+                         CancelledException)
+from dbuild.watch import create_watcher, wait_for_changes
 
 WORKER_STATUS_POLL_WAIT = 0.5
+STATE_DIR = '.dbuild'
+
+DEFAULT_PLAN_WORKERS = 8
 
 stream_handler = logging.StreamHandler(stream=sys.stderr)
 stream_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
@@ -54,8 +80,13 @@ def load_verbs():
     importlib.import_module('dbuild.tasks.info_task')
     importlib.import_module('dbuild.tasks.resolve_task')
     importlib.import_module('dbuild.tasks.readme_task')
+    importlib.import_module('dbuild.tasks.save_task')
+    importlib.import_module('dbuild.tasks.mirror_task')
+    importlib.import_module('dbuild.tasks.stats_task')
+    importlib.import_module('dbuild.tasks.prune_task')
 
 
+@profiled_function('build_plan_tree')
 def build_plan_tree(global_args, verb_args, module, verb_defs, intents=None):
     if intents is None:
         intents = {}
@@ -81,6 +112,12 @@ def build_plan_tree(global_args, verb_args, module, verb_defs, intents=None):
                                                 plan.intents)
                 for child in plan.children:
                     child.parent = plan
+
+                    # children act on their parent's output
+                    if child.variant is None:
+                        child.variant = plan.variant
+                    if child.fingerprint is None:
+                        child.fingerprint = plan.fingerprint
     except VerbException as ex:
         logger.error('Error while building execution plan, exiting!')
         logger.error('Reason: %s', ex)
@@ -93,27 +130,14 @@ def build_plan_tree(global_args, verb_args, module, verb_defs, intents=None):
     return plans
 
 
-def print_plans(plans, offset=''):
-    for plan in plans:
-        print textwrap.fill(repr(plan),
-                            width=200,
-                            initial_indent=offset,
-                            subsequent_indent=offset + '     ')
-
-        print_plans(plan.children, offset + '  ')
-
-
-def print_artifacts(plans, offset=''):
+def print_plans(plans, offset='', file=sys.stdout):
     for plan in plans:
-        print textwrap.fill(
-            '%s - %s: %s' % (plan.verb, plan.status.as_str,
-                             ', '.join(plan.artifacts)),
-            width=200,
-            initial_indent=offset,
-            subsequent_indent=offset + '     '
-        )
+        print >> file, textwrap.fill(repr(plan),
+                                     width=200,
+                                     initial_indent=offset,
+                                     subsequent_indent=offset + '     ')
 
-        print_artifacts(plan.children, offset + '  ')
+        print_plans(plan.children, offset + '  ', file)
 
 
 def flatten(dest, plans):
@@ -130,18 +154,43 @@ def flatten(dest, plans):
 
 
 # noinspection PyBroadException
+@profiled_function('worker-{thread}')
 def execute_single_plan(plan):
     if plan.is_dead():
         plan.status.failed = True
+        plan.status.finished_at = time.time()
         plan.status.finished = True
         return plan
 
+    if plan.status.started_at is None:
+        plan.status.started_at = time.time()
+    plan.status.attempts += 1
+    plan.status.retry_at = None
+    plan.status.output.clear()
+
     try:
-        plan.function(plan)
-    except Exception:
+        # plans without a function only carry information for their verb's
+        # report, e.g. resolved tags
+        if plan.function:
+            plan.function(plan)
+    except CancelledException:
+        plan.status.cancelled = True
+        token = plan.status.cancel_token
+        if token.requested_at is not None:
+            logger.info('plan stopped %.2fs after cancel request: %r',
+                        time.time() - token.requested_at, plan)
+        else:
+            logger.info('plan stopped: %r', plan)
+    except Exception as ex:
         logger.exception('Exception while executing plan: %r', plan)
         plan.status.failed = True
+        plan.status.error = str(ex)
 
+    if plan.status.failed and schedule_retry(plan):
+        # the submission thread will pick this plan up again
+        return plan
+
+    plan.status.finished_at = time.time()
     plan.status.finished = True
     plan.status.current = plan.status.total
     plan.status.description = None
@@ -149,27 +198,115 @@ def execute_single_plan(plan):
     return plan
 
 
-def submission_thread_func(flat_plans, workers):
-    flat_plans = flat_plans[:]
+def get_retry_policy(plan):
+    verb_def = verbs.get(plan.verb)
+    return verb_def.retry if verb_def else None
+
+
+def schedule_retry(plan):
+    policy = get_retry_policy(plan)
+    if not policy or _cancelled or plan.status.cancel_requested:
+        return False
+
+    if plan.status.attempts >= policy.attempts:
+        return False
+
+    if not policy.is_retryable(plan.status.error):
+        logger.debug('error is not retryable: %s', plan.status.error)
+        return False
+
+    delay = policy.delay(plan.status.attempts)
+    logger.warning('%s %s failed (attempt %d/%d), retrying in %.1fs: %s',
+                   plan.verb, plan.module, plan.status.attempts,
+                   policy.attempts, delay, plan.status.error)
 
-    with ThreadPoolExecutor(max_workers=workers) as ex:
+    plan.status.failed = False
+    plan.status.current = 0
+    plan.status.retry_at = time.time() + delay
+    return True
+
+
+def describe_plan(plan):
+    if plan.status.retry_at:
+        return 'retry %d/%d in %ds' % (
+            plan.status.attempts + 1, get_retry_policy(plan).attempts,
+            max(0, plan.status.retry_at - time.time()))
+
+    return plan.status.description or ''
+
+
+@profiled_function('submission')
+def submission_thread_func(flat_plans, worker_limit, budget, journal=None):
+    # plans restored from the journal are already finished
+    pending = [p for p in flat_plans if not p.status.finished]
+    running = []
+    queue = FairQueue()
+
+    with ThreadPoolExecutor(max_workers=worker_limit.max_workers) as ex:
         submitted = 0
-        while flat_plans:
+        while pending or running:
             if _cancelled:
                 logger.info('cancelling submission, %d plans not scheduled',
-                            len(flat_plans))
+                            len(pending))
+                for plan in pending:
+                    if plan.status.retry_at:
+                        plan.status.retry_at = None
+                        plan.status.cancelled = True
+                        plan.status.finished = True
                 break
 
+            finished = [p for p in running if p.status.future.done()]
+            for plan in finished:
+                budget.release(plan)
+                queue.finished(plan)
+
+                # retries free up their worker while they wait
+                if plan.status.retry_at:
+                    pending.append(plan)
+            running = [p for p in running if p not in finished]
+
             done = []
-            for plan in flat_plans:
-                if plan.is_ready() or plan.is_dead():
+            ready = []
+            for plan in pending:
+                if plan.status.retry_at and plan.status.retry_at > time.time():
+                    continue
+                elif plan.is_dead():
+                    # nothing to run, no need to take up a worker
                     plan.status.started = True
-                    plan.status.future = ex.submit(execute_single_plan, plan)
-                    submitted += 1
+                    execute_single_plan(plan)
                     done.append(plan)
+                elif plan.is_ready():
+                    ready.append(plan)
+
+            waiting = 0
+            while ready:
+                plan = ready.pop(queue.next(ready))
+
+                # a sibling started in this pass may block it again
+                if not plan.is_ready():
+                    continue
+
+                if len(running) >= worker_limit.limit or \
+                        not budget.fits(plan):
+                    waiting += 1
+                    continue
+
+                budget.reserve(plan)
+                queue.started(plan)
+                plan.status.started = True
+                plan.status.future = ex.submit(execute_single_plan, plan)
+                if journal:
+                    plan.status.future.add_done_callback(
+                        lambda f, p=plan: journal.record(p))
+
+                submitted += 1
+                running.append(plan)
+                done.append(plan)
 
             for plan in done:
-                flat_plans.remove(plan)
+                pending.remove(plan)
+
+            worker_limit.update(flat_plans, running, waiting)
 
             time.sleep(WORKER_STATUS_POLL_WAIT)
 
@@ -178,19 +315,21 @@ def submission_thread_func(flat_plans, workers):
     logger.debug('plan submission finished')
 
 
-# see also: https://github.com/tqdm/tqdm#redirecting-writing
-class DummyTqdmFile(object):
-    def __init__(self, bar, dest=sys.stdout):
-        self.bar = bar
-        self.dest = dest
+def create_renderer(output, output_file=None):
+    if output == OUTPUT_PROGRESS:
+        return ProgressRenderer(stream_handler, describe_plan)
+
+    # leave stdout to the renderer, logs go to stderr. Files are appended
+    # to so watch mode keeps the events of every run
+    stream = open(output_file, 'a') if output_file else sys.stdout
+    if output == OUTPUT_JSONL:
+        return JsonRenderer(stream)
 
-    def write(self, line):
-        line = line.rstrip()
-        if line:
-            self.bar.write(line, file=self.dest)
+    return PlainRenderer(stream)
 
 
-def execute_plans(plan_dict, workers=1):
+def execute_plans(plan_dict, workers=1, budget=None, journal=None,
+                  renderer=None):
     global _cancelled, _cancelled_ack, _killed, _killed_ack
     # collapse tree into a list
     # we'll initially prioritize everything by level, so top-level plans will
@@ -206,116 +345,316 @@ def execute_plans(plan_dict, workers=1):
     for plan_sublist in plan_dict.values():
         root_plans.extend(plan_sublist)
 
+    if workers == 'auto':
+        worker_limit = AutoscalingWorkerLimit()
+    else:
+        worker_limit = WorkerLimit(workers)
+
+    if budget is None:
+        budget = ResourceBudget()
+
     flat_plans = flatten([], root_plans)
+    if journal:
+        restored = journal.restore(flat_plans)
+        if restored:
+            logger.info('%d plans already completed, skipping', restored)
+
     submission_thread = Thread(target=submission_thread_func,
-                               args=(flat_plans, workers))
+                               args=(flat_plans, worker_limit, budget,
+                                     journal))
     submission_thread.start()
 
-    bar_format = '{desc}{percentage:3.0f}% |{bar}| {n_fmt}/{total_fmt} {postfix}]'
-    bars = {}
-    position = 0
-    for module, plans in plan_dict.iteritems():
-        step_count = sum([plan.total_progress for plan in plans])
-        bar = tqdm(desc=module, total=step_count,
-                   bar_format=bar_format, position=position,
-                   file=sys.stderr, dynamic_ncols=True)
-
-        bars[module] = bar
-        position += 1
-
-    stream_handler.stream = DummyTqdmFile(bars.values()[0])
-
-    while submission_thread.isAlive():
-        if _cancelled and not _cancelled_ack:
-            cancelled_count = 0
-            running_count = 0
-            for plan in flat_plans:
-                if plan.status.finished:
-                    continue
-
-                if plan.status.future:
-                    if plan.status.future.cancel():
-                        cancelled_count += 1
+    if renderer is None:
+        renderer = create_renderer(OUTPUT_PROGRESS)
+
+    with profiled('render'):
+        renderer.start(plan_dict)
+
+        while submission_thread.isAlive():
+            if _cancelled and not _cancelled_ack:
+                cancelled_count = 0
+                running_count = 0
+                for plan in flat_plans:
+                    if plan.status.finished:
+                        continue
+
+                    if plan.status.future:
+                        if plan.status.future.cancel():
+                            cancelled_count += 1
+                            plan.status.finished = True
+                            plan.status.cancelled = True
+                            plan.status.current = plan.status.total
+                        else:
+                            running_count += 1
+                    else:
                         plan.status.finished = True
-                        plan.status.cancelled = True
                         plan.status.current = plan.status.total
-                    else:
-                        running_count += 1
-                else:
-                    plan.status.finished = True
-                    plan.status.current = plan.status.total
-                    cancelled_count += 1
+                        cancelled_count += 1
 
-            logger.info('%d submitted plans cancelled, %d still active',
-                        cancelled_count, running_count)
-            _cancelled_ack = True
+                logger.info('%d submitted plans cancelled, %d still active',
+                            cancelled_count, running_count)
+                _cancelled_ack = True
 
-        if _killed and not _killed_ack:
-            req_count = 0
-            for plan in flat_plans:
-                if plan.status.future and plan.status.future.running():
-                    plan.status.cancel_requests = True
-                    req_count += 1
+            if _killed and not _killed_ack:
+                req_count = 0
+                for plan in flat_plans:
+                    if plan.status.future and plan.status.future.running():
+                        plan.status.cancel_token.cancel()
+                        req_count += 1
 
-            logger.info('asked %d ongoing plans to stop', req_count)
+                logger.info('asked %d ongoing plans to stop', req_count)
 
-            _killed_ack = True
+                _killed_ack = True
 
-        for module, plans in plan_dict.iteritems():
-            bar = bars[module]
+            renderer.update(plan_dict)
 
-            current_sum = 0
-            active = []
-            for plan in plans:
-                current_sum += plan.current_progress
-                active.extend(plan.active_in_tree())
+            time.sleep(WORKER_STATUS_POLL_WAIT)
 
-            bar.n = current_sum
+        successes = filter(lambda p: p.status.success, flat_plans)
+        failures = filter(lambda p: p.status.failed, flat_plans)
+        cancelled = filter(lambda p: p.status.finished and p.status.cancelled,
+                           flat_plans)
 
-            if len(active) > 1:
-                post = ', '.join(p.verb for p in active)
-            elif len(active) == 1:
-                post = active[0].status.description or ''
-            elif current_sum < bar.total:
-                post = ' ... waiting ...'
-            else:
-                post = 'done!'
+        renderer.finish(plan_dict, flat_plans, failures)
 
-            if len(post) > 40:
-                post = post[:37] + '...'
+    logger.info('all tasks completed, %d success, %d fail, %d cancelled',
+                len(successes), len(failures), len(cancelled))
 
-            bar.postfix = '%-40s' % post
-            bar.refresh()
+    retried = filter(lambda p: p.status.attempts > 1, flat_plans)
+    if retried:
+        logger.info('%d plans were retried, %d retries in total',
+                    len(retried),
+                    sum(p.status.attempts - 1 for p in retried))
 
-        time.sleep(WORKER_STATUS_POLL_WAIT)
+    submission_thread.join()
 
-    for bar in bars.values():
-        bar.close()
+    return len(failures) == 0
+
+
+def report_plans(arguments, plan_dict):
+    """Lets verbs summarize the results of all their plans in a run"""
+    stream = text_stream(arguments)
+    flat_plans = flatten([], [p for l in plan_dict.values() for p in l])
+    for verb_name in sorted(set(p.verb for p in flat_plans)):
+        verb_def = verbs.get(verb_name)
+        if verb_def and verb_def.report:
+            verb_def.report(arguments,
+                            [p for p in flat_plans if p.verb == verb_name],
+                            stream)
+
+
+def prefetch_base_images(global_args, modules):
+    """Starts pulling the distinct base images of all given modules
+
+    Pulls happen in the background so they overlap with the first builds;
+    build plans wait on the pull of their own base images before starting.
+    Images built by one of the modules are left out: a pull finishing after
+    that build would replace it with the previously published image.
+    """
+    produced = set()
+    for module in modules:
+        produced.update(get_repositories(load_config(global_args.base_path,
+                                                     module)))
+
+    images = []
+    for module in modules:
+        dockerfile = load_dockerfile(global_args.base_path, module)
+        for image in get_base_images(dockerfile):
+            if strip_image_tag(image) in produced:
+                logger.debug('not prefetching %s, built in this run', image)
+            elif image not in images:
+                images.append(image)
+
+    logger.info('prefetching %d base images', len(images))
+    for image in images:
+        global_args.puller.pull(image)
+
+    return images
+
+
+def select_changed_modules(ref, all_modules, selected):
+    """Limits modules to those changed since a git ref, plus dependents
+
+    If no modules were selected explicitly, all changed modules are used.
+    """
+    if not is_git_repository(base_path):
+        logger.error('--changed-since requires a git repository: %s',
+                     base_path)
+        sys.exit(1)
 
-    stream_handler.stream = sys.stdout
+    try:
+        changed = get_changed_modules(base_path, ref, all_modules)
+    except SubprocessException as ex:
+        logger.error('Could not determine changes since %s: %s',
+                     ref, ex.stderr.strip())
+        sys.exit(1)
 
-    successes = filter(lambda p: p.status.success, flat_plans)
-    failures = filter(lambda p: p.status.failed, flat_plans)
-    cancelled = filter(lambda p: p.status.finished and p.status.cancelled,
-                       flat_plans)
+    dependencies = get_module_dependencies(base_path, all_modules)
+    affected = get_dependents(dependencies, changed)
 
-    print ''
-    for module, plan_list in plan_dict.items():
-        print 'artifacts:', module
-        print_artifacts(plan_list, offset='  ')
-        print ''
+    candidates = selected or all_modules
+    result = [m for m in candidates if m in affected]
+    logger.info('%d modules changed since %s, %d selected with dependents',
+                len(changed), ref, len(result))
 
-    logger.info('all tasks completed, %d success, %d fail, %d cancelled',
-                len(successes), len(failures), len(cancelled))
+    return result
 
-    submission_thread.join()
 
-    if len(failures) > 0:
-        print ''
-        logger.debug('Failures occurred, exiting unsuccessfully')
+def set_priority(arguments, module, plans):
+    """Applies the module's priority class to all of its plans"""
+    overrides = dict(arguments.priority or [])
+    try:
+        priority = module_priority(load_config(arguments.base_path, module),
+                                   overrides.get(module))
+    except ValueError as ex:
+        logger.error('%s: %s', module, ex)
         sys.exit(1)
-    else:
-        sys.exit(0)
+
+    for plan in flatten([], plans):
+        plan.priority = priority
+
+
+def generate_plans(arguments, verb_args, active_verbs, modules):
+    """Builds plan trees for all modules concurrently
+
+    Plan generation reads files, may run `docker version`, or log in to
+    Docker Hub, so modules are handled in a thread pool. The result is
+    ordered like `modules` regardless of which finishes first.
+    """
+    plans = OrderedDict()
+    step_count = 0
+    workers = max(1, min(arguments.plan_workers, len(modules)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(module, executor.submit(build_plan_tree, arguments,
+                                            verb_args, module, active_verbs))
+                   for module in modules]
+
+        try:
+            for module, future in futures:
+                plans[module] = future.result()
+                step_count += sum(map(lambda p: p.steps, plans[module]))
+                set_priority(arguments, module, plans[module])
+        except BaseException:
+            # e.g. SystemExit on an invalid plan, don't bother with the rest
+            for _, future in futures:
+                future.cancel()
+
+            raise
+
+    if arguments.show_plans:
+        stream = text_stream(arguments)
+        for module, plan_list in plans.items():
+            print >> stream, 'generated plans:', module
+            print_plans(plan_list, offset='  ', file=stream)
+            print >> stream, ''
+
+    logger.info('%d steps generated from input', step_count)
+
+    return plans
+
+
+def run_plans(arguments, plans, journal=None):
+    """Runs generated plans and reports on them
+
+    :param journal: the journal to record completed plans in; by default
+                    a new one is started, and closed afterwards
+    """
+    if arguments.build_log_dir:
+        if not os.path.exists(arguments.build_log_dir):
+            logger.debug('creating log directory %s', arguments.build_log_dir)
+            os.makedirs(arguments.build_log_dir)
+
+    prefetch_images = []
+    if arguments.prefetch and 'build' in arguments.verbs:
+        prefetch_images = prefetch_base_images(arguments, plans.keys())
+
+    signal.signal(signal.SIGINT, cancel_signal_handler)  # signal signal
+    budget = ResourceBudget(arguments.cpu_budget, arguments.memory_budget)
+    # don't replace the journal of the last real run if there's nothing to do
+    own_journal = journal is None and any(
+        p.function for l in plans.values() for p in flatten([], l))
+    if own_journal:
+        journal = Journal(arguments.state_dir, arguments.resume)
+
+    renderer = create_renderer(arguments.output, arguments.output_file)
+    success = execute_plans(plans, arguments.workers, budget, journal,
+                            renderer)
+    if arguments.output_file and arguments.output != OUTPUT_PROGRESS:
+        renderer.stream.close()
+
+    if own_journal:
+        journal.close()
+
+    report_plans(arguments, plans)
+    record_durations(arguments.state_dir,
+                     flatten([], [p for l in plans.values() for p in l]))
+
+    if arguments.build_log_dir:
+        removed = prune_build_logs(arguments.build_log_dir, plans.keys(),
+                                   arguments.build_log_keep)
+        if removed:
+            logger.debug('removed %d old build logs', removed)
+
+    if prefetch_images:
+        prefetch_time = arguments.puller.elapsed(prefetch_images)
+        if prefetch_time is not None:
+            logger.info('prefetched %d base images in %.1fs',
+                        len(prefetch_images), prefetch_time)
+
+    return success
+
+
+def watch_modules(arguments, verb_args, active_verbs, all_modules):
+    """Runs the given verbs whenever watched modules change
+
+    Changed modules are rebuilt along with any watched modules that use them
+    as a base image, in dependency order. Parsed configs and Dockerfiles are
+    reused between runs unless their files were modified.
+    """
+    watched = arguments.modules
+    modules = watched
+    resume = arguments.resume
+    watcher = create_watcher(arguments.base_path, watched)
+    try:
+        while True:
+            dependencies = get_module_dependencies(arguments.base_path,
+                                                   all_modules)
+            # images built by each round of changes are a separate run, with
+            # one journal for all of its levels. Only the first round can
+            # resume: later rounds rebuild dependents with unchanged inputs
+            arguments.run_id = new_run_id()
+            journal = Journal(arguments.state_dir, resume)
+            resume = False
+            try:
+                for level in dependency_levels(dependencies, modules):
+                    plans = generate_plans(arguments, verb_args,
+                                           active_verbs, level)
+                    if not run_plans(arguments, plans, journal) or \
+                            _cancelled:
+                        break
+            finally:
+                journal.close()
+
+            if _cancelled:
+                return
+
+            logger.info('watching %d modules for changes, press Ctrl+C to '
+                        'exit', len(watched))
+            changed = wait_for_changes(watcher, stop=lambda: _cancelled)
+            if changed is None:
+                return
+
+            for module in changed:
+                invalidate_module(arguments.base_path, module)
+
+            dependencies = get_module_dependencies(arguments.base_path,
+                                                   all_modules)
+            affected = get_dependents(dependencies, changed)
+            modules = [m for m in watched if m in affected]
+            logger.info('changed: %s, rebuilding: %s',
+                        ', '.join(sorted(changed)), ', '.join(modules))
+    finally:
+        watcher.close()
 
 
 def cancel_signal_handler(signal, frame):
@@ -335,12 +674,27 @@ def cancel_signal_handler(signal, frame):
 
 
 def main():
-    load_verbs()
+    # parsed ahead of the other options so module discovery is profiled too
+    profile_parser = ArgumentParser(add_help=False)
+    profile_parser.add_argument('--profile', default=None, metavar='DIR',
+                                help='write cProfile data (.pstats and '
+                                     '.callgrind) of each phase of the run '
+                                     'to this directory')
+    profile_parser.add_argument('--profile-memory', action='store_true',
+                                help='with --profile, also record the memory '
+                                     'usage of each phase')
+    profile_args, _ = profile_parser.parse_known_args()
+    if profile_args.profile:
+        enable_profiling(os.path.realpath(profile_args.profile),
+                         profile_args.profile_memory)
+
+    with profiled('discovery'):
+        load_verbs()
+        modules = sorted(list_modules(base_path))
 
     verb_strs = map(lambda v: '    {:8}  {}'.format(v.name, v.description),
                     sorted(verbs.values()))
 
-    modules = sorted(list_modules(base_path))
     module_str = textwrap.fill(' '.join(modules),
                                initial_indent='    ',
                                subsequent_indent='    ',
@@ -356,10 +710,13 @@ def main():
         verbs and modules can be given in any order;
         modules and verbs will be processed in the order
         given on the command line.
+
+        add 'watch' to keep running and re-run the verbs for
+        modules (and their dependents) whenever their files change.
         ''').format(verbs='\n'.join(verb_strs), modules=module_str)
 
     parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
-                            epilog=epilog)
+                            epilog=epilog, parents=[profile_parser])
     parser.add_argument('-d', '--debug', action='store_true',
                         help='enable debug logging')
     parser.add_argument('-l', '--build-log', action='store_true',
@@ -368,8 +725,83 @@ def main():
     parser.add_argument('--build-log-dir', default=None,
                         help='log container build output to file in specified '
                              'directory')
-    parser.add_argument('-w', '--workers', default=1, type=int,
-                        help='number of parallel workers')
+    parser.add_argument('--build-log-keep', default=DEFAULT_BUILD_LOG_KEEP,
+                        type=int,
+                        help='number of log files kept per module in the '
+                             'build log directory, 0 keeps all (default: '
+                             '%(default)s)')
+    parser.add_argument('--no-compress-logs', action='store_true',
+                        help='write uncompressed files to the build log '
+                             'directory')
+    parser.add_argument('-w', '--workers', default=1, type=worker_count,
+                        help='number of parallel workers, or \'auto\' to '
+                             'adjust to host load during the run')
+    parser.add_argument('--builder', default='legacy',
+                        choices=['legacy', 'buildkit'],
+                        help='image builder backend to use')
+    parser.add_argument('--warm-cache', action='store_true',
+                        help='pull the last published image of each variant '
+                             'and use it as a build cache source')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='pull all base images once, in parallel, before '
+                             'building')
+    parser.add_argument('--plan-workers', type=int,
+                        default=DEFAULT_PLAN_WORKERS,
+                        help='number of threads used to generate plans '
+                             '(default: %(default)s)')
+    parser.add_argument('--pull-workers', default=DEFAULT_PULL_WORKERS,
+                        type=int,
+                        help='max number of concurrent image pulls')
+    parser.add_argument('--priority', action='append', default=[],
+                        type=priority_override, metavar='MODULE=CLASS',
+                        help='priority class (high, normal or low) of a '
+                             'module, overrides its build.yml; may be given '
+                             'several times')
+    parser.add_argument('--cpu-budget', default=None, type=float,
+                        help='cpus available to plans with resource hints '
+                             '(default: all cores)')
+    parser.add_argument('--memory-budget', default=None, type=parse_size,
+                        help='memory available to plans with resource hints, '
+                             'e.g. 8g (default: all memory)')
+    parser.add_argument('--state-dir', default=None,
+                        help='directory for run state such as the plan '
+                             'journal (default: .dbuild in the module '
+                             'directory)')
+    parser.add_argument('--save-dir', default=None,
+                        help='directory for archives written by the save '
+                             'verb (default: images in the state directory)')
+    parser.add_argument('--mirror-to', default=None,
+                        metavar='REGISTRY[/NAMESPACE]',
+                        help='destination registry of the mirror verb, '
+                             'optionally replacing image namespaces')
+    parser.add_argument('--mirror-workers', default=DEFAULT_MIRROR_WORKERS,
+                        type=int,
+                        help='max number of concurrent blob transfers of the '
+                             'mirror verb (default: %(default)s)')
+    parser.add_argument('--prune-keep', default=DEFAULT_PRUNE_KEEP, type=int,
+                        help='number of runs whose images the prune verb '
+                             'keeps per module and variant (default: '
+                             '%(default)s)')
+    parser.add_argument('--parse-cache', action='store_true',
+                        help='cache parsed build.yml files, Dockerfiles and '
+                             'image layer metadata in the state directory')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip plans that completed successfully in the '
+                             'previous run')
+    parser.add_argument('--changed-since', default=None, metavar='REF',
+                        help='only use modules with changes since the given '
+                             'git ref, and modules that depend on them')
+    parser.add_argument('--output', choices=OUTPUT_MODES,
+                        default=OUTPUT_PROGRESS,
+                        help='progress bars (default), plain lines per plan '
+                             'state change, or one JSON event per line')
+    parser.add_argument('--output-file', default=None,
+                        help='write plain or jsonl output to this file '
+                             'instead of stdout')
+    parser.add_argument('--estimate', action='store_true',
+                        help='predict the wall time of the generated plans '
+                             'with the given number of workers instead of '
+                             'running them')
     parser.add_argument('-s', '--show-plans', action='store_true',
                         help='show plan tree before running')
     parser.add_argument('args', nargs='*', metavar='arg',
@@ -377,18 +809,36 @@ def main():
 
     arguments = parser.parse_args()
     arguments.base_path = base_path
+    arguments.run_id = new_run_id()
+    if not arguments.state_dir:
+        arguments.state_dir = os.path.join(base_path, STATE_DIR)
+    if not arguments.save_dir:
+        arguments.save_dir = os.path.join(arguments.state_dir, 'images')
     if arguments.debug:
         logging.root.setLevel(logging.DEBUG)
+    if arguments.parse_cache:
+        enable_parse_cache(arguments.state_dir)
 
     arguments.verbs = filter(lambda v: v in verbs.keys(), arguments.args)
     arguments.modules = filter(lambda m: m in modules, arguments.args)
+    reserved = arguments.verbs + arguments.modules
+
+    if arguments.changed_since:
+        with profiled('discovery'):
+            arguments.modules = select_changed_modules(
+                arguments.changed_since, modules, arguments.modules)
+
     logger.info('Modules: %r', arguments.modules)
 
-    reserved = arguments.verbs + arguments.modules
+    # 'watch' is a mode rather than a verb, unless it names a module
+    arguments.watch = 'watch' in arguments.args and 'watch' not in modules
+    if arguments.watch:
+        reserved.append('watch')
     arguments.verb_args = filter(lambda a: a not in reserved, arguments.args)
     logger.debug('verb_args = %r', arguments.verb_args)
 
-    verb_args = verb_arguments(arguments.verb_args, arguments.verbs)
+    with profiled('verb_arguments'):
+        verb_args = verb_arguments(arguments.verb_args, arguments.verbs)
     active_verbs = sorted(map(lambda v: verbs[v], arguments.verbs),
                           key=lambda v: v.priority,
                           reverse=True)
@@ -396,28 +846,41 @@ def main():
     # re-map to show in order for log message
     logger.info('Applying verbs: %r', map(lambda v: v.name, active_verbs))
 
-    plans = {}
-    step_count = 0
-    for module in arguments.modules:
-        plans[module] = build_plan_tree(arguments, verb_args,
-                                        module, active_verbs)
-        step_count += sum(map(lambda p: p.steps, plans[module]))
+    # estimating only generates plans, which must not pull anything
+    if arguments.estimate:
+        arguments.puller = NullPuller()
+    else:
+        arguments.puller = ImagePuller(arguments.pull_workers)
 
-    if arguments.show_plans:
-        for module, plan_list in plans.items():
-            print 'generated plans:', module
-            print_plans(plan_list, offset='  ')
-            print ''
+    if arguments.watch:
+        watch_modules(arguments, verb_args, active_verbs, modules)
+        arguments.puller.shutdown()
+        sys.exit(0)
 
-    logger.info('%d steps generated from input', step_count)
+    plans = generate_plans(arguments, verb_args, active_verbs,
+                           arguments.modules)
+    if arguments.estimate:
+        workers = arguments.workers
+        if workers == 'auto':
+            workers = cpu_count()
+
+        flat_plans = flatten([], [p for l in plans.values() for p in l])
+        print_estimate(flat_plans, workers,
+                       load_durations(arguments.state_dir),
+                       text_stream(arguments))
+        arguments.puller.shutdown()
+        sys.exit(0)
 
-    if arguments.build_log_dir:
-        if not os.path.exists(arguments.build_log_dir):
-            logger.debug('creating log directory %s', arguments.build_log_dir)
-            os.makedirs(arguments.build_log_dir)
+    success = run_plans(arguments, plans)
 
-    signal.signal(signal.SIGINT, cancel_signal_handler)  # signal signal
-    execute_plans(plans, arguments.workers)
+    arguments.puller.shutdown()
+
+    if not success:
+        print >> text_stream(arguments), ''
+        logger.debug('Failures occurred, exiting unsuccessfully')
+        sys.exit(1)
+    else:
+        sys.exit(0)
 
 
 if __name__ == '__main__':
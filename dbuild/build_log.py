@@ -0,0 +1,79 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import gzip
+import io
+import logging
+import os
+
+# number of most recent log files kept per module in --build-log-dir
+DEFAULT_BUILD_LOG_KEEP = 20
+
+logger = logging.getLogger(__name__)
+
+
+def build_log_path(log_dir, module, variant, compress=True):
+    """Returns a new log file path, logs are grouped by module
+
+    File names start with a timestamp so they sort chronologically.
+    """
+    datestamp = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+    file_name = '%s-%s.log' % (datestamp, variant)
+    if compress:
+        file_name += '.gz'
+
+    return os.path.join(log_dir, module, file_name)
+
+
+def open_build_log(path):
+    """Opens a log file for writing text, compressed if it ends with .gz"""
+    parent = os.path.dirname(path)
+    try:
+        os.makedirs(parent)
+    except OSError:
+        if not os.path.isdir(parent):
+            raise
+
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'wb'), encoding='UTF-8')
+
+    return io.open(path, 'w', encoding='UTF-8')
+
+
+def prune_build_logs(log_dir, modules, keep=DEFAULT_BUILD_LOG_KEEP):
+    """Removes all but the `keep` newest log files of each module
+
+    :return: the number of removed files
+    """
+    if not keep:
+        return 0
+
+    removed = 0
+    for module in modules:
+        module_dir = os.path.join(log_dir, module)
+        if not os.path.isdir(module_dir):
+            continue
+
+        names = sorted(n for n in os.listdir(module_dir)
+                       if n.endswith('.log') or n.endswith('.log.gz'))
+        for name in names[:-keep]:
+            try:
+                os.remove(os.path.join(module_dir, name))
+                removed += 1
+            except OSError:
+                logger.debug('could not remove old log %s', name,
+                             exc_info=True)
+
+    return removed
@@ -12,20 +12,28 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import binascii
+import datetime
 import glob
+import hashlib
+import io
+import json
 import logging
 import os
+import socket
 import subprocess
 import re
 
 import yaml
 
 from distutils.version import LooseVersion
+from threading import Lock
 from dockerfile_parse import DockerfileParser
 
+from dbuild.parse_cache import CACHE_DIR, ParseCache
 from dbuild.tag import (TAG_REGEXES, DockerTag,
                         parse_docker_tag, docker_tags_from_args, interp_tag)
-from dbuild.verb import Argument, VerbException
+from dbuild.verb import Argument, CancelledException, VerbException
 
 REGEX_MODULE = re.compile(r'^[a-z0-9\-]+$')
 REGEX_DOCKERFILE_REBUILD = re.compile(r'^REBUILD_([A-Z_]+)=.+$')
@@ -37,24 +45,119 @@ ARG_VARIANT = Argument('variant', re.compile(r'^(\w[\w_.-]*)$'))
 ARG_REBUILD = Argument('rebuild', re.compile(r'^@(\w[\w_.-]*)$'))
 ARG_APPEND = Argument('append', re.compile(r'^\+$'))
 
+# labels on every built image, used by `prune` to find dbuild's own images
+LABEL_MODULE = 'dbuild.module'
+LABEL_VARIANT = 'dbuild.variant'
+LABEL_RUN = 'dbuild.run'
+LABEL_FINGERPRINT = 'dbuild.fingerprint'
+
+# number of most recent runs whose images `prune` keeps per module/variant
+DEFAULT_PRUNE_KEEP = 3
+
 MIN_DOCKER_VERSION = LooseVersion('1.13.0')
+MIN_BUILDKIT_DOCKER_VERSION = LooseVersion('18.09')
 
 logger = logging.getLogger(__name__)
 config_cache = {}
 dockerfile_cache = {}
+context_hash_cache = {}
+
+# plans are generated concurrently; each cached path is loaded by one thread
+# while others wait for the result
+_path_locks = {}
+_path_locks_lock = Lock()
+
+_docker_client_version = None
+_docker_client_version_lock = Lock()
+
+# on-disk cache of parsed files shared between invocations, see
+# enable_parse_cache()
+parse_cache = None
+
+
+class CachedDockerfileParser(DockerfileParser):
+    """A DockerfileParser that parses its content at most once
+
+    `DockerfileParser.structure` reparses the full content on every access;
+    here the result is kept until the content is modified. A previously
+    parsed structure (e.g. from the on-disk cache) may be passed in.
+    """
+
+    def __init__(self, content, structure=None):
+        # keep the content in memory only, so modifying the parser never
+        # writes to the module's Dockerfile
+        super(CachedDockerfileParser, self).__init__(
+            fileobj=io.BytesIO(content), cache_content=True)
+        self._structure = structure
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = super(CachedDockerfileParser, self).structure
+
+        return self._structure
+
+    @DockerfileParser.lines.setter
+    def lines(self, lines):
+        self._structure = None
+        DockerfileParser.lines.fset(self, lines)
+
+    @DockerfileParser.content.setter
+    def content(self, content):
+        self._structure = None
+        DockerfileParser.content.fset(self, content)
+
+
+def enable_parse_cache(state_dir):
+    global parse_cache
+    parse_cache = ParseCache(os.path.join(state_dir, CACHE_DIR))
+
+
+def path_lock(path):
+    with _path_locks_lock:
+        return _path_locks.setdefault(path, Lock())
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def parse_config(content):
+    if parse_cache is not None:
+        cached = parse_cache.get('build.yml', content)
+        if cached is not None:
+            return cached
+
+    ret = yaml.safe_load(content)
+    if parse_cache is not None:
+        parse_cache.put('build.yml', content, ret)
+
+    return ret
 
 
 def load_config(base_path, module):
     conf_path = os.path.join(base_path, module, 'build.yml')
-    if conf_path in config_cache:
-        return config_cache[conf_path]
-
-    if not os.path.exists(conf_path):
+    mtime = get_mtime(conf_path)
+    if mtime is None:
         return {}
 
-    with open(conf_path, 'r') as f:
-        ret = yaml.safe_load(f)
-        config_cache[conf_path] = ret
+    with path_lock(conf_path):
+        # entries are (mtime, value) so edits are picked up by long-running
+        # processes, i.e. watch mode
+        cached = config_cache.get(conf_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        ret = parse_config(read_bytes(conf_path))
+        config_cache[conf_path] = (mtime, ret)
         return ret
 
 
@@ -184,16 +287,85 @@ def check_tag_contains_date(tag):
 
 def load_dockerfile(base_path, module):
     dockerfile_path = os.path.join(base_path, module, 'Dockerfile')
-    if dockerfile_path in dockerfile_cache:
-        return dockerfile_cache[dockerfile_path]
-
-    with open(dockerfile_path, 'r') as f:
-        p = DockerfileParser()
-        p.content = f.read()
-        dockerfile_cache[dockerfile_path] = p
+    mtime = get_mtime(dockerfile_path)
+    with path_lock(dockerfile_path):
+        cached = dockerfile_cache.get(dockerfile_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            content = read_bytes(dockerfile_path)
+        except IOError:
+            # a missing Dockerfile parses as empty, docker will complain
+            content = b''
+
+        structure = None
+        if parse_cache is not None:
+            structure = parse_cache.get('dockerfile', content)
+
+        p = CachedDockerfileParser(content, structure)
+        if parse_cache is not None and structure is None:
+            parse_cache.put('dockerfile', content, p.structure)
+
+        dockerfile_cache[dockerfile_path] = (mtime, p)
         return p
 
 
+def invalidate_module(base_path, module):
+    """Drops cached state derived from a module's files"""
+    context_hash_cache.pop(os.path.join(base_path, module), None)
+
+
+def hash_directory(path):
+    """Hashes the names and contents of all files in a directory"""
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            h.update(os.path.relpath(file_path, path).encode('utf-8'))
+            try:
+                with open(file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        h.update(chunk)
+            except IOError:
+                # e.g. a broken symlink, docker will complain if it matters
+                logger.debug('could not hash %s', file_path)
+
+    return h.hexdigest()
+
+
+def get_context_hash(base_path, module):
+    """Hashes the names and contents of all files in a module directory"""
+    module_path = os.path.join(base_path, module)
+    with path_lock(module_path):
+        if module_path not in context_hash_cache:
+            context_hash_cache[module_path] = hash_directory(module_path)
+
+        return context_hash_cache[module_path]
+
+
+def input_fingerprint(**inputs):
+    """Hashes a set of (json-serializable) plan inputs"""
+    data = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def new_run_id():
+    """Returns an ID for a run, IDs of later runs sort after earlier ones"""
+    return '%s-%s' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                      binascii.hexlify(os.urandom(2)))
+
+
+def image_labels(module, variant, run_id, fingerprint):
+    return {
+        LABEL_MODULE: module,
+        LABEL_VARIANT: variant or 'default',
+        LABEL_RUN: run_id,
+        LABEL_FINGERPRINT: fingerprint or ''
+    }
+
+
 def get_rebuild_targets(dockerfile):
     targets = []
     for ins in dockerfile.structure:
@@ -207,6 +379,123 @@ def get_rebuild_targets(dockerfile):
     return targets
 
 
+def get_base_images(dockerfile):
+    """Lists the external images referenced by FROM instructions
+
+    References to earlier build stages, `scratch`, and images that depend on
+    build args (i.e. contain a `$`) are excluded, since they can't be pulled
+    ahead of time.
+    """
+    stages = set()
+    images = []
+    for ins in dockerfile.structure:
+        if ins['instruction'] != 'FROM':
+            continue
+
+        parts = [p for p in ins['value'].split() if not p.startswith('--')]
+        if not parts:
+            continue
+
+        image = parts[0]
+        if len(parts) >= 3 and parts[1].lower() == 'as':
+            stages.add(parts[2].lower())
+
+        if image.lower() in stages or image == 'scratch' or '$' in image:
+            continue
+
+        if image not in images:
+            images.append(image)
+
+    return images
+
+
+def get_repositories(config):
+    """Lists the image repositories a module's build.yml can produce"""
+    repositories = set()
+    if config.get('repository'):
+        repositories.add(config['repository'])
+
+    for variant in config.get('variants', []):
+        if variant.get('repository'):
+            repositories.add(variant['repository'])
+
+    return repositories
+
+
+def strip_image_tag(image):
+    """Removes the tag or digest from an image reference"""
+    image = image.split('@', 1)[0]
+    name = image.rsplit('/', 1)[-1]
+    if ':' in name:
+        image = image.rsplit(':', 1)[0]
+
+    return image
+
+
+def get_module_dependencies(base_path, modules):
+    """Maps each module to the modules it builds FROM
+
+    A module depends on another when one of its base images is a repository
+    produced by the other module according to its build.yml.
+    """
+    producers = {}
+    for module in modules:
+        for repository in get_repositories(load_config(base_path, module)):
+            producers[repository] = module
+
+    dependencies = {}
+    for module in modules:
+        dockerfile = load_dockerfile(base_path, module)
+        deps = set()
+        for image in get_base_images(dockerfile):
+            producer = producers.get(strip_image_tag(image))
+            if producer and producer != module:
+                deps.add(producer)
+
+        dependencies[module] = deps
+
+    return dependencies
+
+
+def get_dependents(dependencies, modules):
+    """Expands a set of modules to everything that (transitively) uses them
+    """
+    result = set(modules)
+    changed = True
+    while changed:
+        changed = False
+        for module, deps in dependencies.items():
+            if module not in result and deps & result:
+                result.add(module)
+                changed = True
+
+    return result
+
+
+def dependency_levels(dependencies, modules):
+    """Groups modules so each group only depends on earlier groups
+
+    Dependencies outside of `modules` are ignored. Modules in a cycle end up
+    together in the last group.
+    """
+    remaining = [m for m in modules]
+    done = set()
+    levels = []
+    while remaining:
+        level = [m for m in remaining
+                 if not (dependencies.get(m, set()) & set(remaining))]
+        if not level:
+            logger.warning('dependency cycle between modules: %s',
+                           ', '.join(remaining))
+            level = remaining
+
+        levels.append(level)
+        done.update(level)
+        remaining = [m for m in remaining if m not in done]
+
+    return levels
+
+
 def list_modules(path):
     all_modules = map(lambda p: os.path.basename(os.path.dirname(p)),
                       glob.glob(os.path.join(path, '*/Dockerfile')))
@@ -260,26 +549,95 @@ def capture_docker(args):
     return out, err
 
 
+def abort_response(response):
+    """Closes a streamed `requests` response, unblocking pending reads
+
+    Closing alone doesn't interrupt a thread blocked reading the socket, so
+    the connection's socket is shut down first.
+    """
+    connection = getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            logger.debug('could not shut down stream socket', exc_info=True)
+
+    response.close()
+
+
+def abort_streams_on_cancel(client, token):
+    """Closes the HTTP responses behind docker-py streams when cancelled
+
+    Reads on a docker stream block until the daemon sends something, which
+    can take minutes during a quiet build step. Shutting down the socket
+    unblocks the reader immediately, and the daemon stops the build (or
+    push) once its client goes away.
+
+    The docker API client is a `requests` session, so this adds a response
+    hook that registers every streamed response with the token. Call it
+    before the request that opens the stream, on a client only used by one
+    plan.
+
+    :param client: the docker client that will open the streams
+    :param token: the plan's CancelToken
+    """
+    def hook(response, *args, **kwargs):
+        if kwargs.get('stream'):
+            token.on_cancel(lambda: abort_response(response))
+
+        return response
+
+    client.api.hooks['response'].append(hook)
+
+
+def iter_stream(stream, token):
+    """Iterates a docker stream, raising CancelledException on cancel
+
+    Errors caused by the stream being aborted are reported as cancellation
+    rather than as a failed build.
+    """
+    try:
+        for event in stream:
+            token.check()
+            yield event
+    except CancelledException:
+        raise
+    except Exception:
+        token.check()
+        raise
+
+    token.check()
+
+
 class InvalidDockerVersionException(Exception):
     pass
 
 
 def get_docker_client_version():
-    out, err = capture_docker(['version', '-f', '{{.Client.Version}}'])
-    return LooseVersion(out.strip())
+    global _docker_client_version
+
+    # checked once per build plan, but only needs to run once per process
+    with _docker_client_version_lock:
+        if _docker_client_version is None:
+            out, err = capture_docker(['version', '-f',
+                                       '{{.Client.Version}}'])
+            _docker_client_version = LooseVersion(out.strip())
+
+        return _docker_client_version
 
 
-def verify_docker_version():
+def verify_docker_version(min_version=MIN_DOCKER_VERSION):
     if os.environ.get('IGNORE_DOCKER_VERSION', 'false') == 'true':
         logger.debug('Skipping Docker version check')
         return
 
     docker_client_version = get_docker_client_version()
-    if docker_client_version >= MIN_DOCKER_VERSION:
+    if docker_client_version >= min_version:
         logger.debug('Docker version %s meets requirement >= %s',
-                     docker_client_version, MIN_DOCKER_VERSION)
+                     docker_client_version, min_version)
     else:
         raise InvalidDockerVersionException(
             'Installed Docker version %s does not meet requirement >= %s' % (
-                docker_client_version, MIN_DOCKER_VERSION
+                docker_client_version, min_version
             ))
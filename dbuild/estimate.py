@@ -0,0 +1,233 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import os
+import sys
+
+from dbuild.scheduler import FairQueue
+
+DURATIONS_FILE = 'durations.json'
+
+# number of recent durations kept per module, verb and variant
+DURATION_HISTORY = 5
+
+# guesses for plans that never ran: builds take this long per Dockerfile
+# instruction, other verbs a fixed time
+FALLBACK_SECONDS_PER_INSTRUCTION = 10.0
+FALLBACK_SECONDS = 10.0
+
+# upper bound for the worker counts compared in the estimate
+MAX_ESTIMATED_WORKERS = 32
+
+logger = logging.getLogger(__name__)
+
+
+def duration_key(plan):
+    return '%s/%s/%s' % (plan.module, plan.verb, plan.variant or 'default')
+
+
+def load_durations(state_dir):
+    """Returns recent durations of completed plans, by duration_key()"""
+    path = os.path.join(state_dir, DURATIONS_FILE)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_durations(state_dir, plans):
+    """Adds the durations of plans that ran successfully to the history"""
+    durations = load_durations(state_dir)
+    recorded = 0
+    for plan in plans:
+        status = plan.status
+        if not status.success or status.resumed or \
+                status.started_at is None or status.finished_at is None:
+            continue
+
+        history = durations.setdefault(duration_key(plan), [])
+        history.append(round(status.finished_at - status.started_at, 2))
+        del history[:-DURATION_HISTORY]
+        recorded += 1
+
+    if not recorded:
+        return
+
+    path = os.path.join(state_dir, DURATIONS_FILE)
+    try:
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        with open(path + '.tmp', 'w') as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        logger.debug('could not write %s', path, exc_info=True)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimate_duration(plan, durations):
+    """Returns (seconds, True if based on history) for a plan"""
+    history = durations.get(duration_key(plan))
+    if history:
+        return median(history), True
+
+    if plan.verb == 'build':
+        # status.total is the Dockerfile's instruction count
+        return plan.status.total * FALLBACK_SECONDS_PER_INSTRUCTION, False
+
+    return FALLBACK_SECONDS, False
+
+
+def dependencies(plan, seconds):
+    """Lists the plans that must finish first, if they still need to run"""
+    deps = list(plan.waits_for)
+    if plan.parent:
+        deps.append(plan.parent)
+
+    return [d for d in deps if d.id in seconds]
+
+
+def simulate(plans, seconds, workers):
+    """Simulates running plans with a number of workers
+
+    Plans start once their parent and the plans they wait for are done,
+    picked in the same order as the real scheduler.
+
+    :param plans: all plans, flattened
+    :param seconds: estimated duration by plan id
+    :return: the predicted wall time in seconds
+    """
+    queue = FairQueue()
+    pending = list(plans)
+    finished = set()
+    running = []
+    now = 0.0
+
+    while pending or running:
+        ready = [p for p in pending
+                 if all(d.id in finished for d in dependencies(p, seconds))]
+        while ready and len(running) < workers:
+            plan = ready.pop(queue.next(ready))
+            pending.remove(plan)
+            queue.started(plan)
+            running.append((now + seconds[plan.id], plan))
+
+        if not running:
+            # only possible with a dependency cycle
+            break
+
+        running.sort(key=lambda r: r[0])
+        now, plan = running.pop(0)
+        queue.finished(plan)
+        finished.add(plan.id)
+
+    return now
+
+
+def critical_path(plans, seconds):
+    """Returns the longest chain of dependent plans and its duration"""
+    finish = {}
+    previous = {}
+
+    def earliest_finish(plan):
+        if plan.id not in finish:
+            start = 0.0
+            for dep in dependencies(plan, seconds):
+                if earliest_finish(dep) > start:
+                    start = earliest_finish(dep)
+                    previous[plan.id] = dep
+
+            finish[plan.id] = start + seconds[plan.id]
+
+        return finish[plan.id]
+
+    if not plans:
+        return [], 0.0
+
+    last = max(plans, key=earliest_finish)
+    path = [last]
+    while path[-1].id in previous:
+        path.append(previous[path[-1].id])
+
+    return list(reversed(path)), finish[last.id]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm%02ds' % (hours, minutes, seconds)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+
+    return '%ds' % seconds
+
+
+def print_estimate(plans, workers, durations, file=sys.stdout):
+    """Prints the predicted wall time of running plans with `workers`
+
+    :param plans: all plans, flattened; restored plans count as done
+    """
+    plans = [p for p in plans if not p.status.finished]
+    seconds = {}
+    known = 0
+    for plan in plans:
+        seconds[plan.id], from_history = estimate_duration(plan, durations)
+        known += from_history
+
+    wall_time = simulate(plans, seconds, workers)
+    path, path_time = critical_path(plans, seconds)
+
+    print >> file, 'estimate: %d plans, %d with historical durations' % (
+        len(plans), known)
+    print >> file, '  total work:     %s' % format_duration(
+        sum(seconds.values()))
+    print >> file, '  wall time:      %s with %d workers' % (
+        format_duration(wall_time), workers)
+    print >> file, '  critical path:  %s' % format_duration(path_time)
+    for plan in path:
+        print >> file, '    %8s  %s %s (%s)' % (
+            format_duration(seconds[plan.id]), plan.verb, plan.module,
+            plan.variant or 'default')
+
+    print >> file, ''
+    print >> file, '  workers  wall time  speedup  marginal'
+    serial = simulate(plans, seconds, 1)
+    last = None
+    for count in range(1, min(len(plans), MAX_ESTIMATED_WORKERS) + 1):
+        estimate = simulate(plans, seconds, count)
+        speedup = serial / estimate if estimate else 1.0
+        marginal = ''
+        if last is not None:
+            marginal = '%.2fx' % (last / estimate if estimate else 1.0)
+
+        print >> file, '  %7d  %9s  %6.2fx  %s' % (
+            count, format_duration(estimate), speedup, marginal)
+
+        # no number of workers beats the critical path
+        if estimate <= path_time:
+            break
+        last = estimate
@@ -0,0 +1,68 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import subprocess
+
+from dbuild.docker_utils import SubprocessException
+
+logger = logging.getLogger(__name__)
+
+
+def capture_git(args, cwd):
+    logger.debug('Capturing git: %r', args)
+    p = subprocess.Popen(['git'] + args, cwd=cwd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise SubprocessException(p.returncode, out, err)
+
+    return out, err
+
+
+def get_changed_paths(path, ref):
+    """Lists files under `path` that differ from `ref`
+
+    This includes committed, staged and unstaged changes as well as untracked
+    (but not ignored) files. Paths are relative to `path`. Renamed files
+    are listed under both their old and new path.
+    """
+    diff, _ = capture_git(['diff', '--name-only', '--no-renames',
+                           '--relative', ref, '--'], path)
+    untracked, _ = capture_git(['ls-files', '--others', '--exclude-standard'],
+                               path)
+
+    return set(diff.splitlines()) | set(untracked.splitlines())
+
+
+def get_changed_modules(path, ref, modules):
+    """Returns the modules with at least one changed file since `ref`"""
+    changed = set()
+    for changed_path in get_changed_paths(path, ref):
+        parts = changed_path.split('/', 1)
+        if len(parts) == 2 and parts[0] in modules:
+            changed.add(parts[0])
+
+    logger.debug('modules changed since %s: %r', ref, sorted(changed))
+    return changed
+
+
+def is_git_repository(path):
+    try:
+        capture_git(['rev-parse', '--git-dir'], path)
+        return True
+    except (SubprocessException, OSError):
+        return False
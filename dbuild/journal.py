@@ -0,0 +1,130 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from threading import Lock
+
+JOURNAL_FILE = 'journal.jsonl'
+
+logger = logging.getLogger(__name__)
+
+
+def plan_key(plan):
+    """Identifies a plan across runs
+
+    Two plans share a key when they apply the same verb to the same module,
+    variant and tags, with the same input fingerprint.
+    """
+    ident = json.dumps([plan.module, plan.verb, plan.variant,
+                        sorted(plan.tags), plan.fingerprint])
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+class Journal(object):
+    """Records successfully completed plans so an interrupted run can resume
+
+    Entries are appended as JSON lines as soon as each plan finishes. When
+    resuming, the existing journal is read and kept; otherwise it is
+    replaced.
+    """
+
+    def __init__(self, state_dir, resume=False):
+        self.path = os.path.join(state_dir, JOURNAL_FILE)
+        self.lock = Lock()
+        self.completed = {}
+
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+        if resume:
+            self.completed = self.read()
+            logger.info('resuming: %d completed plans in journal',
+                        len(self.completed))
+
+        self.file = open(self.path, 'a' if resume else 'w')
+        if resume and self.file.tell() and not self.ends_with_newline():
+            # finish a partial line, or it would swallow the next entry
+            self.file.write('\n')
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def read(self):
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # most likely a partial line from an interrupted write
+                    logger.debug('ignoring invalid journal line: %r', line)
+                    continue
+
+                completed[entry['key']] = entry
+
+        return completed
+
+    def record(self, plan):
+        if not plan.status.success:
+            return
+
+        entry = {
+            'key': plan_key(plan),
+            'module': plan.module,
+            'verb': plan.verb,
+            'variant': plan.variant,
+            'tags': sorted(plan.tags),
+            'fingerprint': plan.fingerprint,
+            'artifacts': plan.artifacts,
+            'time': time.time()
+        }
+
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def restore(self, plans):
+        """Marks plans that completed in a previous run as finished
+
+        :return: the number of restored plans
+        """
+        restored = 0
+        for plan in plans:
+            entry = self.completed.get(plan_key(plan))
+            if not entry:
+                continue
+
+            logger.debug('restoring completed plan from journal: %r', plan)
+            plan.status.started = True
+            plan.status.finished = True
+            plan.status.resumed = True
+            plan.status.current = plan.status.total
+            plan.artifacts.extend(entry['artifacts'])
+            restored += 1
+
+        return restored
+
+    def close(self):
+        with self.lock:
+            self.file.close()
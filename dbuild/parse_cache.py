@@ -0,0 +1,136 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from threading import Lock
+
+# bump when the format of cached values, or how they are derived, changes
+CACHE_VERSION = 1
+
+CACHE_DIR = 'cache'
+
+logger = logging.getLogger(__name__)
+
+
+def from_json(value):
+    """Undoes the unicode conversion of json.loads()
+
+    Parsers return byte strings for ASCII text in Python 2 (PyYAML does,
+    for example), so cached values compare and format like fresh ones.
+    """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [from_json(v) for v in value]
+    if isinstance(value, dict):
+        return dict((from_json(k), from_json(v)) for k, v in value.items())
+
+    return value
+
+
+class ParseCache(object):
+    """Stores parse results on disk, keyed by a hash of the parsed content
+
+    Since keys depend only on content, entries never need invalidating: an
+    edited file simply hashes to a new key. Values are stored as JSON, so a
+    cache directory from an untrusted source can't run code; values JSON
+    can't represent faithfully (e.g. dates in YAML, or non-string keys) are
+    not cached.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def key(self, kind, content):
+        h = hashlib.sha256()
+        h.update('{}:{}:'.format(kind, CACHE_VERSION).encode('utf-8'))
+        h.update(content)
+        return h.hexdigest()
+
+    def path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key[:2], key + '.json')
+
+    def get(self, kind, content):
+        """Returns the cached value for `content`, or None if unknown
+
+        :param kind: the type of parser, e.g. `dockerfile`
+        :param content: the raw (byte string) content that was parsed
+        """
+        path = self.path(kind, self.key(kind, content))
+        try:
+            with open(path, 'rb') as f:
+                value = from_json(json.load(f))
+        except (IOError, OSError):
+            self.count(hit=False)
+            return None
+        except Exception:
+            # e.g. truncated by a full disk, treat as a miss and overwrite
+            logger.debug('ignoring unreadable cache entry: %s', path,
+                         exc_info=True)
+            self.count(hit=False)
+            return None
+
+        self.count(hit=True)
+        return value
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, kind, content, value):
+        try:
+            data = json.dumps(value, separators=(',', ':'))
+        except (TypeError, ValueError):
+            data = None
+        if data is None or from_json(json.loads(data)) != value:
+            logger.debug('not caching %s value, not representable as JSON',
+                         kind)
+            return
+
+        path = self.path(kind, self.key(kind, content))
+        parent = os.path.dirname(path)
+
+        try:
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # already created, possibly by another thread
+                if not os.path.isdir(parent):
+                    raise
+
+            # write to a temporary file first so concurrent invocations
+            # never see partial entries
+            fd, tmp_path = tempfile.mkstemp(dir=parent)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # e.g. a read-only checkout, caching is only an optimization
+            logger.debug('could not write cache entry: %s', path,
+                         exc_info=True)
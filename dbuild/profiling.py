@@ -0,0 +1,237 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import re
+import resource
+import sys
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, current_thread, local
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# number of allocation sites listed per phase in memory diffs
+MEMORY_DIFF_TOP = 25
+
+logger = logging.getLogger(__name__)
+
+# enable_profiling()
+profiler = None
+
+
+def phase_filename(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', name)
+
+
+def write_callgrind(stats, path):
+    """Writes pstats data in callgrind format, e.g. for kcachegrind
+
+    Costs are in microseconds. pstats lists the callers of each function,
+    callgrind lists the calls each function makes, so edges are inverted.
+    """
+    calls = {}
+    for callee, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, nc, _, ct) in callers.items():
+            calls.setdefault(caller, []).append((callee, nc, ct))
+
+    def us(seconds):
+        return int(round(seconds * 1e6))
+
+    with open(path, 'w') as f:
+        f.write('version: 1\ncreator: dbuild\n')
+        f.write('events: Microseconds\n\n')
+        for func, (_, _, tt, _, _) in sorted(stats.stats.items()):
+            filename, line, name = func
+            f.write('fl=%s\nfn=%s\n' % (filename, name))
+            f.write('%d %d\n' % (line, us(tt)))
+            for callee, nc, ct in sorted(calls.get(func, [])):
+                f.write('cfl=%s\ncfn=%s\n' % (callee[0], callee[2]))
+                f.write('calls=%d %d\n' % (nc, callee[1]))
+                f.write('%d %d\n' % (line, us(ct)))
+
+            f.write('\n')
+
+
+def memory_usage():
+    """Returns (resident, peak resident) memory of this process in bytes
+
+    The current resident size is only known on Linux, None elsewhere.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # kilobytes everywhere but on macOS
+        peak *= 1024
+
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        resident = None
+
+    return resident, peak
+
+
+def format_mib(size):
+    if size is None:
+        return '?'
+
+    return '%.1f MiB' % (size / 1024.0 ** 2)
+
+
+class Profiler(object):
+    """Collects cProfile data per named phase of a run
+
+    A phase may be entered any number of times and from several threads at
+    once (e.g. plan generation); all of its profiles are merged when
+    written. With `memory`, phases entered on the main thread also write
+    the process' resident and peak memory at their start and end and, where
+    tracemalloc is available, the difference of snapshots taken then.
+    """
+
+    def __init__(self, path, memory=False):
+        self.path = path
+        self.memory = memory
+        self.tracemalloc = memory and tracemalloc is not None
+        self.profiles = {}
+        self.lock = Lock()
+        self.local = local()
+
+        if memory and tracemalloc is None:
+            logger.info('tracemalloc is not available, only recording the '
+                        'memory usage of the process')
+        if self.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        # sys.setprofile() is per thread, so is the active profile. Nested
+        # phases count toward the outer one
+        if getattr(self.local, 'active', None):
+            yield
+            return
+
+        usage, snapshot = None, None
+        if self.memory and current_thread().name == 'MainThread':
+            usage = memory_usage()
+            if self.tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+
+        profile = cProfile.Profile()
+        self.local.active = profile
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.active = None
+            with self.lock:
+                self.profiles.setdefault(name, []).append(profile)
+
+            if usage is not None:
+                self.write_memory_diff(name, usage, snapshot)
+
+    def write_memory_diff(self, name, usage, snapshot=None):
+        resident, peak = memory_usage()
+        path = os.path.join(self.path, '%s.memory.txt' % phase_filename(name))
+        with open(path, 'a') as f:
+            f.write('%s: resident %s -> %s, peak %s -> %s\n' % (
+                name, format_mib(usage[0]), format_mib(resident),
+                format_mib(usage[1]), format_mib(peak)))
+
+            if snapshot is not None:
+                diff = tracemalloc.take_snapshot().compare_to(snapshot,
+                                                              'lineno')
+                f.write('%d allocation sites changed\n' % len(diff))
+                for stat in diff[:MEMORY_DIFF_TOP]:
+                    f.write('  %s\n' % stat)
+
+            f.write('\n')
+
+    def write(self):
+        """Writes one .pstats and one .callgrind file per phase"""
+        with self.lock:
+            phases = sorted(self.profiles.items())
+
+        written = 0
+        for name, profiles in phases:
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if not profile.stats:
+                    continue
+
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+
+            if stats is None:
+                continue
+
+            base = os.path.join(self.path, phase_filename(name))
+            stats.dump_stats(base + '.pstats')
+            write_callgrind(stats, base + '.callgrind')
+            written += 1
+
+        logger.info('wrote profiles of %d phases to %s', written, self.path)
+
+
+def enable_profiling(path, memory=False):
+    """Profiles phases of this run and writes them to `path` on exit"""
+    global profiler
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    profiler = Profiler(path, memory)
+    atexit.register(profiler.write)
+
+
+@contextmanager
+def profiled(name):
+    """Profiles the enclosed block as (part of) phase `name`, if enabled"""
+    if profiler is None:
+        yield
+        return
+
+    with profiler.phase(name):
+        yield
+
+
+def profiled_function(name):
+    """Decorates a function to profile its calls as phase `name`
+
+    `{thread}` in the name is replaced with the name of the calling thread,
+    e.g. to profile each worker thread separately.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if profiler is None:
+                return func(*args, **kwargs)
+
+            with profiler.phase(name.format(thread=current_thread().name)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,135 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+import docker
+
+from docker.utils import parse_repository_tag
+
+DEFAULT_PULL_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePuller(object):
+    """Pulls images in the background, at most once per image per run
+
+    Images are pulled on a dedicated, bounded thread pool so pulls can
+    overlap with plan generation and with other builds. Requesting the same
+    image more than once returns the original future.
+    """
+
+    def __init__(self, workers=DEFAULT_PULL_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+        self.futures = {}
+        self.timings = {}
+
+    def pull(self, image):
+        """Requests a pull of `image`, returning a future
+
+        The future's result is True if the image was pulled successfully,
+        False otherwise. Pull failures are not fatal: an image that has never
+        been published is simply not available as a cache source.
+        """
+        with self.lock:
+            if image not in self.futures:
+                logger.debug('queueing pull: %s', image)
+                self.timings[image] = (time.time(), None)
+                self.futures[image] = self.executor.submit(self._pull, image)
+
+            return self.futures[image]
+
+    def get(self, image):
+        """Returns the future for an already requested pull, or None"""
+        with self.lock:
+            return self.futures.get(image)
+
+    def elapsed(self, images):
+        """Wall time from the first request to the last completed pull
+
+        :param images: the images to consider, usually one phase's requests
+        :return: elapsed seconds, or None if no pull has finished
+        """
+        with self.lock:
+            timings = [self.timings[i] for i in images if i in self.timings]
+
+        finished = [end for start, end in timings if end is not None]
+        if not finished:
+            return None
+
+        return max(finished) - min(start for start, end in timings)
+
+    def _pull(self, image):
+        try:
+            return self._do_pull(image)
+        finally:
+            with self.lock:
+                start, _ = self.timings[image]
+                self.timings[image] = (start, time.time())
+
+    # noinspection PyBroadException
+    def _do_pull(self, image):
+        repo, tag = parse_repository_tag(image)
+
+        try:
+            client = docker.from_env(version='auto')
+            last_event = None
+            for event in client.api.pull(repo, tag=tag or 'latest',
+                                         stream=True, decode=True):
+                last_event = event
+                if 'error' in event:
+                    logger.debug('pull %s: %s', image, event['error'])
+        except Exception as ex:
+            # e.g. the daemon is unreachable, which shouldn't fail the build
+            # plans waiting on this pull either
+            logger.warning('pull %s failed: %s', image, ex)
+            return False
+
+        if last_event is None or 'error' in last_event:
+            logger.debug('could not pull %s, will not use it', image)
+            return False
+
+        logger.debug('pulled %s', image)
+        return True
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class NullPuller(object):
+    """Stands in for ImagePuller when plans are generated but never run
+
+    Requested pulls don't happen and report the image as unavailable, e.g.
+    so `--estimate` has no side effects.
+    """
+
+    def pull(self, image):
+        future = Future()
+        future.set_result(False)
+        return future
+
+    def get(self, image):
+        return None
+
+    def elapsed(self, images):
+        return None
+
+    def shutdown(self):
+        pass
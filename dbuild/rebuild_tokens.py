@@ -0,0 +1,117 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import logging
+import os
+import subprocess
+
+from dbuild.docker_utils import SubprocessException, hash_directory
+from dbuild.git_utils import capture_git
+from dbuild.verb import VerbException
+
+# ways to derive a rebuild token in a `rebuild` block of build.yml
+SOURCE_GIT = 'git'
+SOURCE_FILE = 'file'
+SOURCE_COMMAND = 'command'
+SOURCES = (SOURCE_GIT, SOURCE_FILE, SOURCE_COMMAND)
+
+# length of the hex digests used in tokens
+TOKEN_LENGTH = 16
+
+logger = logging.getLogger(__name__)
+
+
+def short_hash(data):
+    return hashlib.sha256(data).hexdigest()[:TOKEN_LENGTH]
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+
+    return h.hexdigest()[:TOKEN_LENGTH]
+
+
+def git_token(path):
+    """The checkout's commit, plus a hash of uncommitted changes if any"""
+    commit, _ = capture_git(['rev-parse', 'HEAD'], path)
+    token = 'git-%s' % commit.strip()
+
+    status, _ = capture_git(['status', '--porcelain'], path)
+    if status.strip():
+        diff, _ = capture_git(['diff', 'HEAD'], path)
+        token += '-dirty-%s' % short_hash(status + diff)
+
+    return token
+
+
+def file_token(path):
+    if os.path.isdir(path):
+        return 'file-%s' % hash_directory(path)[:TOKEN_LENGTH]
+
+    return 'file-%s' % hash_file(path)
+
+
+def command_token(command, cwd):
+    logger.debug('Resolving rebuild token: %s', command)
+    p = subprocess.Popen(command, shell=True, cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise SubprocessException(p.returncode, out, err)
+
+    return 'command-%s' % short_hash(out)
+
+
+def resolve_rebuild_token(base_path, module, target, source,
+                          run_commands=True):
+    """Derives a rebuild token from the content a rebuild target depends on
+
+    The token only changes when the content does, so rebuilding a target
+    reuses the build cache until its upstream actually changed.
+
+    :param source: the target's entry in the `rebuild` block of build.yml,
+                   e.g. `{'git': '../checkout'}`; paths are relative to the
+                   module directory, commands run in it
+    :param run_commands: if False, command sources are not run and get a
+                         placeholder token, e.g. when plans are only
+                         estimated
+    """
+    if not isinstance(source, dict) or len(source) != 1 or \
+            source.keys()[0] not in SOURCES:
+        raise VerbException('rebuild target %s of %s needs exactly one of '
+                            '%s, got: %r' % (target, module,
+                                             ', '.join(SOURCES), source))
+
+    kind, value = source.items()[0]
+    module_path = os.path.join(base_path, module)
+    try:
+        if kind == SOURCE_GIT:
+            token = git_token(os.path.join(module_path, value))
+        elif kind == SOURCE_FILE:
+            token = file_token(os.path.join(module_path, value))
+        elif run_commands:
+            token = command_token(value, module_path)
+        else:
+            token = 'command-unresolved'
+    except (SubprocessException, EnvironmentError) as ex:
+        raise VerbException('could not resolve rebuild target %s of %s from '
+                            '%s %r: %s' % (target, module, kind, value,
+                                           str(ex).strip()))
+
+    logger.debug('rebuild token for %s/%s: %s', module, target, token)
+    return token
@@ -0,0 +1,284 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import urlparse
+
+from threading import Lock
+
+import requests
+
+MEDIA_TYPE_MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+MEDIA_TYPE_MANIFEST_LIST = \
+    'application/vnd.docker.distribution.manifest.list.v2+json'
+MEDIA_TYPE_OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+MEDIA_TYPE_OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+
+MANIFEST_TYPES = [MEDIA_TYPE_MANIFEST, MEDIA_TYPE_MANIFEST_LIST,
+                  MEDIA_TYPE_OCI_MANIFEST, MEDIA_TYPE_OCI_INDEX]
+MANIFEST_LIST_TYPES = [MEDIA_TYPE_MANIFEST_LIST, MEDIA_TYPE_OCI_INDEX]
+
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+DOCKER_HUB_AUTH_KEY = 'https://index.docker.io/v1/'
+
+CHUNK_SIZE = 1024 * 1024
+
+# max number of concurrent blob transfers when copying images
+DEFAULT_MIRROR_WORKERS = 4
+
+REGEX_CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+logger = logging.getLogger(__name__)
+
+
+class RegistryException(Exception):
+    pass
+
+
+def registry_host(registry):
+    """Returns the host (and port) to talk to for a DockerTag registry"""
+    if not registry or registry in ('docker.io', 'index.docker.io'):
+        return DOCKER_HUB_REGISTRY
+
+    if registry.endswith(':443'):
+        return registry[:-4]
+
+    return registry
+
+
+def registry_path(tag):
+    """Returns the repository name of a DockerTag used in API paths"""
+    path = tag.namespace + '/' + tag.image if tag.namespace else tag.image
+    if '/' not in path and registry_host(tag.registry) == DOCKER_HUB_REGISTRY:
+        path = 'library/' + path
+
+    return path
+
+
+def is_insecure(host):
+    # like docker, allow plain http for registries on the local host
+    name = host.split(':')[0]
+    return name == 'localhost' or name.startswith('127.')
+
+
+def load_docker_credentials(host):
+    """Looks up (username, password) for a registry in the docker config
+
+    Only credentials stored in the config file itself are supported, not
+    credential helpers.
+    """
+    config_dir = os.environ.get('DOCKER_CONFIG',
+                                os.path.expanduser('~/.docker'))
+    try:
+        with open(os.path.join(config_dir, 'config.json')) as f:
+            auths = json.load(f).get('auths', {})
+    except (IOError, ValueError):
+        return None
+
+    keys = [host, 'https://%s' % host, 'http://%s' % host]
+    if host == DOCKER_HUB_REGISTRY:
+        keys.insert(0, DOCKER_HUB_AUTH_KEY)
+
+    for key in keys:
+        auth = auths.get(key, {}).get('auth')
+        if auth:
+            username, password = base64.b64decode(auth).split(':', 1)
+            return username, password
+
+    return None
+
+
+def manifest_digest(body):
+    return 'sha256:' + hashlib.sha256(body).hexdigest()
+
+
+def repository_scope(repository, actions):
+    return 'repository:%s:%s' % (repository, actions)
+
+
+class SizedStream(object):
+    """A request body streamed from an iterator, with a known length
+
+    requests sends a Content-Length for objects with a length instead of
+    using chunked encoding, which not all registries accept for uploads.
+    """
+
+    def __init__(self, chunks, size, callback=None):
+        self.chunks = chunks
+        self.size = size
+        self.callback = callback
+        self.buffer = b''
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+
+            if self.callback:
+                self.callback(len(chunk))
+            self.buffer += chunk
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+
+class RegistryClient(object):
+    """A minimal Docker registry v2 API client
+
+    Handles anonymous, basic, and token authentication; tokens are cached
+    per scope and shared by all threads using the client.
+    """
+
+    def __init__(self, host, credentials=None):
+        self.host = host
+        scheme = 'http' if is_insecure(host) else 'https'
+        self.base_url = '%s://%s' % (scheme, host)
+
+        self.credentials = credentials or load_docker_credentials(host)
+        self.session = requests.Session()
+        self.auth_headers = {}
+        self.lock = Lock()
+
+    def authenticate(self, response, scopes):
+        challenge = response.headers.get('WWW-Authenticate', '')
+        scheme = challenge.split(' ', 1)[0].lower()
+        if scheme == 'basic':
+            if not self.credentials:
+                raise RegistryException('%s requires credentials' % self.host)
+
+            return 'Basic ' + base64.b64encode(
+                '%s:%s' % self.credentials)
+
+        if scheme != 'bearer':
+            raise RegistryException('unsupported authentication: %r' %
+                                    challenge)
+
+        params = dict(REGEX_CHALLENGE_PARAM.findall(challenge))
+        query = {'scope': list(scopes)}
+        if 'service' in params:
+            query['service'] = params['service']
+
+        r = requests.get(params['realm'], params=query,
+                         auth=self.credentials)
+        r.raise_for_status()
+        token = r.json().get('token') or r.json().get('access_token')
+        return 'Bearer ' + token
+
+    def request(self, method, path, scopes, retry_auth=True, **kwargs):
+        url = urlparse.urljoin(self.base_url, path)
+        headers = kwargs.pop('headers', {})
+
+        with self.lock:
+            auth = self.auth_headers.get(scopes)
+        if auth:
+            headers['Authorization'] = auth
+
+        r = self.session.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401 and retry_auth:
+            auth = self.authenticate(r, scopes)
+            with self.lock:
+                self.auth_headers[scopes] = auth
+
+            return self.request(method, path, scopes, False,
+                                headers=headers, **kwargs)
+
+        return r
+
+    def check(self, response, *expected):
+        if response.status_code not in expected:
+            raise RegistryException('%s %s: %d %s' % (
+                response.request.method, response.url, response.status_code,
+                response.text[:200]))
+
+        return response
+
+    def get_manifest(self, repository, reference):
+        """Returns the raw manifest, its media type, and its digest"""
+        r = self.check(self.request(
+            'GET', '/v2/%s/manifests/%s' % (repository, reference),
+            (repository_scope(repository, 'pull'),),
+            headers={'Accept': ', '.join(MANIFEST_TYPES)}), 200)
+
+        body = r.content
+        media_type = r.headers.get('Content-Type', '').split(';')[0]
+        if media_type not in MANIFEST_TYPES:
+            media_type = json.loads(body).get('mediaType', media_type)
+
+        digest = r.headers.get('Docker-Content-Digest') or \
+            manifest_digest(body)
+        return body, media_type, digest
+
+    def put_manifest(self, repository, reference, body, media_type):
+        self.check(self.request(
+            'PUT', '/v2/%s/manifests/%s' % (repository, reference),
+            (repository_scope(repository, 'pull,push'),),
+            headers={'Content-Type': media_type}, data=body), 201)
+
+    def has_blob(self, repository, digest):
+        r = self.request(
+            'HEAD', '/v2/%s/blobs/%s' % (repository, digest),
+            (repository_scope(repository, 'pull'),))
+        return r.status_code == 200
+
+    def open_blob(self, repository, digest):
+        """Returns an iterator over the blob's content"""
+        r = self.check(self.request(
+            'GET', '/v2/%s/blobs/%s' % (repository, digest),
+            (repository_scope(repository, 'pull'),), stream=True), 200)
+        return r.iter_content(CHUNK_SIZE)
+
+    def upload_blob(self, repository, digest, open_blob, size,
+                    from_repository=None, callback=None):
+        """Uploads a blob, or mounts it from another repository if possible
+
+        :param open_blob: callable returning an iterator over the content,
+                          only called if the blob needs to be uploaded
+        :param from_repository: a repository on this registry that has the
+                                blob, for a cross-repository mount
+        :param callback: called with the size of each uploaded chunk
+        :return: True if the blob was mounted rather than uploaded
+        """
+        scopes = (repository_scope(repository, 'pull,push'),)
+        params = {}
+        if from_repository:
+            scopes += (repository_scope(from_repository, 'pull'),)
+            params = {'mount': digest, 'from': from_repository}
+
+        r = self.check(self.request(
+            'POST', '/v2/%s/blobs/uploads/' % repository, scopes,
+            params=params), 201, 202)
+        if r.status_code == 201:
+            return True
+
+        # the body can't be replayed, but the POST already authenticated
+        self.check(self.request(
+            'PUT', r.headers['Location'], scopes, retry_auth=False,
+            params={'digest': digest},
+            headers={'Content-Type': 'application/octet-stream'},
+            data=SizedStream(open_blob(), size, callback)), 201)
+        return False
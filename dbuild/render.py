@@ -0,0 +1,300 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import abc
+import json
+import sys
+import textwrap
+import time
+
+from tqdm import tqdm
+
+OUTPUT_PROGRESS = 'progress'
+OUTPUT_PLAIN = 'plain'
+OUTPUT_JSONL = 'jsonl'
+OUTPUT_MODES = (OUTPUT_PROGRESS, OUTPUT_PLAIN, OUTPUT_JSONL)
+
+
+def text_stream(arguments):
+    """Returns where to print text such as plan listings or verb output
+
+    JSON events written to stdout must not be mixed with text, which then
+    goes to stderr instead.
+    """
+    if arguments.output == OUTPUT_JSONL and not arguments.output_file:
+        return sys.stderr
+
+    return sys.stdout
+
+
+def print_artifacts(plans, offset='', file=sys.stdout):
+    for plan in plans:
+        status = plan.status.as_str
+        if plan.status.resumed:
+            status += ' (resumed)'
+
+        print >> file, textwrap.fill(
+            '%s - %s: %s' % (plan.verb, status, ', '.join(plan.artifacts)),
+            width=200,
+            initial_indent=offset,
+            subsequent_indent=offset + '     '
+        )
+
+        print_artifacts(plan.children, offset + '  ', file)
+
+
+def print_output_excerpt(plan, file=sys.stdout):
+    if not plan.status.output:
+        return
+
+    print >> file, ''
+    print >> file, 'last %d lines of output: %s %s (%s)' % (
+        len(plan.status.output), plan.verb, plan.module,
+        plan.variant or 'default')
+    for line in plan.status.output:
+        print >> file, '  |', line
+
+
+def print_summary(plan_dict, failures, file=sys.stdout):
+    for plan in failures:
+        print_output_excerpt(plan, file)
+
+    print >> file, ''
+    for module, plan_list in plan_dict.items():
+        print >> file, 'artifacts:', module
+        print_artifacts(plan_list, offset='  ', file=file)
+        print >> file, ''
+
+
+# see also: https://github.com/tqdm/tqdm#redirecting-writing
+class DummyTqdmFile(object):
+    def __init__(self, bar, dest=sys.stdout):
+        self.bar = bar
+        self.dest = dest
+
+    def write(self, line):
+        line = line.rstrip()
+        if line:
+            self.bar.write(line, file=self.dest)
+
+
+class ProgressRenderer(object):
+    """Draws a progress bar per module, for interactive use
+
+    :param handler: the logging handler to redirect above the bars
+    :param describe: callable returning a short description of a plan
+    """
+
+    BAR_FORMAT = ('{desc}{percentage:3.0f}% |{bar}| {n_fmt}/{total_fmt} '
+                  '{postfix}]')
+
+    def __init__(self, handler, describe):
+        self.handler = handler
+        self.describe = describe
+        self.bars = {}
+
+    def start(self, plan_dict):
+        position = 0
+        for module, plans in plan_dict.iteritems():
+            step_count = sum([plan.total_progress for plan in plans])
+            bar = tqdm(desc=module, total=step_count,
+                       bar_format=self.BAR_FORMAT, position=position,
+                       file=sys.stderr, dynamic_ncols=True)
+
+            self.bars[module] = bar
+            position += 1
+
+        if self.bars:
+            self.handler.stream = DummyTqdmFile(self.bars.values()[0])
+
+    def update(self, plan_dict):
+        for module, plans in plan_dict.iteritems():
+            bar = self.bars[module]
+
+            current_sum = 0
+            active = []
+            for plan in plans:
+                current_sum += plan.current_progress
+                active.extend(plan.active_in_tree())
+
+            # e.g. saved images only know their size once they're built
+            bar.total = sum(plan.total_progress for plan in plans)
+            bar.n = current_sum
+
+            if len(active) > 1:
+                post = ', '.join(p.verb for p in active)
+            elif len(active) == 1:
+                post = self.describe(active[0])
+            elif current_sum < bar.total:
+                post = ' ... waiting ...'
+            else:
+                post = 'done!'
+
+            if len(post) > 40:
+                post = post[:37] + '...'
+
+            bar.postfix = '%-40s' % post
+            bar.refresh()
+
+    def finish(self, plan_dict, flat_plans, failures):
+        for bar in self.bars.values():
+            bar.close()
+
+        self.handler.stream = sys.stdout
+        print_summary(plan_dict, failures)
+
+
+class TransitionRenderer(object):
+    """Base for renderers that report plan state changes as events
+
+    State is sampled on each update; a plan that started and finished
+    between two updates still produces both events, using the timestamps
+    recorded in its status.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.seen = {}
+
+    def snapshot(self, plan):
+        status = plan.status
+        return (status.attempts, status.retry_at is not None,
+                status.finished)
+
+    def start(self, plan_dict):
+        pass
+
+    def update(self, plan_dict):
+        for plans in plan_dict.values():
+            self.update_tree(plans)
+
+    def update_tree(self, plans):
+        for plan in plans:
+            self.update_plan(plan)
+            self.update_tree(plan.children)
+
+    def update_plan(self, plan):
+        attempts, retrying, finished = self.snapshot(plan)
+        last_attempts, last_retrying, last_finished = self.seen.get(
+            plan.id, (0, False, False))
+
+        if attempts > last_attempts:
+            self.emit('started', plan)
+        if retrying and (not last_retrying or attempts > last_attempts):
+            self.emit('retrying', plan)
+        if finished and not last_finished:
+            self.emit('finished', plan)
+
+        self.seen[plan.id] = (attempts, retrying, finished)
+
+    @abc.abstractmethod
+    def emit(self, event, plan):
+        """Reports a plan event: started, retrying or finished"""
+
+    def finish(self, plan_dict, flat_plans, failures):
+        self.update(plan_dict)
+
+
+class PlainRenderer(TransitionRenderer):
+    """Prints one line per plan state change, for logs and CI"""
+
+    def emit(self, event, plan):
+        status = plan.status
+        name = '%s %s' % (plan.verb, plan.module)
+        if plan.variant:
+            name += ' (%s)' % plan.variant
+
+        if event == 'started':
+            line = '%s: started' % name
+            if status.attempts > 1:
+                line += ', attempt %d' % status.attempts
+        elif event == 'retrying':
+            line = '%s: failed, retrying in %ds: %s' % (
+                name, max(0, status.retry_at - time.time()), status.error)
+        else:
+            line = '%s: %s' % (name, status.as_str)
+            if status.resumed:
+                line += ' (resumed)'
+            elif status.started_at and status.finished_at:
+                line += ' in %.1fs' % (status.finished_at - status.started_at)
+            if status.error and not status.success:
+                line += ': %s' % status.error
+
+        print >> self.stream, time.strftime('%H:%M:%S'), line
+        self.stream.flush()
+
+    def finish(self, plan_dict, flat_plans, failures):
+        super(PlainRenderer, self).finish(plan_dict, flat_plans, failures)
+        print_summary(plan_dict, failures, self.stream)
+
+
+class JsonRenderer(TransitionRenderer):
+    """Writes one JSON object per line and plan state change
+
+    Every event has an `event` type and a `time`; plan events describe the
+    plan, and the last event is a `summary` of the run.
+    """
+
+    def emit(self, event, plan, **extra):
+        status = plan.status
+        data = {
+            'event': event,
+            'time': time.time(),
+            'id': plan.id,
+            'parent': plan.parent.id if plan.parent else None,
+            'module': plan.module,
+            'verb': plan.verb,
+            'variant': plan.variant,
+            'tags': plan.tags,
+            'attempt': status.attempts,
+            'started_at': status.started_at,
+        }
+
+        if event == 'retrying':
+            data['error'] = status.error
+            data['retry_at'] = status.retry_at
+        elif event == 'finished':
+            data['result'] = status.as_str
+            data['resumed'] = status.resumed
+            data['finished_at'] = status.finished_at
+            if status.started_at and status.finished_at:
+                data['duration'] = status.finished_at - status.started_at
+            data['artifacts'] = plan.artifacts
+            if not status.success:
+                data['error'] = status.error
+                data['output'] = list(status.output)
+
+        self.write(data)
+
+    def write(self, data):
+        self.stream.write(json.dumps(data, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    def finish(self, plan_dict, flat_plans, failures):
+        super(JsonRenderer, self).finish(plan_dict, flat_plans, failures)
+
+        results = {}
+        for plan in flat_plans:
+            result = plan.status.as_str
+            results[result] = results.get(result, 0) + 1
+
+        self.write({
+            'event': 'summary',
+            'time': time.time(),
+            'plans': len(flat_plans),
+            'results': results,
+            'success': not failures
+        })
@@ -0,0 +1,382 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import re
+import time
+
+import attr
+
+from dbuild.docker_utils import capture_docker, SubprocessException
+
+# seconds between autoscaling decisions
+AUTOSCALE_INTERVAL = 10.0
+
+# 1-minute load average per core above which we stop adding workers, and
+# above which we start removing them
+AUTOSCALE_LOAD_LOW = 0.75
+AUTOSCALE_LOAD_HIGH = 1.5
+
+# minimum fraction of memory / disk that must remain available
+AUTOSCALE_MIN_FREE_MEMORY = 0.10
+AUTOSCALE_MIN_FREE_DISK = 0.10
+
+# throughput drop (relative to the previous window) treated as the daemon
+# slowing down after we added a worker
+AUTOSCALE_THROUGHPUT_DROP = 0.25
+
+# errors of failed plans that suggest the daemon or host is struggling, as
+# opposed to e.g. a failing Dockerfile step. 137 is a step killed by the
+# OOM killer
+REGEX_AUTOSCALE_DISTRESS = re.compile(
+    r'(?i)(\b5\d\d\b|timeout|timed out|connection (reset|refused|aborted)|'
+    r'broken pipe|\bEOF\b|temporar|unavailable|no space left|'
+    r'cannot allocate memory|out of memory|code:? 137\b)')
+
+# priority classes for modules, plans of higher classes start first
+PRIORITY_CLASSES = {'high': 1, 'normal': 0, 'low': -1}
+
+REGEX_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.I)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3,
+              't': 1024 ** 4}
+
+logger = logging.getLogger(__name__)
+
+
+def worker_count(value):
+    """argparse type for --workers: a positive integer or 'auto'"""
+    if value == 'auto':
+        return value
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+
+    if count < 1:
+        raise argparse.ArgumentTypeError(
+            'expected a number of at least 1 or \'auto\', got %r' % value)
+
+    return count
+
+
+def priority_override(value):
+    """argparse type for --priority: MODULE=CLASS"""
+    module, _, name = value.partition('=')
+    if not module or name not in PRIORITY_CLASSES:
+        raise argparse.ArgumentTypeError(
+            'expected MODULE=CLASS with a class of: %s' %
+            ', '.join(sorted(PRIORITY_CLASSES)))
+
+    return module, name
+
+
+def module_priority(config, name=None):
+    """Returns the numeric priority of a module
+
+    :param config: the module's build.yml, with an optional `priority`
+    :param name: a class given on the command line, overriding the config
+    """
+    name = name or config.get('priority') or 'normal'
+    if name not in PRIORITY_CLASSES:
+        raise ValueError('invalid priority class %r, must be one of: %s' % (
+            name, ', '.join(sorted(PRIORITY_CLASSES))))
+
+    return PRIORITY_CLASSES[name]
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def parse_size(value):
+    """Parses a memory size like '512m' or '4g' (or plain bytes)"""
+    if isinstance(value, (int, long, float)):
+        return int(value)
+
+    m = REGEX_SIZE.match(str(value))
+    if not m:
+        raise ValueError('invalid size: %r' % value)
+
+    number, unit = m.groups()
+    return int(float(number) * SIZE_UNITS[unit.lower()])
+
+
+@attr.s
+class Resources(object):
+    cpu = attr.ib(default=0.0)
+    memory = attr.ib(default=0)
+
+    @classmethod
+    def from_config(cls, config):
+        """Reads an optional `resources: {cpu, memory}` block"""
+        if not config or 'resources' not in config:
+            return None
+
+        res = config['resources'] or {}
+        return cls(cpu=float(res.get('cpu', 0)),
+                   memory=parse_size(res.get('memory', 0)))
+
+
+def read_meminfo():
+    """Returns (available, total) memory in kB, or None if unknown"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            info = {}
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+
+    if 'MemAvailable' not in info or 'MemTotal' not in info:
+        return None
+
+    return info['MemAvailable'], info['MemTotal']
+
+
+def get_docker_root():
+    """Returns the daemon's root directory if it is on this host"""
+    try:
+        out, _ = capture_docker(['info', '-f', '{{.DockerRootDir}}'])
+    except (SubprocessException, OSError):
+        return None
+
+    path = out.strip()
+    if path and os.path.isdir(path):
+        return path
+
+    return None
+
+
+def distress_failures(plans):
+    """Returns (plan id, attempt) of failed attempts that hint at overload
+
+    Only attempts that actually ran count, not plans failed because their
+    parent did, and only errors matching REGEX_AUTOSCALE_DISTRESS. Attempts
+    that will be retried count too.
+    """
+    failures = set()
+    for plan in plans:
+        status = plan.status
+        if not status.attempts or not (status.failed or status.retry_at):
+            continue
+
+        if REGEX_AUTOSCALE_DISTRESS.search(status.error or ''):
+            failures.add((plan.id, status.attempts))
+
+    return failures
+
+
+class WorkerLimit(object):
+    """A fixed limit on the number of concurrently executing plans"""
+
+    def __init__(self, workers):
+        self.limit = workers
+        self.max_workers = workers
+
+    def update(self, plans, running, waiting):
+        pass
+
+
+class AutoscalingWorkerLimit(WorkerLimit):
+    """Adjusts the number of concurrently executing plans during a run
+
+    Workers are added one at a time while every slot is busy, plans are
+    waiting, and the host has headroom. Workers are removed when the host is
+    overloaded (load average, available memory, free disk under the Docker
+    root) or when step throughput drops after adding a worker. New failures
+    that look like a struggling daemon (see distress_failures()) halve the
+    limit, since it tends to fail builds rather than just slow them down.
+    """
+
+    def __init__(self, max_workers=None):
+        cores = cpu_count()
+        self.cores = cores
+        self.max_workers = max_workers or cores * 2
+        self.limit = max(1, min(self.max_workers, cores // 2))
+        self.docker_root = get_docker_root()
+
+        self.last_update = time.time()
+        self.last_progress = None
+        self.last_rate = None
+        self.seen_failures = set()
+        self.grew = False
+
+        logger.info('autoscaling workers: starting with %d, max %d',
+                    self.limit, self.max_workers)
+
+    def host_pressure(self):
+        """Returns a list of reasons the host is overloaded, if any"""
+        reasons = []
+
+        try:
+            load = os.getloadavg()[0] / self.cores
+            if load > AUTOSCALE_LOAD_HIGH:
+                reasons.append('load %.2f/core' % load)
+        except OSError:
+            pass
+
+        meminfo = read_meminfo()
+        if meminfo:
+            available, total = meminfo
+            if float(available) / total < AUTOSCALE_MIN_FREE_MEMORY:
+                reasons.append('memory %d%% free' % (100 * available / total))
+
+        if self.docker_root:
+            st = os.statvfs(self.docker_root)
+            free = float(st.f_bavail) / st.f_blocks if st.f_blocks else 1.0
+            if free < AUTOSCALE_MIN_FREE_DISK:
+                reasons.append('disk %d%% free' % (100 * free))
+
+        return reasons
+
+    def host_idle(self):
+        try:
+            return os.getloadavg()[0] / self.cores < AUTOSCALE_LOAD_LOW
+        except OSError:
+            return True
+
+    def set_limit(self, limit, reason):
+        limit = max(1, min(self.max_workers, limit))
+        if limit != self.limit:
+            logger.info('autoscaling workers: %d -> %d (%s)',
+                        self.limit, limit, reason)
+
+        self.grew = limit > self.limit
+        self.limit = limit
+
+    def update(self, plans, running, waiting):
+        now = time.time()
+        elapsed = now - self.last_update
+        if elapsed < AUTOSCALE_INTERVAL:
+            return
+
+        progress = sum(p.status.current for p in plans)
+        failures = distress_failures(plans) - self.seen_failures
+        self.seen_failures.update(failures)
+
+        rate = None
+        if self.last_progress is not None:
+            rate = (progress - self.last_progress) / elapsed
+
+        grew = self.grew
+        self.grew = False
+        self.last_update = now
+        self.last_progress = progress
+
+        if failures:
+            self.set_limit(self.limit // 2, 'plans failing')
+            self.last_rate = rate
+            return
+
+        reasons = self.host_pressure()
+        if reasons:
+            self.set_limit(self.limit - 1, ', '.join(reasons))
+        elif grew and rate is not None and self.last_rate and \
+                rate < self.last_rate * (1 - AUTOSCALE_THROUGHPUT_DROP):
+            self.set_limit(self.limit - 1, 'throughput dropped')
+        elif len(running) >= self.limit and waiting and self.host_idle():
+            self.set_limit(self.limit + 1, 'host has headroom')
+
+        self.last_rate = rate
+
+
+class ResourceBudget(object):
+    """Tracks cpu and memory reserved by running plans against a host budget
+
+    Plans without resource hints don't count against the budget. A plan that
+    doesn't fit is skipped for now, letting smaller ready plans fill the
+    remaining capacity (first-fit). A plan larger than the whole budget may
+    still run, but only when nothing else holds a reservation.
+    """
+
+    def __init__(self, cpu=None, memory=None):
+        if cpu is None:
+            cpu = cpu_count()
+
+        if memory is None:
+            meminfo = read_meminfo()
+            memory = meminfo[1] * 1024 if meminfo else None
+
+        self.cpu = cpu
+        self.memory = memory
+        self.reserved = {}
+
+        logger.debug('resource budget: cpu=%s memory=%s', cpu, memory)
+
+    @property
+    def used(self):
+        cpu = sum(r.cpu for r in self.reserved.values())
+        memory = sum(r.memory for r in self.reserved.values())
+        return cpu, memory
+
+    def fits(self, plan):
+        if plan.resources is None or not self.reserved:
+            return True
+
+        cpu, memory = self.used
+        if cpu + plan.resources.cpu > self.cpu:
+            return False
+
+        if self.memory is not None and \
+                memory + plan.resources.memory > self.memory:
+            return False
+
+        return True
+
+    def reserve(self, plan):
+        if plan.resources is not None:
+            self.reserved[plan.id] = plan.resources
+
+    def release(self, plan):
+        self.reserved.pop(plan.id, None)
+
+
+class FairQueue(object):
+    """Picks the next ready plan to start, fairly across modules
+
+    Plans of higher priority classes go first. Among equal priorities, the
+    module with the fewest running plans is served next, and ties go to the
+    module that was served least recently; a module with many variants thus
+    takes turns with the others instead of holding every worker. Remaining
+    ties keep the plans' original (tree level) order.
+    """
+
+    def __init__(self):
+        self.running = {}
+        self.served = {}
+        self.sequence = 0
+
+    def key(self, plan, index):
+        return (-plan.priority, self.running.get(plan.module, 0),
+                self.served.get(plan.module, -1), index)
+
+    def next(self, plans):
+        """Returns the index of the plan in `plans` to start next"""
+        return min(range(len(plans)), key=lambda i: self.key(plans[i], i))
+
+    def started(self, plan):
+        self.running[plan.module] = self.running.get(plan.module, 0) + 1
+        self.served[plan.module] = self.sequence
+        self.sequence += 1
+
+    def finished(self, plan):
+        self.running[plan.module] -= 1
@@ -13,27 +13,48 @@
 # under the License.
 
 import datetime
-import io
 import logging
 import os
 import re
+import subprocess
+import tempfile
 
 from collections import deque
+from concurrent.futures import TimeoutError
 
 import docker
 
 from docker.errors import BuildError
 
+from dbuild.build_log import build_log_path, open_build_log
 from dbuild.docker_utils import (ARG_BUILD_ARG, ARG_VARIANT,
                                  ARG_REBUILD, ARG_TAG, ARG_APPEND,
                                  load_config, resolve_variants,
                                  get_variant, verify_docker_version,
-                                 load_dockerfile, get_rebuild_targets)
+                                 load_dockerfile, get_rebuild_targets,
+                                 get_base_images, MIN_BUILDKIT_DOCKER_VERSION,
+                                 abort_streams_on_cancel, iter_stream,
+                                 get_context_hash, input_fingerprint,
+                                 image_labels)
+from dbuild.rebuild_tokens import resolve_rebuild_token
+from dbuild.scheduler import Resources
 from dbuild.verb import verb, VerbException, Plan
 
 REGEX_DOCKER_BUILD_STEP = re.compile(r'^Step (\d+)/(\d+) : ([A-Z]+)')
 REGEX_DOCKER_BUILD_SUCCESS = re.compile(r'^(Successfully built |sha256:)([0-9a-f]+)')
 
+# buildkit --progress=plain output, e.g. '#5 [stage-1 2/4] RUN make'
+REGEX_BUILDKIT_VERTEX = re.compile(r'^#(\d+) \[([^\]]+)\] (.*)$')
+REGEX_BUILDKIT_STEP = re.compile(r'^(?:(\S+) )?(\d+)/(\d+)$')
+REGEX_BUILDKIT_STATUS = re.compile(r'^#(\d+) (DONE|CACHED|ERROR)\b')
+
+# how often to check for cancellation while waiting on background pulls
+CANCEL_POLL_INTERVAL = 0.25
+
+# instructions that produce (potentially expensive) layers; a shared prefix
+# needs at least one of these before it's worth building variants in order
+LAYER_INSTRUCTIONS = ('RUN', 'COPY', 'ADD')
+
 
 logger = logging.getLogger(__name__)
 
@@ -76,32 +97,146 @@ def get_proxy_config():
     return proxies
 
 
-def execute_plan(plan):
-    plan.status.blocking = False
+def effective_instructions(dockerfile, build_args):
+    """Lists Dockerfile instructions with build arg values substituted
 
-    module_path = os.path.join(plan.arguments['base_path'], plan.module)
-    images = [tag.full_interp for tag in plan.arguments['tags']]
+    Two variants produce identical layers for as long as these instructions
+    are identical, since an ARG is where a differing build arg first takes
+    effect.
+    """
+    instructions = []
+    for ins in dockerfile.structure:
+        value = ins['value']
+        if ins['instruction'] == 'ARG':
+            name = value.split('=', 1)[0].strip()
+            if name in build_args:
+                value = '%s=%s' % (name, build_args[name])
 
-    first_image = images.pop(0)
-    plan.status.description = 'build %s' % first_image
+        instructions.append((ins['instruction'], value))
 
-    client = docker.from_env(version='auto')
+    return instructions
 
-    logger.debug('building: path=%s, tag=%s, args=%r',
-                 module_path, first_image, plan.arguments['build_args'])
 
-    build_log = plan.arguments['build_log']
-    if plan.arguments['log_file']:
-        log_file = io.open(plan.arguments['log_file'], 'w', encoding='UTF-8')
-    else:
-        log_file = None
+def shared_layer_count(a, b):
+    count = 0
+    for ins_a, ins_b in zip(a, b):
+        if ins_a != ins_b:
+            break
 
-    # build phase
+        if ins_a[0] in LAYER_INSTRUCTIONS:
+            count += 1
+
+    return count
+
+
+def order_by_shared_prefix(plans, instructions):
+    """Makes variants that share early layers wait for a representative
+
+    The first plan of each group of variants with a common instruction
+    prefix is built first; the rest of the group waits for it so that they
+    start from a warm cache instead of racing to build the same layers.
+
+    :param plans: build plans for a single module
+    :param instructions: effective instructions for each plan, by plan id
+    """
+    representatives = []
+    for plan in plans:
+        for rep in representatives:
+            shared = shared_layer_count(instructions[rep.id],
+                                        instructions[plan.id])
+            if shared > 0:
+                logger.debug('plan %d shares %d layers with plan %d, will '
+                             'wait for it', plan.id, shared, rep.id)
+                plan.waits_for.append(rep)
+                break
+        else:
+            representatives.append(plan)
+
+
+def collapse_identical_plans(plans):
+    """Merges plans that would build the same image into one
+
+    Plans with the same input fingerprint (e.g. a variant and an alias of
+    it, or variants with identical args) differ only in their tags. The
+    first plan builds the image and applies every tag; intents are merged so
+    later verbs still act on all images.
+
+    :param plans: build plans for a single module
+    :return: the remaining plans
+    """
+    collapsed = []
+    by_fingerprint = {}
+    for plan in plans:
+        first = by_fingerprint.get(plan.fingerprint)
+        if first is None:
+            by_fingerprint[plan.fingerprint] = plan
+            collapsed.append(plan)
+            continue
+
+        logger.debug('variant %s of %s has the same inputs as %s, building '
+                     'it once', plan.variant, plan.module, first.variant)
+
+        known = set(tag.full for tag in first.arguments['tags'])
+        for tag in plan.arguments['tags']:
+            if tag.full not in known:
+                first.arguments['tags'].append(tag)
+                first.tags.append(tag.full)
+                known.add(tag.full)
+
+        first.intents['images'] = \
+            first.intents['images'] | plan.intents['images']
+
+        cache_images = set(image for image, _ in first.arguments['cache_from'])
+        first.arguments['cache_from'].extend(
+            (image, future) for image, future in plan.arguments['cache_from']
+            if image not in cache_images)
+
+    return collapsed
+
+
+def write_build_log(plan, line, log_file):
+    plan.status.output.append(line)
+
+    if plan.arguments['build_log']:
+        logger.info('build %s: %s', plan.module, line)
+
+    if log_file:
+        log_file.write(line)
+        if not line.endswith('\n'):
+            log_file.write(u'\n')
+
+        # flushing compressed logs per line would ruin the compression
+        if not plan.arguments['log_file'].endswith('.gz'):
+            log_file.flush()
+
+
+def wait_for_pull(plan, future):
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_INTERVAL)
+        except TimeoutError:
+            plan.status.cancel_token.check()
+
+
+def plan_labels(plan):
+    return image_labels(plan.module, plan.variant, plan.arguments['run_id'],
+                        plan.fingerprint)
+
+
+def build_legacy(plan, client, module_path, image, cache_from, log_file):
+    token = plan.status.cancel_token
+
+    # forcerm: also clean up intermediate containers when the build fails or
+    # is cancelled
+    abort_streams_on_cancel(client, token)
     stream = client.api.build(buildargs=plan.arguments['build_args'],
-                              path=module_path, rm=True, tag=first_image,
-                              decode=True)
+                              path=module_path, rm=True, forcerm=True,
+                              tag=image, cache_from=cache_from or None,
+                              target=plan.arguments['target'],
+                              labels=plan_labels(plan), decode=True)
+
     last_events = deque(maxlen=2)
-    for event in stream:
+    for event in iter_stream(stream, token):
         last_events.append(event)
 
         if 'error' in event:
@@ -112,27 +247,18 @@ def execute_plan(plan):
             m = REGEX_DOCKER_BUILD_STEP.match(event['stream'])
 
             for line in event['stream'].strip().splitlines():
-                if build_log:
-                    logger.info('build %s: %s', plan.module, line)
-
-                if log_file:
-                    log_file.write(line)
-                    if not line.endswith('\n'):
-                        log_file.write(u'\n')
-                    log_file.flush()
+                write_build_log(plan, line, log_file)
+
             if m:
                 step = m.group(1)
                 plan.status.current = int(step)
 
                 start, end = m.span()
                 cmd_snippet = event['stream'][end:20].strip()
-                plan.status.description = 'build %s %s %s' % (first_image,
+                plan.status.description = 'build %s %s %s' % (image,
                                                               m.group(3),
                                                               cmd_snippet)
 
-    if log_file:
-        log_file.close()
-
     # grabbed from docker-py/docker/models/images.py:ImageCollection.build
     if not last_events[-1]:
         raise BuildError('Unknown')
@@ -158,23 +284,210 @@ def execute_plan(plan):
             raise BuildError('Build did not succeed. Last '
                              'line: %s' % last_events[-1])
 
+    return image_id
+
+
+def parse_buildkit_progress(lines, status, image):
+    """Follows the output of `docker build --progress=plain`
+
+    Vertices that are Dockerfile steps (`#5 [stage 2/3] RUN ...`) count
+    toward `status.current` once they are DONE or CACHED, and the last step
+    started is shown in the description. Other vertices, e.g. loading the
+    build context or exporting the image, are ignored.
+
+    :param lines: decoded output lines
+    :param status: the build plan's status, with `total` set to the
+                   Dockerfile's step count
+    :return: the last few error lines
+    """
+    # vertex id -> step label, for vertices that are Dockerfile steps
+    steps = {}
+    stage_totals = {}
+    done = set()
+    errors = deque(maxlen=5)
+    for line in lines:
+        m = REGEX_BUILDKIT_VERTEX.match(line)
+        if m:
+            vertex, label, command = m.groups()
+            sm = REGEX_BUILDKIT_STEP.match(label)
+            if sm:
+                stage, _, total = sm.groups()
+                steps[vertex] = label
+                stage_totals[stage] = int(total)
+                status.description = 'build %s %s' % (image, command[:20])
+            continue
+
+        m = REGEX_BUILDKIT_STATUS.match(line)
+        if m:
+            vertex, state = m.groups()
+            if state == 'ERROR':
+                errors.append(line)
+                status.description = 'error'
+            elif vertex in steps:
+                done.add(vertex)
+
+            # buildkit only lists the steps it actually needs to run, scale
+            # them to the dockerfile's step count used by the progress bar
+            known = sum(stage_totals.values())
+            if known:
+                status.current = min(status.total - 1,
+                                     status.total * len(done) // known)
+            continue
+
+        if line.startswith('error:') or line.startswith('ERROR:'):
+            errors.append(line)
+
+    return errors
+
+
+def read_build_output(plan, stream, log_file):
+    for line in iter(stream.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip()
+        write_build_log(plan, line, log_file)
+        yield line
+
+
+def build_buildkit(plan, module_path, images, cache_from, log_file):
+    iid_fd, iid_path = tempfile.mkstemp(prefix='dbuild-iid-')
+    os.close(iid_fd)
+    try:
+        return run_buildkit(plan, module_path, images, cache_from, log_file,
+                            iid_path)
+    finally:
+        os.remove(iid_path)
+
+
+def run_buildkit(plan, module_path, images, cache_from, log_file, iid_path):
+    args = ['build', '--progress=plain', '--iidfile', iid_path]
+    for image in images:
+        args.extend(['-t', image])
+
+    # embed cache metadata so this image can be used with --cache-from later
+    build_args = plan.arguments['build_args'].copy()
+    build_args['BUILDKIT_INLINE_CACHE'] = '1'
+    for k, v in sorted(build_args.items()):
+        args.extend(['--build-arg', '%s=%s' % (k, v)])
+
+    for image in cache_from:
+        args.extend(['--cache-from', image])
+
+    for k, v in sorted(plan_labels(plan).items()):
+        args.extend(['--label', '%s=%s' % (k, v)])
+
+    if plan.arguments['target']:
+        args.extend(['--target', plan.arguments['target']])
+
+    args.append(module_path)
+
+    env = os.environ.copy()
+    env['DOCKER_BUILDKIT'] = '1'
+
+    logger.debug('Running buildkit: %r', args)
+    p = subprocess.Popen(['docker'] + args, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # the cli cancels the build session (and buildkit the build) on SIGTERM
+    token = plan.status.cancel_token
+    token.on_cancel(p.terminate)
+
+    try:
+        errors = parse_buildkit_progress(
+            read_build_output(plan, p.stdout, log_file), plan.status,
+            images[0])
+    except Exception:
+        p.kill()
+        raise
+    finally:
+        p.wait()
+
+    with open(iid_path, 'r') as f:
+        image_id = f.read().strip()
+
+    token.check()
+
+    if p.returncode != 0 or not image_id:
+        logger.error('buildkit build failed: %s', '; '.join(errors))
+        raise BuildError('Build failed with exit code %d, errors: %r' % (
+            p.returncode, list(errors)))
+
+    return image_id
+
+
+def execute_plan(plan):
+    plan.status.blocking = False
+
+    module_path = os.path.join(plan.arguments['base_path'], plan.module)
+    images = [tag.full_interp for tag in plan.arguments['tags']]
+
+    first_image = images[0]
+    plan.status.description = 'build %s' % first_image
+
+    client = docker.from_env(version='auto')
+
+    logger.debug('building: path=%s, tag=%s, args=%r',
+                 module_path, first_image, plan.arguments['build_args'])
+
+    if plan.arguments['log_file']:
+        log_file = open_build_log(plan.arguments['log_file'])
+    else:
+        log_file = None
+
+    # if base images are being prefetched, wait for them rather than letting
+    # the daemon pull them a second time
+    puller = plan.arguments['puller']
+    for image in plan.arguments['base_images']:
+        future = puller.get(image)
+        if future:
+            plan.status.description = 'pulling %s' % image
+            wait_for_pull(plan, future)
+
+    # wait for any cache warming pulls, only images that actually exist
+    # locally can be used as cache sources
+    cache_from = []
+    for image, future in plan.arguments['cache_from']:
+        plan.status.description = 'warming cache %s' % image
+        if wait_for_pull(plan, future):
+            cache_from.append(image)
+
+    if cache_from:
+        logger.debug('using cache images: %r', cache_from)
+        plan.status.description = 'build %s' % first_image
+
+    # build phase
+    try:
+        if plan.arguments['builder'] == 'buildkit':
+            # buildkit applies all tags itself
+            build_buildkit(plan, module_path, images, cache_from, log_file)
+            plan.artifacts.extend(images)
+            plan.status.current = plan.status.total
+            return
+
+        image_id = build_legacy(plan, client, module_path, first_image,
+                                cache_from, log_file)
+    finally:
+        if log_file:
+            log_file.close()
+
     image = client.images.get(image_id)
 
     plan.artifacts.append(first_image)
 
     # tagging phase
     plan.status.current = plan.status.total
-    for extra_tag in images:
+    for extra_tag in images[1:]:
         repo, tag = extra_tag.rsplit(':', 1)
         image.tag(repo, tag=tag)
 
         plan.artifacts.append(extra_tag)
 
 
-@verb('build', priority=1, args=ARG_TYPES,
+@verb('build', priority=2, args=ARG_TYPES,
       description='builds specified modules')
 def build(global_args, verb_args, module, intents):
-    verify_docker_version()
+    if global_args.builder == 'buildkit':
+        verify_docker_version(MIN_BUILDKIT_DOCKER_VERSION)
+    else:
+        verify_docker_version()
 
     base_config = load_config(global_args.base_path, module)
     dockerfile = load_dockerfile(global_args.base_path, module)
@@ -213,14 +526,28 @@ def build(global_args, verb_args, module, intents):
                              target, ', '.join(valid_targets))
                 raise VerbException()
 
+    # targets declared in build.yml get a token derived from their content,
+    # any others a timestamp that always invalidates the cache
+    rebuild_sources = dict((k.lower(), v) for k, v in
+                           base_config.get('rebuild', {}).items())
     rebuild_str = datetime.datetime.now().isoformat()
+    timestamp_args = set()
     for target in rebuild_targets:
-        build_args['REBUILD_%s' % target.upper()] = rebuild_str
+        arg = 'REBUILD_%s' % target.upper()
+        if target.lower() in rebuild_sources:
+            build_args[arg] = resolve_rebuild_token(
+                global_args.base_path, module, target.lower(),
+                rebuild_sources[target.lower()],
+                run_commands=not global_args.estimate)
+        else:
+            build_args[arg] = rebuild_str
+            timestamp_args.add(arg)
 
     variants = resolve_variants(verb_args, base_config)
     logger.debug('Resolved variants: %r', variants)
 
     plans = []
+    instructions = {}
     for variant_args in variants:
         variant = get_variant(base_config, variant_args['variant_tag'])
 
@@ -231,6 +558,12 @@ def build(global_args, verb_args, module, intents):
         variant_build_args.update(build_args)
         logger.debug('variant_build_args: %r', variant_build_args)
 
+        # optional stage to stop at in multi-stage dockerfiles
+        if variant and 'target' in variant:
+            target = variant['target']
+        else:
+            target = base_config.get('target', None)
+
         # we'll generate a set of images for tasks later in the pipeline, e.g.
         # push - not used for build
         images = set()
@@ -244,21 +577,54 @@ def build(global_args, verb_args, module, intents):
             variant_intents['images'] = images
 
         if global_args.build_log_dir:
-            datestamp = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-            file_name = '%s-%s-%s.log' % (datestamp, module,
-                                          variant_args['variant_tag'])
-            log_file = os.path.join(global_args.build_log_dir, file_name)
+            log_file = build_log_path(global_args.build_log_dir, module,
+                                      variant_args['variant_tag'],
+                                      not global_args.no_compress_logs)
         else:
             log_file = None
 
+        # pull the previously published image for this variant so its layers
+        # can be reused; pulls start now and overlap with plan generation
+        cache_from = []
+        if global_args.warm_cache:
+            cache_image = variant_args['tags'][0].full_interp
+            cache_from.append((cache_image,
+                               global_args.puller.pull(cache_image)))
+
         plan = Plan('build', module, execute_plan, variant_intents, {
             'base_path': global_args.base_path,
-            'tags': variant_args['tags'],
+            'tags': list(variant_args['tags']),
             'build_args': variant_build_args,
+            'target': target,
+            'builder': global_args.builder,
             'build_log': global_args.build_log,
-            'log_file': log_file
+            'log_file': log_file,
+            'cache_from': cache_from,
+            'puller': global_args.puller,
+            'base_images': get_base_images(dockerfile),
+            'run_id': global_args.run_id
         })
+        plan.variant = variant_args['variant_tag']
+        plan.tags = [tag.full for tag in variant_args['tags']]
+
+        # timestamp rebuild args are left out so a resumed run can still
+        # recognize this build, only the requested targets matter
+        plan.fingerprint = input_fingerprint(
+            context=get_context_hash(global_args.base_path, module),
+            build_args=dict((k, v) for k, v in variant_build_args.items()
+                            if k not in timestamp_args),
+            rebuild_targets=sorted(t.lower() for t in rebuild_targets),
+            target=target)
+
         plan.status.total = len(dockerfile.structure)
+        plan.resources = Resources.from_config(variant) or \
+            Resources.from_config(base_config)
         plans.append(plan)
 
+        instructions[plan.id] = effective_instructions(dockerfile,
+                                                       variant_build_args)
+
+    plans = collapse_identical_plans(plans)
+    order_by_shared_prefix(plans, instructions)
+
     return plans
@@ -15,18 +15,22 @@
 import logging
 
 from dbuild.docker_utils import load_config
-from dbuild.verb import verb
+from dbuild.verb import verb, Plan
 
 logger = logging.getLogger(__name__)
 
 
-@verb('info', description='show info for a module', priority=10)
+def report(global_args, plans, file):
+    for plan in plans:
+        print >> file, 'info:', plan.module
+
+
+@verb('info', description='show info for a module', priority=10,
+      report=report)
 def info(global_args, verb_args, module, intents):
     base_config = load_config(global_args.base_path, module)
 
     # TODO this should let users inspect the current pipeline
     # i.e. describe intents
 
-    print 'info:', module
-
-
+    return [Plan('info', module, None, intents, {})]
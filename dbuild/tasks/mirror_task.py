@@ -0,0 +1,251 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from threading import Lock
+
+from dbuild.docker_utils import (ARG_VARIANT, ARG_APPEND, ARG_TAG,
+                                 load_config, resolve_variants)
+from dbuild.registry import (DEFAULT_MIRROR_WORKERS, MANIFEST_LIST_TYPES,
+                             RegistryClient, registry_host, registry_path)
+from dbuild.tag import interp_tag, parse_docker_tag
+from dbuild.tasks.build_task import CANCEL_POLL_INTERVAL
+from dbuild.verb import verb, Plan, VerbException
+
+logger = logging.getLogger(__name__)
+
+ARG_TYPES = [ARG_VARIANT, ARG_APPEND, ARG_TAG]
+
+_mirror = None
+_mirror_lock = Lock()
+
+
+def parse_mirror_target(target):
+    """Splits `host[:port][/namespace]` into (registry, namespace)"""
+    if '/' in target:
+        registry, namespace = target.split('/', 1)
+        return registry, namespace or None
+
+    return target, None
+
+
+def chain_future(source, target):
+    """Copies the outcome of one future to another"""
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class Mirror(object):
+    """Copies blobs between registries, each at most once per run
+
+    Transfers run concurrently in a thread pool. A blob needed in several
+    repositories of the same registry is uploaded once, and then mounted
+    into the other repositories.
+    """
+
+    def __init__(self, workers=DEFAULT_MIRROR_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+        self.clients = {}
+
+        # (host, digest) -> (future, repository) of the first copy
+        self.blobs = {}
+
+        # (host, repository, digest) -> future
+        self.copies = {}
+
+    def client(self, registry):
+        host = registry_host(registry)
+        with self.lock:
+            if host not in self.clients:
+                self.clients[host] = RegistryClient(host)
+
+            return self.clients[host]
+
+    def copy_blob(self, src, src_repo, dst, dst_repo, descriptor,
+                  callback=None):
+        """Starts copying a blob, unless it is already being copied
+
+        :return: (future, started), the future's result is 'exists',
+                 'mounted' or 'uploaded', and started is False if the copy
+                 was started by an earlier call
+        """
+        digest = descriptor['digest']
+        with self.lock:
+            key = (dst.host, dst_repo, digest)
+            if key in self.copies:
+                return self.copies[key], False
+
+            first = self.blobs.get((dst.host, digest))
+            if first is None:
+                future = self.executor.submit(
+                    self.transfer, src, src_repo, dst, dst_repo, descriptor,
+                    None, callback)
+                self.blobs[(dst.host, digest)] = (future, dst_repo)
+            else:
+                # mount from the first repository once it's there; chained
+                # rather than waited on, so no worker blocks on another
+                future = Future()
+                first_future, first_repo = first
+
+                def submit(_):
+                    inner = self.executor.submit(
+                        self.transfer, src, src_repo, dst, dst_repo,
+                        descriptor, first_repo, callback)
+                    inner.add_done_callback(
+                        lambda f: chain_future(f, future))
+
+                first_future.add_done_callback(submit)
+
+            self.copies[key] = future
+            return future, True
+
+    def transfer(self, src, src_repo, dst, dst_repo, descriptor,
+                 from_repo=None, callback=None):
+        digest = descriptor['digest']
+        if dst.has_blob(dst_repo, digest):
+            logger.debug('blob %s already in %s/%s', digest, dst.host,
+                         dst_repo)
+            return 'exists'
+
+        mounted = dst.upload_blob(
+            dst_repo, digest, lambda: src.open_blob(src_repo, digest),
+            descriptor['size'], from_repository=from_repo,
+            callback=callback)
+        if mounted:
+            logger.debug('mounted blob %s from %s', digest, from_repo)
+            return 'mounted'
+
+        logger.debug('uploaded blob %s to %s/%s', digest, dst.host, dst_repo)
+        return 'uploaded'
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def get_mirror(workers):
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = Mirror(workers)
+
+        return _mirror
+
+
+def wait_for(plan, future):
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_INTERVAL)
+        except TimeoutError:
+            plan.status.cancel_token.check()
+
+
+def copy_manifest(plan, mirror, src, src_repo, dst, dst_repo, reference,
+                  dst_reference):
+    body, media_type, digest = src.get_manifest(src_repo, reference)
+    manifest = json.loads(body)
+
+    if media_type in MANIFEST_LIST_TYPES:
+        # copy each platform's image by digest, then the list itself
+        for child in manifest['manifests']:
+            copy_manifest(plan, mirror, src, src_repo, dst, dst_repo,
+                          child['digest'], child['digest'])
+    else:
+        descriptors = [manifest['config']] + manifest['layers']
+
+        def progress(size):
+            plan.status.current += size
+
+        futures = []
+        for descriptor in descriptors:
+            plan.status.total += descriptor['size']
+            future, started = mirror.copy_blob(
+                src, src_repo, dst, dst_repo, descriptor, progress)
+            futures.append((descriptor, future, started))
+
+        for descriptor, future, started in futures:
+            result = wait_for(plan, future)
+            if result != 'uploaded' or not started:
+                # nothing was streamed through this plan's callback
+                plan.status.current += descriptor['size']
+
+    dst.put_manifest(dst_repo, dst_reference, body, media_type)
+    return digest
+
+
+def execute_plan(plan):
+    mirror = get_mirror(plan.arguments['workers'])
+
+    # progress is counted in bytes as blob sizes become known
+    plan.status.total = 0
+    plan.status.current = 0
+
+    for src_tag, dst_tag in plan.arguments['tags']:
+        plan.status.description = 'mirror %s' % src_tag.full_interp
+
+        src = mirror.client(src_tag.registry)
+        dst = mirror.client(dst_tag.registry)
+        tag = interp_tag(src_tag.tag or 'latest')
+        copy_manifest(plan, mirror, src, registry_path(src_tag), dst,
+                      registry_path(dst_tag), tag, tag)
+
+        plan.artifacts.append(dst_tag.full_interp)
+
+    plan.status.total = max(plan.status.total, 1)
+    plan.status.current = plan.status.total
+
+
+# reads from the source registry, so after push has updated it
+@verb('mirror', priority=-1, args=ARG_TYPES,
+      description='copies images of specified modules to another registry')
+def mirror(global_args, verb_args, module, intents):
+    if not global_args.mirror_to:
+        raise VerbException('mirror requires a destination, use --mirror-to')
+
+    registry, namespace = parse_mirror_target(global_args.mirror_to)
+
+    if 'images' in intents:
+        logger.debug('Mirroring collected images from build intents')
+        variants = [(None, [parse_docker_tag(image)
+                            for image in sorted(intents['images'])])]
+    else:
+        logger.debug('Mirroring collected images from user args')
+        base_config = load_config(global_args.base_path, module)
+        variants = [(v['variant_tag'], v['tags'])
+                    for v in resolve_variants(verb_args, base_config)]
+        logger.debug('Resolved variants: %r', variants)
+
+    plans = []
+    for variant, variant_tags in variants:
+        tags = []
+        for tag in variant_tags:
+            dst_tag = tag.mutate(registry=registry)
+            if namespace:
+                dst_tag = dst_tag.mutate(namespace=namespace)
+            tags.append((tag, dst_tag))
+
+        plan = Plan('mirror', module, execute_plan, intents, {
+            'tags': tags,
+            'workers': global_args.mirror_workers
+        })
+        plan.variant = variant
+        plan.tags = [dst.full_interp for _, dst in tags]
+        plans.append(plan)
+
+    return plans
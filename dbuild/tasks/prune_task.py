@@ -0,0 +1,104 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+import docker
+
+from docker.errors import APIError, ImageNotFound
+
+from dbuild.docker_utils import LABEL_MODULE, LABEL_RUN, LABEL_VARIANT
+from dbuild.verb import verb, Plan
+
+logger = logging.getLogger(__name__)
+
+
+def stale_images(images, keep):
+    """Selects images from all but the `keep` latest runs of each variant
+
+    :param images: docker-py images carrying dbuild's labels
+    """
+    variants = {}
+    for image in images:
+        variant = image.labels.get(LABEL_VARIANT)
+        variants.setdefault(variant, []).append(image)
+
+    stale = []
+    for variant, variant_images in sorted(variants.items()):
+        runs = sorted(set(i.labels.get(LABEL_RUN) for i in variant_images),
+                      reverse=True)
+        kept = set(runs[:keep])
+        stale.extend(i for i in variant_images
+                     if i.labels.get(LABEL_RUN) not in kept)
+
+    return stale
+
+
+def remove_image(client, image):
+    """Removes an image and its intermediate parents, if nothing uses them
+
+    :return: True if the image was removed
+    """
+    try:
+        # an image still tagged is removed along with its last tag
+        for tag in image.tags:
+            client.images.remove(tag)
+
+        if not image.tags:
+            client.images.remove(image.id)
+    except ImageNotFound:
+        pass
+    except APIError as ex:
+        # e.g. used by a container, or the base of a newer image
+        logger.debug('not removing %s: %s', image.short_id, ex)
+        return False
+
+    return True
+
+
+def execute_plan(plan):
+    client = docker.from_env(version='auto')
+
+    # only ever list images carrying our labels
+    labels = ['%s=%s' % (LABEL_MODULE, plan.module)]
+    if plan.variant is not None:
+        labels.append('%s=%s' % (LABEL_VARIANT, plan.variant))
+
+    plan.status.description = 'prune %s' % plan.module
+    images = client.images.list(filters={'label': labels})
+    stale = stale_images(images, plan.arguments['keep'])
+
+    plan.status.total = max(1, len(stale))
+    removed = 0
+    for image in stale:
+        plan.status.cancel_token.check()
+        if remove_image(client, image):
+            removed += 1
+
+        plan.status.current += 1
+
+    logger.debug('%s: removed %d of %d images from old runs', plan.module,
+                 removed, len(stale))
+    plan.artifacts.append('%d images removed, %d kept' % (
+        removed, len(images) - removed))
+
+
+@verb('prune', priority=-1,
+      description='removes images of specified modules from old runs')
+def prune(global_args, verb_args, module, intents):
+    # after other verbs, the variant is inherited from the parent plan, so
+    # only images of the variant just built are pruned
+    return [Plan('prune', module, execute_plan, intents, {
+        'keep': global_args.prune_keep
+    })]
@@ -14,29 +14,68 @@
 
 import logging
 
+from collections import OrderedDict
+
 import docker
 
 from dbuild.docker_utils import (ARG_VARIANT, ARG_APPEND, ARG_TAG,
-                                 load_config, resolve_variants)
-from dbuild.verb import verb, Plan
+                                 load_config, resolve_variants,
+                                 abort_streams_on_cancel, iter_stream)
+from dbuild.registry import RegistryClient, registry_host, registry_path
+from dbuild.tag import parse_docker_tag
+from dbuild.verb import verb, Plan, RetryPolicy
 
 logger = logging.getLogger(__name__)
 
 
 ARG_TYPES = [ARG_VARIANT, ARG_APPEND, ARG_TAG]
 
+# registry errors that are worth another try, e.g. 'received unexpected HTTP
+# status: 502 Bad Gateway' or 'net/http: TLS handshake timeout'
+RETRY_PUSH = RetryPolicy(
+    attempts=4, backoff=5.0,
+    pattern=r'(?i)(\b5\d\d\b|\b429\b|timeout|timed out|connection '
+            r'(reset|refused)|broken pipe|\bEOF\b|temporar|unavailable|'
+            r'too many requests)')
 
-def execute_plan(plan):
-    client = docker.from_env(version='auto')
 
-    image = plan.arguments['image']
-    plan.status.description = 'push %s' % image
+class PushProgress(object):
+    """Counts the layers of all pushes in a plan as one step each
+
+    Steps rather than bytes keep push progress comparable to that of other
+    verbs in the module's bar. Layers are only known once the daemon starts
+    uploading them, so the plan's total grows during the push.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.layers = {}
+
+    def update(self, event):
+        layer = event.get('id')
+        if not layer:
+            return
+
+        status = event.get('status') or ''
+        done = status in ('Pushed', 'Layer already exists') or \
+            status.startswith('Mounted from')
+        self.layers[layer] = self.layers.get(layer, False) or done
 
+        # +1: the last manifest is only done when the plan is
+        self.plan.status.total = 1 + len(self.layers)
+        self.plan.status.current = sum(self.layers.values())
+
+
+def push_image(plan, client, image, progress):
     repo, tag = image.rsplit(':', 1)
 
+    token = plan.status.cancel_token
+    stream = client.images.push(repo, tag=tag, stream=True, decode=True)
+
     last_event = None
-    for event in client.images.push(repo, tag=tag, stream=True, decode=True):
+    for event in iter_stream(stream, token):
         last_event = event
+        progress.update(event)
 
         if 'status' in event:
             logger.debug('push %s: %s', plan.module, event['status'])
@@ -48,8 +87,73 @@ def execute_plan(plan):
     if 'error' in last_event:
         logger.error('Push failed with error: %s', last_event['error'])
         plan.status.failed = True
-    else:
-        plan.artifacts.append(image)
+        plan.status.error = last_event['error']
+        return False
+
+    return True
+
+
+# noinspection PyBroadException
+def copy_tag(registry, source, image):
+    """Tags an already pushed image in its registry by copying its manifest
+
+    :return: False if the registry API couldn't be used
+    """
+    src_tag = parse_docker_tag(source)
+    dst_tag = parse_docker_tag(image)
+    repository = registry_path(dst_tag)
+    try:
+        body, media_type, _ = registry.get_manifest(repository, src_tag.tag)
+        registry.put_manifest(repository, dst_tag.tag, body, media_type)
+    except Exception as ex:
+        # e.g. credentials only available to the daemon through a helper
+        logger.debug('could not copy manifest of %s to %s: %s', source,
+                     image, ex)
+        return False
+
+    return True
+
+
+def group_by_image_id(client, images):
+    """Groups tags by the local image they refer to, keeping their order"""
+    groups = OrderedDict()
+    for image in images:
+        groups.setdefault(client.images.get(image).id, []).append(image)
+
+    return groups.values()
+
+
+def execute_plan(plan):
+    client = docker.from_env(version='auto')
+    abort_streams_on_cancel(client, plan.status.cancel_token)
+    progress = PushProgress(plan)
+
+    # all images of a plan share a repository, so one client (and its
+    # cached tokens) serves every tag
+    images = plan.arguments['images']
+    registry = RegistryClient(
+        registry_host(parse_docker_tag(images[0]).registry))
+
+    for tags in group_by_image_id(client, images):
+        # the first push uploads the layers; other tags of the same image
+        # only need its manifest under another name. Tags pushed by an
+        # earlier attempt of this plan are not pushed again
+        if tags[0] not in plan.artifacts:
+            plan.status.description = 'push %s' % tags[0]
+            if not push_image(plan, client, tags[0], progress):
+                return
+            plan.artifacts.append(tags[0])
+
+        for image in tags[1:]:
+            if image in plan.artifacts:
+                continue
+
+            plan.status.cancel_token.check()
+            plan.status.description = 'tag %s' % image
+            if not copy_tag(registry, tags[0], image):
+                if not push_image(plan, client, image, progress):
+                    return
+            plan.artifacts.append(image)
 
 
 def images_from_args(global_args, verb_args, module):
@@ -66,7 +170,8 @@ def images_from_args(global_args, verb_args, module):
     return images
 
 
-@verb('push', args=ARG_TYPES, description='pushes specified modules')
+@verb('push', args=ARG_TYPES, retry=RETRY_PUSH,
+      description='pushes specified modules')
 def push(global_args, verb_args, module, intents):
     if 'images' in intents:
         logger.debug('Pushing collected images from build intents')
@@ -75,10 +180,17 @@ def push(global_args, verb_args, module, intents):
         logger.debug('Pushing collected images from user args')
         images = images_from_args(global_args, verb_args, module)
 
-    plans = []
+    repositories = {}
     for image in images:
-        plans.append(Plan('push', module, execute_plan, intents,
-                          {'image': image}))
+        repositories.setdefault(image.rsplit(':', 1)[0], []).append(image)
+
+    plans = []
+    for repository, repository_images in sorted(repositories.items()):
+        plan = Plan('push', module, execute_plan, intents, {
+            'images': sorted(repository_images)
+        })
+        plan.tags = sorted(repository_images)
+        plans.append(plan)
 
     return plans
 
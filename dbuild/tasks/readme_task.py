@@ -16,6 +16,8 @@ import getpass
 import logging
 import os
 
+from threading import Lock
+
 import requests
 
 from dbuild.docker_utils import ARG_TAG, load_config, resolve_variants
@@ -31,33 +33,37 @@ DOCKER_HUB_PASSWORD = os.environ.get('DOCKER_HUB_PASSWORD', None)
 DOCKER_HUB_TOKEN = os.environ.get('DOCKER_HUB_TOKEN', None)
 
 _auth_token = None
+_auth_token_lock = Lock()
 
 
 def get_auth_token():
     global _auth_token
 
-    if _auth_token:
-        return _auth_token
-
     if DOCKER_HUB_TOKEN:
         return DOCKER_HUB_TOKEN
 
-    username = DOCKER_HUB_USERNAME
-    if not username:
-        username = raw_input('Docker Hub username: ')
+    # plans are generated concurrently, but the user should only be asked
+    # to log in once
+    with _auth_token_lock:
+        if _auth_token:
+            return _auth_token
 
-    password = DOCKER_HUB_PASSWORD
-    if not password:
-        password = getpass.getpass('Docker Hub password: ')
+        username = DOCKER_HUB_USERNAME
+        if not username:
+            username = raw_input('Docker Hub username: ')
 
-    r = requests.post(DOCKER_HUB_API + DOCKER_HUB_ENDPOINT_LOGIN, json={
-        'username': username,
-        'password': password
-    })
-    r.raise_for_status()
+        password = DOCKER_HUB_PASSWORD
+        if not password:
+            password = getpass.getpass('Docker Hub password: ')
 
-    _auth_token = r.json()['token']
-    return _auth_token
+        r = requests.post(DOCKER_HUB_API + DOCKER_HUB_ENDPOINT_LOGIN, json={
+            'username': username,
+            'password': password
+        })
+        r.raise_for_status()
+
+        _auth_token = r.json()['token']
+        return _auth_token
 
 
 def execute_plan(plan):
@@ -115,12 +121,15 @@ def readme(global_args, verb_args, module, intents):
                              'will skip: %r', tag)
                 continue
 
-            plans.append(Plan('readme', module, execute_plan, intents, {
+            plan = Plan('readme', module, execute_plan, intents, {
                 'token': get_auth_token(),
                 'variant_tag': variant['variant_tag'],
                 'tag': tag,
                 'readme_path': readme_path
-            }))
+            })
+            plan.variant = variant['variant_tag']
+            plan.tags = [tag.full]
+            plans.append(plan)
 
     if not plans:
         logger.debug('no READMEs can be updated, skipping...')
@@ -16,22 +16,32 @@ import logging
 
 from dbuild.docker_utils import (ARG_VARIANT, ARG_APPEND, ARG_TAG,
                                  load_config, resolve_variants)
-from dbuild.verb import verb
+from dbuild.verb import verb, Plan
 
 logger = logging.getLogger(__name__)
 
 ARG_TYPES = [ARG_VARIANT, ARG_APPEND, ARG_TAG]
 
 
-@verb('resolve', args=ARG_TYPES,
+def report(global_args, plans, file):
+    # plans are generated concurrently, so tags are only printed here, in
+    # module order
+    for plan in plans:
+        print >> file, 'resolved tags:', plan.module
+        for variant_tag, tags in plan.arguments['variants']:
+            print >> file, '  %s' % variant_tag
+            for tag in tags:
+                print >> file, '    %s' % tag
+        print >> file, ''
+
+
+@verb('resolve', args=ARG_TYPES, report=report,
       description='tests variant resolver against args')
 def resolve(global_args, verb_args, module, intents):
     base_config = load_config(global_args.base_path, module)
     variants = resolve_variants(verb_args, base_config)
 
-    print 'resolved tags:', module
-    for variant in variants:
-        print '  %s' % variant['variant_tag']
-        for tag in variant['tags']:
-            print '    %s' % tag.full
-    print ''
+    return [Plan('resolve', module, None, intents, {
+        'variants': [(v['variant_tag'], [tag.full for tag in v['tags']])
+                     for v in variants]
+    })]
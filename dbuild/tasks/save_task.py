@@ -0,0 +1,404 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import gzip
+import json
+import logging
+import os
+import subprocess
+import tarfile
+
+from threading import Lock
+
+import docker
+
+from dbuild.docker_utils import (ARG_VARIANT, ARG_APPEND, ARG_TAG,
+                                 load_config, resolve_variants)
+from dbuild.tag import parse_docker_tag
+from dbuild.verb import verb, Plan
+
+logger = logging.getLogger(__name__)
+
+ARG_TYPES = [ARG_VARIANT, ARG_APPEND, ARG_TAG]
+
+INDEX_FILE = 'index.json'
+
+# faster than gzip's default of 9 at nearly the same size for image layers
+SAVE_COMPRESSLEVEL = 6
+
+# offset and value of the magic field of a ustar header, i.e. a layer tarball
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b'ustar'
+
+
+class LayerStore(object):
+    """Tracks which archives in a save directory hold each image layer
+
+    An archive may leave out a layer that a completed archive already holds:
+    `docker load` only reads layer data for layers the daemon doesn't have
+    yet, so it works as long as the holder is loaded first. Layers of
+    archives that are still being written, or whose save fails, are never
+    left out, so a failed save can't leave other archives unloadable.
+
+    The index merges the archives of earlier runs that are still on disk,
+    so later runs saving only some modules keep the others loadable.
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.lock = Lock()
+        self.archives = {}
+        self.load_index()
+
+    def load_index(self):
+        path = os.path.join(self.save_dir, INDEX_FILE)
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        for entry in index.get('archives', []):
+            if not os.path.exists(os.path.join(self.save_dir,
+                                               entry['file'])):
+                continue
+
+            self.archives[entry['file']] = {
+                'file': entry['file'],
+                'images': entry['images'],
+                'layers': set(entry.get('layers', [])),
+                'shared': entry.get('shared', {}),
+                'complete': True
+            }
+
+    def begin(self, file_name, images):
+        with self.lock:
+            # the old file stays on disk until the new one replaces it
+            previous = self.archives.get(file_name)
+            if previous and not previous['complete']:
+                previous = previous.get('previous')
+
+            self.archives[file_name] = {
+                'file': file_name,
+                'images': images,
+                'layers': set(),
+                'shared': {},
+                'complete': False,
+                'previous': previous
+            }
+
+    def requires(self, file_name, other, archives=None):
+        """Returns True if `file_name` must be loaded after `other`"""
+        if archives is None:
+            archives = self.archives
+
+        pending = [file_name]
+        seen = set()
+        while pending:
+            name = pending.pop()
+            entry = archives.get(name)
+            if name in seen or entry is None:
+                continue
+
+            seen.add(name)
+            holders = set(entry['shared'].values())
+            if other in holders:
+                return True
+            pending.extend(holders)
+
+        return False
+
+    def find_holder(self, file_name, layer, archives):
+        for name in sorted(archives):
+            entry = archives[name]
+            if name != file_name and layer in entry['layers'] and \
+                    not self.requires(name, file_name, archives):
+                return name
+
+        return None
+
+    def claim(self, file_name, layer):
+        """Returns True if the layer must be written into this archive"""
+        with self.lock:
+            complete = dict((n, a) for n, a in self.archives.items()
+                            if a['complete'])
+            holder = self.find_holder(file_name, layer, complete)
+
+            archive = self.archives[file_name]
+            if holder is None:
+                archive['layers'].add(layer)
+                return True
+
+            archive['shared'][layer] = holder
+            return False
+
+    def complete(self, file_name):
+        with self.lock:
+            archive = self.archives[file_name]
+            archive['complete'] = True
+            archive['previous'] = None
+            self.write_index()
+
+    def fail(self, file_name):
+        """Forgets a failed archive; an older file of it stays in use"""
+        with self.lock:
+            previous = self.archives.pop(file_name).get('previous')
+            if previous:
+                self.archives[file_name] = previous
+
+    def write_index(self):
+        # the archives as they are on disk right now
+        archives = {}
+        for name, archive in self.archives.items():
+            if not archive['complete']:
+                archive = archive.get('previous')
+            if archive:
+                archives[name] = archive
+
+        entries = {}
+        for name, archive in archives.items():
+            shared = {}
+            missing = []
+            for layer, holder in sorted(archive['shared'].items()):
+                # a holder rewritten since may no longer have the layer
+                if holder not in archives or \
+                        layer not in archives[holder]['layers']:
+                    holder = self.find_holder(name, layer, archives)
+                if holder is None:
+                    missing.append(layer)
+                else:
+                    shared[layer] = holder
+
+            entries[name] = {
+                'file': name,
+                'images': archive['images'],
+                'layers': sorted(archive['layers']),
+                'shared': shared,
+                'requires': sorted(set(shared.values()))
+            }
+            if missing:
+                logger.warning('%s: %d layers are in none of the saved '
+                               'archives, save it again', name, len(missing))
+                entries[name]['missing'] = missing
+
+        # dependencies first, otherwise by name
+        ordered = []
+        while entries:
+            ready = sorted(n for n, e in entries.items()
+                           if not set(e['requires']) & set(entries))
+            for name in ready or sorted(entries):
+                ordered.append(entries.pop(name))
+
+        path = os.path.join(self.save_dir, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'archives': ordered}, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def get_layer_store(save_dir):
+    with _stores_lock:
+        return _stores.setdefault(save_dir, LayerStore(save_dir))
+
+
+class ProgressReader(object):
+    """A file-like view of a subprocess pipe that counts bytes read"""
+
+    def __init__(self, plan, stream):
+        self.plan = plan
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        self.plan.status.cancel_token.check()
+
+        data = self.stream.read(size)
+        self.bytes += len(data)
+
+        # the tar stream is a bit larger than the image size
+        status = self.plan.status
+        status.current = min(self.bytes, status.total - 1)
+        return data
+
+
+def is_layer(name):
+    # 'abc.../layer.tar' in docker's own format, content addressed blobs in
+    # the OCI layout written by newer versions
+    return name.endswith('/layer.tar') or name.startswith('blobs/')
+
+
+def copy_archive(plan, store, source, dest):
+    """Copies a `docker save` tar stream, leaving out layers stored before
+
+    :return: the number of layers left out
+    """
+    file_name = plan.arguments['file_name']
+    skipped = 0
+
+    tar_in = tarfile.open(fileobj=source, mode='r|')
+    tar_out = tarfile.open(fileobj=dest, mode='w|')
+    for member in tar_in:
+        data = tar_in.extractfile(member) if member.isfile() else None
+        if data is None:
+            tar_out.addfile(member)
+            continue
+
+        head = data.read(tarfile.BLOCKSIZE)
+        layer = is_layer(member.name) and \
+            head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 5] == TAR_MAGIC
+
+        if layer and not store.claim(file_name, member.name):
+            # the rest of the member is skipped by the streaming reader
+            skipped += 1
+            continue
+
+        tar_out.addfile(member, ChainedReader(head, data))
+
+    tar_out.close()
+    tar_in.close()
+    return skipped
+
+
+class ChainedReader(object):
+    """Reads already consumed bytes before the rest of a file"""
+
+    def __init__(self, head, rest):
+        self.head = head
+        self.rest = rest
+
+    def read(self, size=-1):
+        if self.head:
+            if size < 0 or size >= len(self.head):
+                data, self.head = self.head, b''
+                if size >= 0:
+                    size -= len(data)
+                return data + self.rest.read(size) if size else data
+
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+
+        return self.rest.read(size)
+
+
+def save_archive(plan, store, images, path):
+    logger.debug('saving %r to %s', images, path)
+    p = subprocess.Popen(['docker', 'save'] + images, stdout=subprocess.PIPE)
+
+    token = plan.status.cancel_token
+    token.on_cancel(p.terminate)
+
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            gz = gzip.GzipFile(fileobj=f, mode='wb',
+                               compresslevel=SAVE_COMPRESSLEVEL)
+            skipped = copy_archive(plan, store, ProgressReader(plan, p.stdout),
+                                   gz)
+            gz.close()
+    except Exception:
+        p.kill()
+        p.wait()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        token.check()
+        raise
+
+    if p.wait() != 0:
+        os.remove(tmp_path)
+        raise Exception('docker save exited with code %d' % p.returncode)
+
+    os.rename(tmp_path, path)
+    return skipped
+
+
+def execute_plan(plan):
+    images = plan.arguments['images']
+    save_dir = plan.arguments['save_dir']
+    file_name = '%s-%s.tar.gz' % (plan.module, plan.variant or 'default')
+    plan.arguments['file_name'] = file_name
+    path = os.path.join(save_dir, file_name)
+
+    if not os.path.isdir(save_dir):
+        try:
+            os.makedirs(save_dir)
+        except OSError:
+            if not os.path.isdir(save_dir):
+                raise
+
+    client = docker.from_env(version='auto')
+    plan.status.total = max(1, client.images.get(images[0]).attrs['Size'])
+    plan.status.description = 'save %s' % images[0]
+
+    store = get_layer_store(save_dir)
+    store.begin(file_name, images)
+    try:
+        skipped = save_archive(plan, store, images, path)
+    except Exception:
+        # includes CancelledException
+        store.fail(file_name)
+        raise
+
+    store.complete(file_name)
+    if skipped:
+        logger.debug('%s: %d layers stored in other archives', file_name,
+                     skipped)
+
+    plan.artifacts.append(path)
+
+
+def variants_from_args(global_args, verb_args, module):
+    base_config = load_config(global_args.base_path, module)
+
+    variants = resolve_variants(verb_args, base_config)
+    logger.debug('Resolved variants: %r', variants)
+
+    ret = []
+    for variant in variants:
+        ret.append((variant['variant_tag'],
+                    [tag.full_interp for tag in variant['tags']]))
+
+    return ret
+
+
+@verb('save', priority=1, args=ARG_TYPES,
+      description='saves images of specified modules to compressed files')
+def save(global_args, verb_args, module, intents):
+    if 'images' in intents:
+        logger.debug('Saving collected images from build intents')
+        # build intents hold the raw tags, e.g. with a `{date}`
+        variants = [(None, sorted(parse_docker_tag(image).full_interp
+                                  for image in intents['images']))]
+    else:
+        logger.debug('Saving collected images from user args')
+        variants = variants_from_args(global_args, verb_args, module)
+
+    plans = []
+    for variant, images in variants:
+        # later verbs (i.e. push) act on the same images
+        variant_intents = intents.copy()
+        variant_intents['images'] = set(images)
+
+        plan = Plan('save', module, execute_plan, variant_intents, {
+            'images': images,
+            'save_dir': global_args.save_dir
+        })
+        plan.variant = variant
+        plan.tags = images
+        plans.append(plan)
+
+    return plans
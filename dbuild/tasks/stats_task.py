@@ -0,0 +1,282 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+import docker
+
+from dbuild import docker_utils
+from dbuild.docker_utils import (ARG_VARIANT, ARG_APPEND, ARG_TAG,
+                                 load_config, load_dockerfile,
+                                 resolve_variants)
+from dbuild.tag import parse_docker_tag
+from dbuild.verb import verb, Plan
+
+logger = logging.getLogger(__name__)
+
+ARG_TYPES = [ARG_VARIANT, ARG_APPEND, ARG_TAG]
+
+# instructions that add a layer to an image, everything else only changes
+# its config
+LAYER_INSTRUCTIONS = ('RUN', 'ADD', 'COPY')
+
+# number of layers listed in the report
+LARGEST_LAYERS = 10
+
+
+def format_size(size):
+    if size < 1024:
+        return '%d B' % size
+
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return '%.1f %s' % (size, unit)
+
+
+def is_empty_layer(entry):
+    created_by = entry.get('CreatedBy') or ''
+
+    # the legacy builder records metadata instructions as `#(nop)`, they have
+    # no layer; ADD and COPY are recorded as `#(nop)` as well, and do have one
+    if '#(nop) ' in created_by:
+        instruction = created_by.split('#(nop) ', 1)[1].strip()
+        return instruction.split(' ', 1)[0] not in LAYER_INSTRUCTIONS
+
+    # BuildKit records the plain instruction, e.g. `ENV A=b` or `RUN /bin/sh
+    # -c make # buildkit`; the legacy builder's RUN entries start with the
+    # shell instead
+    instruction = created_by.split(' ', 1)[0]
+    return instruction.isupper() and \
+        instruction not in LAYER_INSTRUCTIONS and not entry.get('Size')
+
+
+def image_layers(history, diff_ids):
+    """Matches the layers of an image with the history entries creating them
+
+    :param history: `docker history` entries, newest first
+    :param diff_ids: the image's layer digests (`RootFS.Layers`), oldest
+                     first
+    :return: a list of dicts with the `digest`, `size`, and `created_by` of
+             each layer, oldest first
+    """
+    entries = [e for e in reversed(history)
+               if not is_empty_layer(e)]
+    if len(entries) != len(diff_ids):
+        # e.g. squashed images, assume the newest entries made the layers
+        logger.debug('%d history entries for %d layers', len(entries),
+                     len(diff_ids))
+        entries = list(reversed(history))[-len(diff_ids):]
+        entries = [{}] * (len(diff_ids) - len(entries)) + entries
+
+    return [{
+        'digest': digest,
+        'size': entry.get('Size', 0),
+        'created_by': entry.get('CreatedBy') or ''
+    } for digest, entry in zip(diff_ids, entries)]
+
+
+def describe_instruction(entry):
+    value = ' '.join(entry['value'].split())
+    if len(value) > 60:
+        value = value[:57] + '...'
+
+    return 'line %d: %s %s' % (entry['startline'] + 1, entry['instruction'],
+                               value)
+
+
+def attribute_instructions(layers, structure):
+    """Sets the Dockerfile instruction that produced each layer
+
+    Layers added by the Dockerfile are the newest ones, one per layer
+    instruction of its final stage; older layers come from the base image.
+    """
+    stage = []
+    base = None
+    for entry in structure:
+        if entry['instruction'] == 'FROM':
+            stage = []
+            base = entry
+        elif entry['instruction'] in LAYER_INSTRUCTIONS:
+            stage.append(entry)
+
+    own = min(len(stage), len(layers))
+    for layer, entry in zip(layers[len(layers) - own:], stage[-own:]):
+        layer['instruction'] = describe_instruction(entry)
+
+    for layer in layers[:len(layers) - own]:
+        if base:
+            layer['instruction'] = 'base image: %s' % base['value']
+        else:
+            layer['instruction'] = None
+
+    return layers
+
+
+def inspect_image(client, image):
+    """Returns the size and layers of an image
+
+    Layer metadata is cached by image ID, which as a digest of the image
+    config pins its layers, so only new images need a `docker history`.
+    """
+    attrs = client.api.inspect_image(image)
+    image_id = attrs['Id'].encode('utf-8')
+    cache = docker_utils.parse_cache
+
+    layers = cache.get('layers', image_id) if cache else None
+    if layers is None:
+        layers = image_layers(client.api.history(image_id),
+                              attrs['RootFS'].get('Layers', []))
+        if cache:
+            cache.put('layers', image_id, layers)
+
+    return {
+        'id': attrs['Id'],
+        'size': attrs['Size'],
+        'layers': layers
+    }
+
+
+def execute_plan(plan):
+    image = plan.arguments['images'][0]
+    plan.status.description = 'stats %s' % image
+
+    client = docker.from_env(version='auto')
+    stats = inspect_image(client, image)
+
+    # copies, the cached layer list is shared between images
+    stats['layers'] = attribute_instructions(
+        [dict(layer) for layer in stats['layers']],
+        load_dockerfile(plan.arguments['base_path'], plan.module).structure)
+    stats['image'] = image
+    plan.arguments['stats'] = stats
+
+    plan.artifacts.append('%s, %d layers' % (format_size(stats['size']),
+                                             len(stats['layers'])))
+
+
+def is_base_layer(layer):
+    return (layer['instruction'] or '').startswith('base image')
+
+
+def summarize(results):
+    """Compares the layers of several images
+
+    Layers used by images of more than one module are shared; bytes in
+    layers used by a single module are unique to it.
+
+    :param results: (module, stats) tuples
+    """
+    users = {}
+    for module, stats in results:
+        for layer in stats['layers']:
+            users.setdefault(layer['digest'], set()).add(module)
+
+    images = []
+    layers = {}
+    for module, stats in results:
+        unique = 0
+        shared = 0
+        for layer in stats['layers']:
+            if len(users[layer['digest']]) > 1:
+                shared += layer['size']
+            else:
+                unique += layer['size']
+
+            # prefer the module that added the layer over its dependents
+            known = layers.get(layer['digest'])
+            if known is None or (is_base_layer(known) and
+                                 not is_base_layer(layer)):
+                layers[layer['digest']] = dict(layer, module=module)
+
+        images.append({
+            'module': module,
+            'image': stats['image'],
+            'size': stats['size'],
+            'layers': len(stats['layers']),
+            'unique': unique,
+            'shared': shared
+        })
+
+    largest = sorted(layers.values(), key=lambda l: l['size'],
+                     reverse=True)[:LARGEST_LAYERS]
+    for layer in largest:
+        layer['modules'] = len(users[layer['digest']])
+
+    return {
+        'images': images,
+        'largest': largest,
+        'total': sum(l['size'] for l in layers.values()),
+        'shared': sum(l['size'] for l in layers.values()
+                      if len(users[l['digest']]) > 1)
+    }
+
+
+def report(global_args, plans, file):
+    results = [(p.module, p.arguments['stats']) for p in plans
+               if p.status.success and 'stats' in p.arguments]
+    if not results:
+        return
+
+    summary = summarize(results)
+
+    print >> file, 'image stats:'
+    print >> file, '  %-40s %10s %6s %10s %10s' % (
+        'image', 'size', 'layers', 'unique', 'shared')
+    for image in summary['images']:
+        print >> file, '  %-40s %10s %6d %10s %10s' % (
+            image['image'], format_size(image['size']), image['layers'],
+            format_size(image['unique']), format_size(image['shared']))
+
+    print >> file, ''
+    print >> file, '%s in distinct layers, %s of them shared across ' \
+                   'modules' % (format_size(summary['total']),
+                                format_size(summary['shared']))
+
+    print >> file, ''
+    print >> file, 'largest layers:'
+    for layer in summary['largest']:
+        print >> file, '  %10s  %s (%s), used by %d module(s)' % (
+            format_size(layer['size']), layer['module'],
+            layer['instruction'] or layer['created_by'][:60],
+            layer['modules'])
+    print >> file, ''
+
+
+@verb('stats', args=ARG_TYPES, report=report,
+      description='shows image sizes and the layers shared between modules')
+def stats(global_args, verb_args, module, intents):
+    if 'images' in intents:
+        logger.debug('Inspecting collected images from build intents')
+        # build intents hold the raw tags, e.g. with a `{date}`
+        variants = [(None, sorted(parse_docker_tag(image).full_interp
+                                  for image in intents['images']))]
+    else:
+        logger.debug('Inspecting collected images from user args')
+        base_config = load_config(global_args.base_path, module)
+        variants = [(v['variant_tag'], [t.full_interp for t in v['tags']])
+                    for v in resolve_variants(verb_args, base_config)]
+        logger.debug('Resolved variants: %r', variants)
+
+    plans = []
+    for variant, images in variants:
+        plan = Plan('stats', module, execute_plan, intents, {
+            'images': images,
+            'base_path': global_args.base_path
+        })
+        plan.variant = variant
+        plan.tags = images
+        plans.append(plan)
+
+    return plans
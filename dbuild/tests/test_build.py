@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_build
+----------------------------------
+
+Tests for plan execution in `dbuild.build`.
+"""
+
+import argparse
+import os
+import time
+
+from StringIO import StringIO
+
+import attr
+import fixtures
+
+from dbuild import build, verb
+from dbuild.scheduler import ResourceBudget, WorkerLimit
+from dbuild.tests import base
+from dbuild.tasks import resolve_task
+from dbuild.verb import Plan, RetryPolicy, VerbDefinition, verbs
+
+FLAKY_VERB = VerbDefinition(
+    name='test-flaky', aliases=[], function=None, description=None,
+    priority=0, args=[],
+    retry=RetryPolicy(attempts=3, backoff=0.01, jitter=0,
+                      pattern=r'\b502\b'))
+
+
+class TestExecution(base.TestCase):
+
+    def setUp(self):
+        super(TestExecution, self).setUp()
+        self.patch(build, 'WORKER_STATUS_POLL_WAIT', 0.01)
+
+        verbs['test-flaky'] = FLAKY_VERB
+        self.addCleanup(verbs.pop, 'test-flaky')
+
+    def run_plans(self, plans, workers=1):
+        build.submission_thread_func(plans, WorkerLimit(workers),
+                                     ResourceBudget(cpu=1, memory=None))
+
+    def test_children_skipped_after_failure(self):
+        def fail(plan):
+            raise Exception('broken')
+
+        parent = Plan('build', 'module', fail, {}, {})
+        child = Plan('push', 'module', lambda p: None, {}, {}, parent=parent)
+        parent.children = [child]
+
+        self.run_plans([parent, child])
+
+        self.assertTrue(parent.status.failed)
+        self.assertTrue(child.status.failed)
+        self.assertEqual(0, child.status.attempts)
+
+    def test_transient_errors_are_retried(self):
+        calls = []
+
+        def push(plan):
+            calls.append(plan.status.attempts)
+            if len(calls) < 3:
+                raise Exception('received unexpected HTTP status: 502')
+
+        plan = Plan('test-flaky', 'module', push, {}, {})
+        self.run_plans([plan])
+
+        self.assertEqual([1, 2, 3], calls)
+        self.assertTrue(plan.status.success)
+
+    def test_permanent_errors_are_not_retried(self):
+        def push(plan):
+            raise Exception('denied: requested access to the resource')
+
+        plan = Plan('test-flaky', 'module', push, {}, {})
+        self.run_plans([plan])
+
+        self.assertEqual(1, plan.status.attempts)
+        self.assertTrue(plan.status.failed)
+        self.assertTrue(plan.status.finished)
+
+    def test_retries_are_limited(self):
+        def push(plan):
+            raise Exception('502 Bad Gateway')
+
+        plan = Plan('test-flaky', 'module', push, {}, {})
+        self.run_plans([plan])
+
+        self.assertEqual(3, plan.status.attempts)
+        self.assertTrue(plan.status.failed)
+
+    def test_cancelled_without_request(self):
+        def stop(plan):
+            raise verb.CancelledException()
+
+        plan = Plan('build', 'module', stop, {}, {})
+        build.execute_single_plan(plan)
+
+        self.assertTrue(plan.status.cancelled)
+        self.assertTrue(plan.status.finished)
+        self.assertFalse(plan.status.failed)
+
+    def test_recent_output_is_kept(self):
+        def build(plan):
+            for i in range(100):
+                plan.status.output.append('line %d' % i)
+            raise Exception('broken')
+
+        plan = Plan('build', 'module', build, {}, {})
+        self.run_plans([plan])
+
+        self.assertTrue(plan.status.failed)
+        self.assertEqual(verb.OUTPUT_EXCERPT_LINES, len(plan.status.output))
+        self.assertEqual('line 99', plan.status.output[-1])
+
+    def test_modules_take_turns(self):
+        order = []
+
+        def run(plan):
+            order.append(plan.module)
+
+        plans = [Plan('build', 'module-a', run, {}, {}) for _ in range(3)]
+        plans.append(Plan('build', 'module-b', run, {}, {}))
+        plans.append(Plan('build', 'module-c', run, {}, {}, priority=1))
+
+        self.run_plans(plans)
+
+        self.assertEqual(['module-c', 'module-a', 'module-b', 'module-a',
+                          'module-a'], order)
+
+    def test_plans_are_generated_in_module_order(self):
+        def generate(global_args, verb_args, module, intents):
+            # finish in reverse order
+            time.sleep(0.01 * (5 - int(module[-1])))
+            return [Plan('test-flaky', module, None, {}, {})]
+
+        definition = attr.evolve(FLAKY_VERB, function=generate)
+        modules = ['module-%d' % i for i in range(5)]
+        arguments = argparse.Namespace(plan_workers=5, show_plans=False,
+                                       base_path='/nonexistent', priority=[])
+        plans = build.generate_plans(arguments, {'test-flaky': []},
+                                     [definition], modules)
+
+        self.assertEqual(modules, list(plans.keys()))
+        ids = [plans[m][0].id for m in modules]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_resolved_tags_are_printed_in_module_order(self):
+        base_path = self.useFixture(fixtures.TempDir()).path
+        modules = ['module-%d' % i for i in range(12)]
+        for module in modules:
+            os.mkdir(os.path.join(base_path, module))
+            with open(os.path.join(base_path, module, 'build.yml'), 'w') as f:
+                f.write('repository: me/%s\nvariants:\n'
+                        '  - tag: master\n  - tag: stable\n' % module)
+
+        arguments = argparse.Namespace(plan_workers=4, show_plans=False,
+                                       base_path=base_path, priority=[])
+        definition = verbs['resolve']
+        plans = build.generate_plans(
+            arguments, verb.verb_arguments(['all'], ['resolve']),
+            [definition], modules)
+
+        stream = StringIO()
+        self.patch(build, 'text_stream', lambda arguments: stream)
+        build.report_plans(arguments, plans)
+
+        expected = []
+        for module in modules:
+            expected.extend(['resolved tags: %s' % module,
+                             '  master', '    me/%s:master' % module,
+                             '  stable', '    me/%s:stable' % module, ''])
+        self.assertEqual(expected, stream.getvalue().splitlines())
+        self.assertIs(resolve_task.report, definition.report)
+
+    def test_prefetch_skips_images_built_in_this_run(self):
+        base_path = self.useFixture(fixtures.TempDir()).path
+        files = {
+            'module-a/build.yml': 'repository: me/module-a\n',
+            'module-a/Dockerfile': 'FROM alpine:3.6\n',
+            'module-b/build.yml': 'repository: me/module-b\n',
+            'module-b/Dockerfile': 'FROM golang:1.9 AS builder\n'
+                                   'FROM me/module-a:latest\n'
+                                   'FROM alpine:3.6\n'
+        }
+        for name, content in files.items():
+            if not os.path.isdir(os.path.join(base_path,
+                                              os.path.dirname(name))):
+                os.mkdir(os.path.join(base_path, os.path.dirname(name)))
+            with open(os.path.join(base_path, name), 'w') as f:
+                f.write(content)
+
+        pulled = []
+        arguments = argparse.Namespace(
+            base_path=base_path, puller=argparse.Namespace(pull=pulled.append))
+
+        images = build.prefetch_base_images(arguments,
+                                            ['module-a', 'module-b'])
+        self.assertEqual(['alpine:3.6', 'golang:1.9'], images)
+        self.assertEqual(images, pulled)
+
+        # a module that isn't built is pulled like any other image
+        self.assertEqual(['golang:1.9', 'me/module-a:latest', 'alpine:3.6'],
+                         build.prefetch_base_images(arguments, ['module-b']))
+
+    def test_retry_policy_delay(self):
+        policy = RetryPolicy(backoff=2.0, max_delay=5.0, jitter=0)
+        self.assertEqual(2.0, policy.delay(1))
+        self.assertEqual(4.0, policy.delay(2))
+        self.assertEqual(5.0, policy.delay(3))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_build_log
+----------------------------------
+
+Tests for `dbuild.build_log`.
+"""
+
+import gzip
+import os
+
+import fixtures
+
+from dbuild import build_log
+from dbuild.tests import base
+
+
+class TestBuildLog(base.TestCase):
+
+    def setUp(self):
+        super(TestBuildLog, self).setUp()
+        self.log_dir = self.useFixture(fixtures.TempDir()).path
+
+    def write_log(self, module, name):
+        path = os.path.join(self.log_dir, module, name)
+        with build_log.open_build_log(path) as f:
+            f.write(u'Step 1/2 : FROM alpine\n')
+
+        return path
+
+    def test_logs_are_compressed(self):
+        path = build_log.build_log_path(self.log_dir, 'module', 'master')
+        self.assertTrue(path.endswith('-master.log.gz'))
+
+        self.write_log('module', os.path.basename(path))
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(b'Step 1/2 : FROM alpine\n', f.read())
+
+    def test_prune_keeps_newest_per_module(self):
+        for day in range(1, 5):
+            self.write_log('module-a', '2017-10-0%d-master.log.gz' % day)
+        self.write_log('module-b', '2017-10-01-master.log')
+
+        removed = build_log.prune_build_logs(
+            self.log_dir, ['module-a', 'module-b', 'module-c'], keep=2)
+
+        self.assertEqual(2, removed)
+        self.assertEqual(
+            ['2017-10-03-master.log.gz', '2017-10-04-master.log.gz'],
+            sorted(os.listdir(os.path.join(self.log_dir, 'module-a'))))
+        self.assertEqual(
+            ['2017-10-01-master.log'],
+            os.listdir(os.path.join(self.log_dir, 'module-b')))
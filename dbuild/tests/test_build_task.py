@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_build_task
+----------------------------------
+
+Tests for `dbuild.tasks.build_task`.
+"""
+
+import io
+import os
+import tempfile
+
+import fixtures
+import mock
+
+from dbuild.tag import parse_docker_tag
+from dbuild.tasks import build_task
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+class FakeDockerfile(object):
+    def __init__(self, *instructions):
+        self.structure = [{'instruction': i, 'value': v}
+                          for i, v in instructions]
+
+
+DOCKERFILE = FakeDockerfile(
+    ('FROM', 'alpine:3.6'),
+    ('RUN', 'apk add --no-cache python'),
+    ('ARG', 'BRANCH=master'),
+    ('RUN', 'git clone -b $BRANCH repo'),
+)
+
+
+# `docker build --progress=plain` of a two stage Dockerfile with 5 steps:
+# FROM alpine:3.6 AS base, ARG, RUN, FROM base, COPY
+BUILDKIT_MULTI_STAGE = """#1 [internal] load build definition from Dockerfile
+#1 transferring dockerfile: 155B done
+#1 DONE 0.0s
+
+#2 [internal] load .dockerignore
+#2 transferring context: 2B done
+#2 DONE 0.0s
+
+#3 [internal] load metadata for docker.io/library/alpine:3.6
+#3 DONE 0.8s
+
+#4 [base 1/3] FROM docker.io/library/alpine:3.6@sha256:66790a2b79e1ea3e
+#4 CACHED
+
+#5 [internal] load build context
+#5 transferring context: 87B done
+#5 DONE 0.0s
+
+#6 [base 3/3] RUN apk add --no-cache python
+#6 0.412 fetch http://dl-cdn.alpinelinux.org/alpine/v3.6/main/APKINDEX.tar.gz
+#6 3.024 OK: 41 MiB in 24 packages
+#6 DONE 3.2s
+
+#7 [stage-1 2/2] COPY . /app
+#7 DONE 0.1s
+
+#8 exporting to image
+#8 exporting layers 0.1s done
+#8 writing image sha256:4f3b2d1c done
+#8 naming to docker.io/me/module:latest done
+#8 DONE 0.1s
+""".splitlines()
+
+BUILDKIT_ERROR = """#1 [internal] load build definition from Dockerfile
+#1 DONE 0.0s
+
+#2 [1/2] FROM docker.io/library/alpine:3.6
+#2 CACHED
+
+#3 [2/2] RUN apk add --no-cache pyhton
+#3 0.398 ERROR: unsatisfiable constraints:
+#3 0.401   pyhton (missing):
+#3 ERROR: executor failed running [/bin/sh -c apk add pyhton]: exit code: 1
+------
+ > [2/2] RUN apk add --no-cache pyhton:
+------
+error: failed to solve: executor failed running [/bin/sh -c apk add pyhton]
+""".splitlines()
+
+
+def make_plan():
+    return Plan('build', 'module', None, {}, {})
+
+
+class TestSharedPrefixOrder(base.TestCase):
+
+    def test_effective_instructions_substitutes_args(self):
+        ins = build_task.effective_instructions(DOCKERFILE,
+                                                {'BRANCH': 'stable'})
+        self.assertEqual(('ARG', 'BRANCH=stable'), ins[2])
+        self.assertEqual(('RUN', 'apk add --no-cache python'), ins[1])
+
+    def test_variants_with_shared_layers_wait(self):
+        plans = [make_plan(), make_plan(), make_plan()]
+        instructions = {}
+        for plan, branch in zip(plans, ['master', 'stable', 'dev']):
+            instructions[plan.id] = build_task.effective_instructions(
+                DOCKERFILE, {'BRANCH': branch})
+
+        build_task.order_by_shared_prefix(plans, instructions)
+
+        self.assertEqual([], plans[0].waits_for)
+        self.assertEqual([plans[0]], plans[1].waits_for)
+        self.assertEqual([plans[0]], plans[2].waits_for)
+        self.assertTrue(plans[0].is_ready())
+        self.assertFalse(plans[1].is_ready())
+
+        plans[0].status.finished = True
+        self.assertTrue(plans[1].is_ready())
+
+    def test_no_shared_layers_runs_concurrently(self):
+        dockerfile = FakeDockerfile(
+            ('FROM', 'alpine:3.6'),
+            ('ARG', 'BRANCH=master'),
+            ('RUN', 'git clone -b $BRANCH repo'),
+        )
+        plans = [make_plan(), make_plan()]
+        instructions = {}
+        for plan, branch in zip(plans, ['master', 'stable']):
+            instructions[plan.id] = build_task.effective_instructions(
+                dockerfile, {'BRANCH': branch})
+
+        build_task.order_by_shared_prefix(plans, instructions)
+
+        self.assertEqual([], plans[1].waits_for)
+
+
+def make_variant_plan(variant, fingerprint, *tags):
+    tags = [parse_docker_tag(t) for t in tags]
+    plan = Plan('build', 'module', None,
+                {'images': set(t.full for t in tags)},
+                {'tags': tags, 'cache_from': []})
+    plan.variant = variant
+    plan.tags = [t.full for t in tags]
+    plan.fingerprint = fingerprint
+    return plan
+
+
+class TestCollapse(base.TestCase):
+
+    def test_identical_plans_are_merged(self):
+        master = make_variant_plan('master', 'a', 'me/module:master')
+        latest = make_variant_plan('latest', 'a', 'me/module:latest',
+                                   'me/module:master')
+        stable = make_variant_plan('stable', 'b', 'me/module:stable')
+
+        plans = build_task.collapse_identical_plans([master, latest, stable])
+
+        self.assertEqual([master, stable], plans)
+        self.assertEqual(['me/module:master', 'me/module:latest'],
+                         master.tags)
+        self.assertEqual(master.tags,
+                         [t.full for t in master.arguments['tags']])
+        self.assertEqual({'me/module:master', 'me/module:latest'},
+                         master.intents['images'])
+        self.assertEqual(['me/module:stable'], stable.tags)
+
+
+class TestBuildkitProgress(base.TestCase):
+
+    def parse(self, lines, total):
+        plan = make_plan()
+        plan.status.total = total
+        errors = build_task.parse_buildkit_progress(lines, plan.status,
+                                                    'me/module:latest')
+        return plan.status, list(errors)
+
+    def test_multi_stage(self):
+        # only the cached FROM of the base stage so far
+        status, _ = self.parse(BUILDKIT_MULTI_STAGE[:13], 5)
+        self.assertEqual(1, status.current)
+        self.assertEqual('build me/module:latest FROM docker.io/libra',
+                         status.description)
+
+        status, errors = self.parse(BUILDKIT_MULTI_STAGE, 5)
+        self.assertEqual(3, status.current)
+        self.assertEqual('build me/module:latest COPY . /app',
+                         status.description)
+        self.assertEqual([], errors)
+
+    def test_progress_is_scaled_to_dockerfile_steps(self):
+        status, _ = self.parse(BUILDKIT_MULTI_STAGE, 10)
+        self.assertEqual(6, status.current)
+
+        # all steps done, but the build only finishes with the image
+        status, _ = self.parse(['#2 [1/2] FROM docker.io/library/alpine',
+                                '#2 CACHED',
+                                '#3 [2/2] RUN true',
+                                '#3 DONE 0.1s'], 2)
+        self.assertEqual(1, status.current)
+
+    def test_errors(self):
+        status, errors = self.parse(BUILDKIT_ERROR, 2)
+        self.assertEqual('error', status.description)
+        self.assertEqual(1, status.current)
+        self.assertEqual([
+            '#3 ERROR: executor failed running [/bin/sh -c apk add pyhton]: '
+            'exit code: 1',
+            'error: failed to solve: executor failed running [/bin/sh -c apk '
+            'add pyhton]'
+        ], errors)
+
+    def test_iidfile_is_removed_on_errors(self):
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        mkstemp = tempfile.mkstemp
+        self.patch(build_task.tempfile, 'mkstemp',
+                   lambda **kw: mkstemp(dir=tmp_dir, **kw))
+
+        process = mock.Mock(stdout=io.BytesIO(b'\n'.join(BUILDKIT_ERROR)))
+        self.patch(build_task.subprocess, 'Popen', lambda *a, **kw: process)
+
+        def fail(plan, line, log_file):
+            raise IOError('No space left on device')
+        self.patch(build_task, 'write_build_log', fail)
+
+        plan = make_plan()
+        plan.arguments.update({'build_args': {}, 'target': None,
+                               'run_id': 'run'})
+        self.assertRaises(IOError, build_task.build_buildkit, plan,
+                          '/module', ['me/module:latest'], [], None)
+        self.assertEqual([], os.listdir(tmp_dir))
+        process.kill.assert_called_once_with()
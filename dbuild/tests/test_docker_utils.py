@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_docker_utils
+----------------------------------
+
+Tests for parsing, caching and streams in `dbuild.docker_utils`.
+"""
+
+import datetime
+import json
+import os
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Thread
+
+import docker
+import fixtures
+
+from dbuild import docker_utils
+from dbuild.tests import base
+from dbuild.verb import CancelToken, CancelledException
+
+DOCKERFILE = b"""FROM alpine:3.6 AS base
+ARG REBUILD_CHECKOUT=1
+RUN apk add --no-cache python
+
+FROM base
+COPY . /app
+"""
+
+BUILD_YML = b"""repository: me/module
+variants:
+  - tag: latest
+"""
+
+
+class TestParseCache(base.TestCase):
+
+    def setUp(self):
+        super(TestParseCache, self).setUp()
+        self.base_path = self.useFixture(fixtures.TempDir()).path
+        self.state_dir = os.path.join(self.base_path, '.dbuild')
+
+        os.mkdir(os.path.join(self.base_path, 'module'))
+        self.write('Dockerfile', DOCKERFILE)
+        self.write('build.yml', BUILD_YML)
+
+        self.patch(docker_utils, 'parse_cache', None)
+        self.patch(docker_utils, 'config_cache', {})
+        self.patch(docker_utils, 'dockerfile_cache', {})
+
+    def write(self, name, content):
+        with open(os.path.join(self.base_path, 'module', name), 'wb') as f:
+            f.write(content)
+
+    def forget(self):
+        """Simulates a new invocation with an empty in-process cache"""
+        docker_utils.config_cache.clear()
+        docker_utils.dockerfile_cache.clear()
+        docker_utils.enable_parse_cache(self.state_dir)
+
+    def test_structure_is_parsed_once(self):
+        dockerfile = docker_utils.load_dockerfile(self.base_path, 'module')
+        self.assertIs(dockerfile.structure, dockerfile.structure)
+        self.assertEqual(5, len(dockerfile.structure))
+
+        dockerfile.content = u'FROM scratch\n'
+        self.assertEqual(1, len(dockerfile.structure))
+
+    def test_parse_results_are_reused_between_runs(self):
+        self.forget()
+        expected = docker_utils.load_dockerfile(self.base_path, 'module')
+        config = docker_utils.load_config(self.base_path, 'module')
+        self.assertEqual(0, docker_utils.parse_cache.hits)
+
+        self.forget()
+        dockerfile = docker_utils.load_dockerfile(self.base_path, 'module')
+        self.assertEqual(config,
+                         docker_utils.load_config(self.base_path, 'module'))
+        self.assertEqual(2, docker_utils.parse_cache.hits)
+        self.assertEqual(expected.structure, dockerfile.structure)
+        self.assertEqual(['alpine:3.6'],
+                         docker_utils.get_base_images(dockerfile))
+        self.assertEqual(['checkout'],
+                         docker_utils.get_rebuild_targets(dockerfile))
+
+    def test_changed_content_is_reparsed(self):
+        self.forget()
+        docker_utils.load_config(self.base_path, 'module')
+
+        self.forget()
+        self.write('build.yml', b'repository: me/other\n')
+        config = docker_utils.load_config(self.base_path, 'module')
+        self.assertEqual({'repository': 'me/other'}, config)
+        self.assertEqual(0, docker_utils.parse_cache.hits)
+
+    def test_values_are_stored_as_json(self):
+        self.forget()
+        cache = docker_utils.parse_cache
+        cache.put('build.yml', b'a', {'name': 'caf\xc3\xa9'.decode('utf-8'),
+                                      'tags': ['latest']})
+        value = cache.get('build.yml', b'a')
+        self.assertEqual({'name': u'caf\xe9', 'tags': ['latest']}, value)
+        self.assertIsInstance(value['tags'][0], str)
+
+        with open(cache.path('build.yml', cache.key('build.yml', b'a'))) as f:
+            self.assertEqual(value, json.load(f))
+
+        # dates and non-string keys would not survive a round trip
+        cache.put('build.yml', b'b', {'built': datetime.date(2017, 1, 1)})
+        cache.put('build.yml', b'c', {1: 'one'})
+        self.assertIsNone(cache.get('build.yml', b'b'))
+        self.assertIsNone(cache.get('build.yml', b'c'))
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Sends one push event, then stalls like a daemon during a slow push"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        event = b'{"status": "Preparing", "id": "abc"}\r\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.flush()
+        self.server.release.wait(10)
+
+
+class TestStreamCancel(base.TestCase):
+
+    def setUp(self):
+        super(TestStreamCancel, self).setUp()
+        self.token = CancelToken()
+
+    def fake_daemon(self):
+        server = HTTPServer(('127.0.0.1', 0), StreamHandler)
+        server.release = Event()
+        thread = Thread(target=server.handle_request)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.release.set)
+
+        return docker.DockerClient(
+            base_url='tcp://127.0.0.1:%d' % server.server_port,
+            version='1.35')
+
+    def test_blocked_stream_is_aborted(self):
+        client = self.fake_daemon()
+        docker_utils.abort_streams_on_cancel(client, self.token)
+        stream = client.images.push('me/module', tag='latest', stream=True,
+                                    decode=True)
+
+        events = []
+        errors = []
+
+        def read():
+            try:
+                for event in docker_utils.iter_stream(stream, self.token):
+                    events.append(event)
+            except Exception as ex:
+                errors.append(ex)
+
+        reader = Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        for _ in range(100):
+            if events:
+                break
+            time.sleep(0.01)
+        self.assertEqual([{'status': 'Preparing', 'id': 'abc'}], events)
+
+        # the reader is blocked until the daemon sends more, cancelling
+        # must unblock it well within a second
+        self.token.cancel()
+        reader.join(1)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], CancelledException)
+
+    def test_iter_stream(self):
+        self.token.cancel()
+        self.assertRaises(CancelledException, list,
+                          docker_utils.iter_stream(iter([{}]), self.token))
+
+        # errors of an aborted stream are cancellation, not failures
+        def aborted():
+            yield {}
+            raise IOError('connection closed')
+
+        token = CancelToken()
+        stream = docker_utils.iter_stream(aborted(), token)
+        next(stream)
+        token.cancel()
+        self.assertRaises(CancelledException, next, stream)
+
+        stream = docker_utils.iter_stream(aborted(), CancelToken())
+        self.assertRaises(IOError, list, stream)
+
+
+class TestDependencies(base.TestCase):
+
+    def test_strip_image_tag(self):
+        self.assertEqual('me/module',
+                         docker_utils.strip_image_tag('me/module:1.0'))
+        self.assertEqual('me/module',
+                         docker_utils.strip_image_tag('me/module'))
+        self.assertEqual('localhost:5000/me/module',
+                         docker_utils.strip_image_tag(
+                             'localhost:5000/me/module:1.0'))
+        self.assertEqual('localhost:5000/me/module',
+                         docker_utils.strip_image_tag(
+                             'localhost:5000/me/module'))
+        self.assertEqual('me/module', docker_utils.strip_image_tag(
+            'me/module@sha256:0123abcd'))
+        self.assertEqual('localhost:5000/me/module',
+                         docker_utils.strip_image_tag(
+                             'localhost:5000/me/module:1.0@sha256:0123abcd'))
+
+    def test_base_images(self):
+        dockerfile = docker_utils.CachedDockerfileParser(b'''ARG VERSION=3.6
+FROM --platform=linux/amd64 golang:1.9 AS builder
+RUN make
+FROM alpine:$VERSION
+FROM builder AS test
+FROM scratch
+COPY --from=builder /app /app
+FROM alpine:3.6
+FROM golang:1.9
+''')
+        self.assertEqual(['golang:1.9', 'alpine:3.6'],
+                         docker_utils.get_base_images(dockerfile))
+
+    def test_dependents(self):
+        dependencies = {
+            'base': set(),
+            'python': {'base'},
+            'app': {'python'},
+            'other': set(),
+        }
+        self.assertEqual({'base', 'python', 'app'},
+                         docker_utils.get_dependents(dependencies, ['base']))
+        self.assertEqual({'python', 'app'},
+                         docker_utils.get_dependents(dependencies,
+                                                     ['python']))
+        self.assertEqual({'other'},
+                         docker_utils.get_dependents(dependencies, ['other']))
+
+    def test_levels(self):
+        # a diamond: both middle modules build FROM base, top uses both
+        dependencies = {
+            'base': set(),
+            'left': {'base'},
+            'right': {'base'},
+            'top': {'left', 'right'},
+        }
+        self.assertEqual(
+            [['base'], ['right', 'left'], ['top']],
+            docker_utils.dependency_levels(
+                dependencies, ['top', 'right', 'left', 'base']))
+
+        # dependencies outside of the given modules don't count
+        self.assertEqual(
+            [['left', 'right'], ['top']],
+            docker_utils.dependency_levels(dependencies,
+                                           ['left', 'right', 'top']))
+
+    def test_cycles(self):
+        dependencies = {
+            'a': {'b'},
+            'b': {'a'},
+            'c': set(),
+            'd': {'a'},
+        }
+        self.assertEqual(
+            [['c'], ['a', 'b', 'd']],
+            docker_utils.dependency_levels(dependencies,
+                                           ['a', 'b', 'c', 'd']))
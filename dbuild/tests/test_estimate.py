@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_estimate
+----------------------------------
+
+Tests for `dbuild.estimate`.
+"""
+
+from StringIO import StringIO
+
+import fixtures
+
+from dbuild import estimate
+from dbuild.build import flatten
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def make_tree(module, variant, instructions):
+    build = Plan('build', module, None, {}, {})
+    build.variant = variant
+    build.status.total = instructions
+
+    push = Plan('push', module, None, {}, {}, parent=build)
+    push.variant = variant
+    build.children = [push]
+    return build
+
+
+class TestEstimate(base.TestCase):
+
+    def setUp(self):
+        super(TestEstimate, self).setUp()
+        self.master = make_tree('module-a', 'master', 6)
+        self.stable = make_tree('module-a', 'stable', 6)
+        self.stable.waits_for = [self.master]
+        self.module_b = make_tree('module-b', None, 3)
+
+        self.plans = flatten([], [self.master, self.stable, self.module_b])
+        self.seconds = dict(
+            (p.id, estimate.estimate_duration(p, {})[0]) for p in self.plans)
+
+    def test_fallback_durations(self):
+        self.assertEqual(60, self.seconds[self.master.id])
+        self.assertEqual(estimate.FALLBACK_SECONDS,
+                         self.seconds[self.master.children[0].id])
+
+    def test_simulate(self):
+        self.assertEqual(180, estimate.simulate(self.plans, self.seconds, 1))
+        self.assertEqual(130, estimate.simulate(self.plans, self.seconds, 2))
+
+        path, seconds = estimate.critical_path(self.plans, self.seconds)
+        self.assertEqual(130, seconds)
+        self.assertEqual([self.master, self.stable, self.stable.children[0]],
+                         path)
+
+    def test_durations_are_recorded(self):
+        state_dir = self.useFixture(fixtures.TempDir()).path
+        for i, plan in enumerate(self.plans):
+            plan.status.finished = True
+            plan.status.started_at = 100.0
+            plan.status.finished_at = 105.0 + i
+
+        estimate.record_durations(state_dir, self.plans)
+        durations = estimate.load_durations(state_dir)
+        self.assertEqual((5.0, True),
+                         estimate.estimate_duration(self.master, durations))
+
+        # finished plans, e.g. restored from the journal, don't count
+        out = StringIO()
+        estimate.print_estimate(self.plans, 2, durations, out)
+        self.assertIn('estimate: 0 plans', out.getvalue())
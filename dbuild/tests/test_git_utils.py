@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_git_utils
+----------------------------------
+
+Tests for `dbuild.git_utils`.
+"""
+
+import os
+
+import fixtures
+
+from dbuild.docker_utils import SubprocessException
+from dbuild.git_utils import capture_git, get_changed_modules
+from dbuild.tests import base
+
+MODULES = ['module-a', 'module-b', 'module-c']
+
+
+class TestChangedModules(base.TestCase):
+
+    def setUp(self):
+        super(TestChangedModules, self).setUp()
+        self.repo = self.useFixture(fixtures.TempDir()).path
+        # the workspace is a subdirectory of the repository
+        self.base_path = os.path.join(self.repo, 'docker')
+        for module in MODULES:
+            os.makedirs(os.path.join(self.base_path, module))
+            self.write('docker/%s/Dockerfile' % module, 'FROM alpine\n')
+        self.write('docker/module-a/start.sh', '#!/bin/sh\n')
+        self.write('docker/README.md', 'modules\n')
+        self.write('setup.py', 'pass\n')
+
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.commit()
+
+    def git(self, *args):
+        out, _ = capture_git(list(args), self.repo)
+        return out
+
+    def commit(self):
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@test',
+                 'commit', '-q', '-m', 'change')
+
+    def write(self, name, content):
+        with open(os.path.join(self.repo, name), 'w') as f:
+            f.write(content)
+
+    def changed(self, ref='HEAD'):
+        return get_changed_modules(self.base_path, ref, MODULES)
+
+    def test_changes_in_modules(self):
+        self.assertEqual(set(), self.changed())
+
+        # unstaged, staged and untracked files all count
+        self.write('docker/module-a/start.sh', '#!/bin/bash\n')
+        self.write('docker/module-b/Dockerfile', 'FROM alpine:3.6\n')
+        self.git('add', 'docker/module-b/Dockerfile')
+        self.write('docker/module-c/new.txt', 'new\n')
+        self.assertEqual(set(MODULES), self.changed())
+
+    def test_committed_changes(self):
+        first = self.git('rev-parse', 'HEAD').strip()
+        self.write('docker/module-b/Dockerfile', 'FROM alpine:3.6\n')
+        self.git('add', '.')
+        self.commit()
+
+        self.assertEqual(set(), self.changed())
+        self.assertEqual({'module-b'}, self.changed(first))
+
+    def test_root_level_changes(self):
+        # neither files next to the modules nor outside the workspace
+        # belong to a module
+        self.write('docker/README.md', 'changed\n')
+        self.write('setup.py', 'raise\n')
+        self.assertEqual(set(), self.changed())
+
+    def test_renames(self):
+        self.git('mv', 'docker/module-a/start.sh', 'docker/module-b/start.sh')
+        self.commit()
+
+        self.assertEqual({'module-a', 'module-b'}, self.changed('HEAD~1'))
+
+    def test_invalid_ref(self):
+        self.assertRaises(SubprocessException, self.changed, 'no-such-ref')
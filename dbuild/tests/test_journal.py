@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_journal
+----------------------------------
+
+Tests for `dbuild.journal`.
+"""
+
+import os
+
+import fixtures
+
+from dbuild.journal import JOURNAL_FILE, Journal
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def make_plan(module, fingerprint='abc', success=True):
+    plan = Plan('build', module, None, {}, {})
+    plan.variant = 'master'
+    plan.tags = ['me/%s:master' % module, 'me/%s:latest' % module]
+    plan.fingerprint = fingerprint
+    plan.status.finished = True
+    plan.status.failed = not success
+    plan.artifacts = ['me/%s:master' % module]
+    return plan
+
+
+class TestJournal(base.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.state_dir = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'state')
+
+    def record(self, *plans):
+        journal = Journal(self.state_dir)
+        for plan in plans:
+            journal.record(plan)
+        journal.close()
+
+    def restore(self, *plans):
+        journal = Journal(self.state_dir, resume=True)
+        try:
+            return journal.restore(plans)
+        finally:
+            journal.close()
+
+    def test_round_trip(self):
+        self.record(make_plan('module-a'), make_plan('module-b',
+                                                     success=False))
+
+        plan = Plan('build', 'module-a', None, {}, {})
+        plan.variant = 'master'
+        plan.tags = ['me/module-a:latest', 'me/module-a:master']
+        plan.fingerprint = 'abc'
+        failed = make_plan('module-b')
+        failed.status.finished = False
+
+        self.assertEqual(1, self.restore(plan, failed))
+        self.assertTrue(plan.status.finished)
+        self.assertTrue(plan.status.resumed)
+        self.assertEqual(['me/module-a:master'], plan.artifacts)
+        self.assertFalse(failed.status.finished)
+
+    def test_changed_inputs_are_not_restored(self):
+        self.record(make_plan('module-a'))
+
+        plan = make_plan('module-a', fingerprint='def')
+        plan.status.finished = False
+        self.assertEqual(0, self.restore(plan))
+        self.assertFalse(plan.status.finished)
+
+    def test_truncated_line(self):
+        self.record(make_plan('module-a'), make_plan('module-b'))
+
+        # an interrupted write of the last entry
+        path = os.path.join(self.state_dir, JOURNAL_FILE)
+        with open(path, 'r+') as f:
+            f.truncate(os.path.getsize(path) - 20)
+
+        journal = Journal(self.state_dir, resume=True)
+        self.assertEqual(1, len(journal.completed))
+        journal.record(make_plan('module-c'))
+        journal.close()
+
+        # entries appended after resuming are still readable
+        plans = [make_plan(m) for m in ('module-a', 'module-b', 'module-c')]
+        self.assertEqual(2, self.restore(*plans))
+        self.assertFalse(plans[1].status.resumed)
+
+    def test_fresh_run_replaces_journal(self):
+        self.record(make_plan('module-a'))
+        self.record()
+        self.assertEqual(0, self.restore(make_plan('module-a')))
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_mirror_task
+----------------------------------
+
+Tests for `dbuild.tasks.mirror_task` against in-process registries.
+"""
+
+import hashlib
+import json
+import re
+import urlparse
+import uuid
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+from argparse import Namespace
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dbuild import build
+from dbuild.registry import MEDIA_TYPE_MANIFEST, MEDIA_TYPE_MANIFEST_LIST
+from dbuild.tag import DockerTag
+from dbuild.tasks import mirror_task
+from dbuild.tests import base
+from dbuild.verb import Plan, verbs
+
+REGEX_UPLOAD = re.compile(r'^/v2/(.+)/blobs/uploads/(.*)$')
+REGEX_OBJECT = re.compile(r'^/v2/(.+)/(manifests|blobs)/([^/]+)$')
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    """Just enough of the registry v2 API to push and pull images"""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def get_object(self):
+        url = urlparse.urlparse(self.path)
+        match = REGEX_OBJECT.match(url.path)
+        if not match:
+            return self.reply(404)
+
+        repo, kind, reference = match.groups()
+        store = self.server.registry
+        if kind == 'blobs':
+            data = store.blobs.get(repo, {}).get(reference)
+            if data is None:
+                return self.reply(404)
+
+            return self.reply(200, data)
+
+        manifest = store.manifests.get(repo, {}).get(reference)
+        if manifest is None:
+            return self.reply(404)
+
+        body, media_type = manifest
+        self.reply(200, body, {'Content-Type': media_type,
+                               'Docker-Content-Digest': digest(body)})
+
+    do_GET = get_object
+    do_HEAD = get_object
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        repo = REGEX_UPLOAD.match(url.path).group(1)
+        query = dict(urlparse.parse_qsl(url.query))
+        store = self.server.registry
+
+        with store.lock:
+            source = store.blobs.get(query.get('from'), {})
+            if query.get('mount') in source:
+                store.blobs.setdefault(repo, {})[query['mount']] = \
+                    source[query['mount']]
+                store.mounts += 1
+                return self.reply(201)
+
+        self.reply(202, headers={
+            'Location': '/v2/%s/blobs/uploads/%s' % (repo, uuid.uuid4())
+        })
+
+    def do_PUT(self):
+        url = urlparse.urlparse(self.path)
+        store = self.server.registry
+        body = self.read_body()
+
+        upload = REGEX_UPLOAD.match(url.path)
+        if upload:
+            expected = dict(urlparse.parse_qsl(url.query))['digest']
+            if digest(body) != expected:
+                return self.reply(400)
+
+            with store.lock:
+                store.blobs.setdefault(upload.group(1), {})[expected] = body
+                store.uploads += 1
+            return self.reply(201)
+
+        repo, _, reference = REGEX_OBJECT.match(url.path).groups()
+        with store.lock:
+            store.manifests.setdefault(repo, {})[reference] = (
+                body, self.headers['Content-Type'])
+        self.reply(201)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeRegistry(object):
+
+    def __init__(self):
+        self.blobs = {}
+        self.manifests = {}
+        self.uploads = 0
+        self.mounts = 0
+        self.lock = Lock()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RegistryHandler)
+        self.server.registry = self
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_image(self, repo, tag, layers):
+        config = json.dumps({'repository': repo, 'tag': tag})
+        descriptors = []
+        for data in [config] + layers:
+            self.blobs.setdefault(repo, {})[digest(data)] = data
+            descriptors.append({'digest': digest(data), 'size': len(data)})
+
+        body = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_MANIFEST,
+            'config': descriptors[0],
+            'layers': descriptors[1:]
+        })
+        self.manifests.setdefault(repo, {})[tag] = (body, MEDIA_TYPE_MANIFEST)
+        return body
+
+
+BASE_LAYER = b'base' * 100000
+
+
+class TestMirror(base.TestCase):
+
+    def setUp(self):
+        super(TestMirror, self).setUp()
+        self.source = FakeRegistry()
+        self.dest = FakeRegistry()
+        self.addCleanup(self.source.stop)
+        self.addCleanup(self.dest.stop)
+
+        mirror = mirror_task.Mirror(workers=4)
+        self.addCleanup(mirror.shutdown)
+        self.patch(mirror_task, '_mirror', mirror)
+
+    def mirror(self, *images):
+        plans = []
+        for image in images:
+            tag = DockerTag(self.source.host, 'me', image, 'latest')
+            plans.append(Plan('mirror', image, mirror_task.execute_plan, {}, {
+                'tags': [(tag, tag.mutate(registry=self.dest.host,
+                                          namespace='mirror'))],
+                'workers': 4
+            }))
+
+        executor = ThreadPoolExecutor(max_workers=len(plans))
+        for future in [executor.submit(p.function, p) for p in plans]:
+            future.result()
+        executor.shutdown()
+
+        return plans
+
+    def test_mirror_waits_for_push(self):
+        build.load_verbs()
+        definitions = sorted([verbs['mirror'], verbs['push']],
+                             key=lambda v: v.priority, reverse=True)
+
+        global_args = Namespace(mirror_to='registry.example.com',
+                                mirror_workers=1)
+        plans = build.build_plan_tree(
+            global_args, {'mirror': [], 'push': []}, 'module-a',
+            definitions, {'images': {'me/module-a:latest'}})
+
+        self.assertEqual(['push'], [p.verb for p in plans])
+        self.assertEqual(['mirror'], [p.verb for p in plans[0].children])
+
+    def test_shared_blobs_are_copied_once(self):
+        manifest_a = self.source.add_image('me/module-a', 'latest',
+                                           [BASE_LAYER, b'a'])
+        manifest_b = self.source.add_image('me/module-b', 'latest',
+                                           [BASE_LAYER, b'b'])
+
+        plans = self.mirror('module-a', 'module-b')
+
+        # two configs, the base layer, and one layer per module
+        self.assertEqual(5, self.dest.uploads)
+        self.assertEqual(1, self.dest.mounts)
+        self.assertEqual(
+            (manifest_a, MEDIA_TYPE_MANIFEST),
+            self.dest.manifests['mirror/module-a']['latest'])
+        self.assertEqual(
+            (manifest_b, MEDIA_TYPE_MANIFEST),
+            self.dest.manifests['mirror/module-b']['latest'])
+        self.assertIn(digest(BASE_LAYER), self.dest.blobs['mirror/module-b'])
+
+        for plan in plans:
+            self.assertEqual(plan.status.total, plan.status.current)
+            self.assertEqual(['%s/mirror/%s:latest' % (self.dest.host,
+                                                       plan.module)],
+                             plan.artifacts)
+
+        # blobs already in the destination are not copied again
+        self.patch(mirror_task, '_mirror', mirror_task.Mirror(workers=4))
+        self.mirror('module-a')
+        self.assertEqual(5, self.dest.uploads)
+
+    def test_manifest_list(self):
+        child = self.source.add_image('me/module-a', 'amd64', [b'amd64'])
+        body = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MEDIA_TYPE_MANIFEST_LIST,
+            'manifests': [{'digest': digest(child), 'size': len(child)}]
+        })
+        self.source.manifests['me/module-a']['latest'] = (
+            body, MEDIA_TYPE_MANIFEST_LIST)
+        self.source.manifests['me/module-a'][digest(child)] = (
+            child, MEDIA_TYPE_MANIFEST)
+
+        self.mirror('module-a')
+
+        manifests = self.dest.manifests['mirror/module-a']
+        self.assertEqual((child, MEDIA_TYPE_MANIFEST),
+                         manifests[digest(child)])
+        self.assertEqual((body, MEDIA_TYPE_MANIFEST_LIST),
+                         manifests['latest'])
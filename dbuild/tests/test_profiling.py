@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_profiling
+----------------------------------
+
+Tests for `dbuild.profiling`.
+"""
+
+import os
+import pstats
+
+from threading import Thread
+
+import fixtures
+
+from dbuild import profiling
+from dbuild.tests import base
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiling(base.TestCase):
+
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.profiler = profiling.Profiler(self.path)
+        self.patch(profiling, 'profiler', self.profiler)
+
+    def stats(self, phase):
+        stats = pstats.Stats(os.path.join(self.path, phase + '.pstats'))
+        return dict((name, entry) for (_, _, name), entry
+                    in stats.stats.items())
+
+    def test_phases_are_merged(self):
+        with profiling.profiled('planning'):
+            busy(100)
+        with profiling.profiled('planning'):
+            busy(100)
+            # nested phases count toward the outer one
+            with profiling.profiled('inner'):
+                busy(100)
+
+        self.profiler.write()
+
+        stats = self.stats('planning')
+        self.assertEqual(3, stats['busy'][1])
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                     'inner.pstats')))
+
+        with open(os.path.join(self.path, 'planning.callgrind')) as f:
+            callgrind = f.read()
+        self.assertIn('events: Microseconds', callgrind)
+        self.assertIn('fn=busy\n', callgrind)
+        self.assertIn('cfn=<sum>\ncalls=3 ', callgrind)
+
+    def test_threads(self):
+        work = profiling.profiled_function('worker-{thread}')(busy)
+        threads = [Thread(target=work, args=(100,), name='w%d' % i)
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.profiler.write()
+
+        for i in range(2):
+            self.assertEqual(1, self.stats('worker-w%d' % i)['busy'][1])
+
+    def test_disabled(self):
+        self.patch(profiling, 'profiler', None)
+        work = profiling.profiled_function('worker')(busy)
+        self.assertEqual(busy(10), work(10))
+
+        self.profiler.write()
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_memory(self):
+        profiler = profiling.Profiler(self.path, memory=True)
+        with profiler.phase('planning'):
+            data = [str(i) for i in range(100000)]
+
+        with profiler.phase('planning'):
+            del data
+
+        with open(os.path.join(self.path, 'planning.memory.txt')) as f:
+            lines = [l for l in f.read().splitlines()
+                     if l.startswith('planning: ')]
+        self.assertEqual(2, len(lines))
+        self.assertIn(' MiB, peak ', lines[0])
+
+        _, peak = profiling.memory_usage()
+        self.assertGreater(peak, 0)
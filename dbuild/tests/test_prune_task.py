@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_prune_task
+----------------------------------
+
+Tests for removing images from old runs in `dbuild.tasks.prune_task`.
+"""
+
+import mock
+
+from docker.errors import APIError
+
+from dbuild.docker_utils import image_labels, LABEL_MODULE, LABEL_VARIANT
+from dbuild.tasks import prune_task
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def image(variant, run_id, image_id=None, tags=()):
+    return mock.Mock(labels=image_labels('module-a', variant, run_id, 'f'),
+                     name='%s/%s' % (variant, run_id), id=image_id,
+                     short_id=image_id, tags=list(tags))
+
+
+class TestPrune(base.TestCase):
+
+    def test_stale_images(self):
+        runs = ['20260101-000000-aaaa', '20260102-000000-bbbb',
+                '20260103-000000-cccc']
+        master = [image('master', run) for run in runs]
+        stable = [image('stable', runs[0])]
+
+        # a run may have built several images of a variant, e.g. targets
+        extra = image('master', runs[0])
+
+        stale = prune_task.stale_images(master + stable + [extra], keep=2)
+
+        self.assertEqual([master[0], extra], stale)
+        self.assertEqual(
+            [], prune_task.stale_images(master + stable, keep=3))
+
+    def test_execute_plan(self):
+        runs = ['20260101-000000-aaaa', '20260102-000000-bbbb',
+                '20260103-000000-cccc']
+        tagged = image('master', runs[0], 'sha256:a', ['me/module-a:old'])
+        in_use = image('master', runs[0], 'sha256:b')
+        images = [tagged, in_use, image('master', runs[1], 'sha256:c'),
+                  image('master', runs[2], 'sha256:d')]
+
+        def remove(name):
+            if name == 'sha256:b':
+                raise APIError('conflict: image is being used by running '
+                               'container', response=mock.Mock(
+                                   status_code=409))
+
+        client = mock.Mock()
+        client.images.list.return_value = images
+        client.images.remove.side_effect = remove
+        self.patch(prune_task.docker, 'from_env', lambda **kw: client)
+
+        plan = Plan('prune', 'module-a', prune_task.execute_plan, {},
+                    {'keep': 2}, variant='master')
+        prune_task.execute_plan(plan)
+
+        client.images.list.assert_called_once_with(filters={'label': [
+            '%s=module-a' % LABEL_MODULE, '%s=master' % LABEL_VARIANT]})
+
+        # tagged images are removed through their tags, not by id
+        self.assertEqual([mock.call('me/module-a:old'),
+                          mock.call('sha256:b')],
+                         client.images.remove.call_args_list)
+        self.assertEqual(['1 images removed, 3 kept'], plan.artifacts)
+        self.assertEqual((2, 2), (plan.status.current, plan.status.total))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_pull
+----------------------------------
+
+Tests for `dbuild.pull`.
+"""
+
+from threading import Event
+
+import mock
+
+from dbuild import pull
+from dbuild.tests import base
+
+
+class TestImagePuller(base.TestCase):
+
+    def setUp(self):
+        super(TestImagePuller, self).setUp()
+        self.client = mock.Mock()
+        self.patch(pull.docker, 'from_env', lambda **kw: self.client)
+
+        self.puller = pull.ImagePuller(workers=2)
+        self.addCleanup(self.puller.shutdown)
+
+    def test_images_are_pulled_once(self):
+        release = Event()
+
+        def api_pull(repo, tag, stream, decode):
+            release.wait(10)
+            return iter([{'status': 'Pulling from %s' % repo},
+                         {'status': 'Downloaded newer image'}])
+
+        self.client.api.pull.side_effect = api_pull
+
+        future = self.puller.pull('me/module-a:master')
+        self.assertIs(future, self.puller.pull('me/module-a:master'))
+        self.assertIs(future, self.puller.get('me/module-a:master'))
+        self.assertIsNone(self.puller.get('me/module-b:master'))
+
+        release.set()
+        self.assertTrue(future.result(10))
+        self.assertTrue(self.puller.pull('me/module-a:master').result(10))
+        self.client.api.pull.assert_called_once_with(
+            'me/module-a', tag='master', stream=True, decode=True)
+
+        self.assertGreaterEqual(
+            self.puller.elapsed(['me/module-a:master']), 0)
+
+    def test_failed_pulls_are_not_fatal(self):
+        self.client.api.pull.return_value = iter([
+            {'error': 'manifest for me/module-a:master not found'}])
+        self.assertFalse(self.puller.pull('me/module-a:master').result(10))
+
+        self.client.api.pull.side_effect = IOError('connection refused')
+        self.assertFalse(self.puller.pull('me/module-b:master').result(10))
+
+        self.patch(pull.docker, 'from_env',
+                   mock.Mock(side_effect=Exception('no daemon')))
+        self.assertFalse(self.puller.pull('me/module-c:master').result(10))
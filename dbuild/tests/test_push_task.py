@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_push_task
+----------------------------------
+
+Tests for grouped pushes in `dbuild.tasks.push_task`.
+"""
+
+import mock
+
+from dbuild.registry import MEDIA_TYPE_MANIFEST
+from dbuild.tasks import push_task
+from dbuild.tests import base
+from dbuild.tests.test_mirror_task import FakeRegistry
+from dbuild.verb import Plan
+
+
+class FakeDockerClient(object):
+    """Pushes images to a FakeRegistry, by name only"""
+
+    def __init__(self, registry, image_ids):
+        self.registry = registry
+        self.image_ids = image_ids
+        self.pushed = []
+        self.failing = set()
+        self.images = self
+
+    def get(self, image):
+        return mock.Mock(id=self.image_ids[image])
+
+    def push(self, repo, tag, stream, decode):
+        self.pushed.append('%s:%s' % (repo, tag))
+        if tag in self.failing:
+            self.failing.remove(tag)
+            return iter([{'error': 'received unexpected HTTP status: 502'}])
+
+        self.registry.add_image(repo.split('/', 1)[1], tag, [b'layer'])
+
+        return iter([
+            {'status': 'Preparing', 'id': 'abc'},
+            {'status': 'Pushing', 'id': 'abc',
+             'progressDetail': {'current': 512, 'total': 1024}},
+            {'status': 'Pushing', 'id': 'abc',
+             'progressDetail': {'current': 1024, 'total': 1024}},
+            {'status': 'Pushed', 'id': 'abc', 'progressDetail': {}},
+            {'status': '%s: digest: sha256:0 size: 1' % tag},
+        ])
+
+
+class TestPush(base.TestCase):
+
+    def setUp(self):
+        super(TestPush, self).setUp()
+        self.registry = FakeRegistry()
+        self.addCleanup(self.registry.stop)
+        self.patch(push_task, 'abort_streams_on_cancel', mock.Mock())
+
+    def image(self, tag):
+        return '%s/me/module-a:%s' % (self.registry.host, tag)
+
+    def test_tags_of_one_image_are_pushed_once(self):
+        client = FakeDockerClient(self.registry, {
+            self.image('1.0.0'): 'sha256:a',
+            self.image('latest'): 'sha256:a',
+            self.image('debug'): 'sha256:b'
+        })
+        self.patch(push_task.docker, 'from_env', lambda **kw: client)
+
+        plans = push_task.push(None, [], 'module-a', {'images': {
+            self.image('1.0.0'), self.image('latest'), self.image('debug')
+        }})
+        self.assertEqual(1, len(plans))
+
+        plan = plans[0]
+        push_task.execute_plan(plan)
+
+        self.assertFalse(plan.status.failed)
+        self.assertEqual([self.image('1.0.0'), self.image('debug')],
+                         client.pushed)
+        self.assertEqual(
+            self.registry.manifests['me/module-a']['1.0.0'],
+            self.registry.manifests['me/module-a']['latest'])
+        self.assertEqual(MEDIA_TYPE_MANIFEST,
+                         self.registry.manifests['me/module-a']['latest'][1])
+        self.assertEqual(
+            [self.image('1.0.0'), self.image('latest'), self.image('debug')],
+            plan.artifacts)
+
+        # the same layer id in both pushes counts once
+        self.assertEqual(2, plan.status.total)
+        self.assertEqual(1, plan.status.current)
+
+    def test_retry_skips_pushed_tags(self):
+        client = FakeDockerClient(self.registry, {
+            self.image('1.0.0'): 'sha256:a',
+            self.image('latest'): 'sha256:a',
+            self.image('debug'): 'sha256:b'
+        })
+        client.failing.add('debug')
+        self.patch(push_task.docker, 'from_env', lambda **kw: client)
+        registry_client = mock.Mock(wraps=push_task.RegistryClient)
+        self.patch(push_task, 'RegistryClient', registry_client)
+
+        plan = push_task.push(None, [], 'module-a', {'images': {
+            self.image('1.0.0'), self.image('latest'), self.image('debug')
+        }})[0]
+        push_task.execute_plan(plan)
+        self.assertTrue(plan.status.failed)
+
+        plan.status.failed = False
+        plan.status.error = None
+        push_task.execute_plan(plan)
+
+        self.assertFalse(plan.status.failed)
+        self.assertEqual(
+            [self.image('1.0.0'), self.image('debug'), self.image('debug')],
+            client.pushed)
+        self.assertEqual(
+            [self.image('1.0.0'), self.image('latest'), self.image('debug')],
+            plan.artifacts)
+        # one registry client per attempt, not per tag
+        self.assertEqual(2, registry_client.call_count)
+
+    def test_progress(self):
+        plan = Plan('push', 'module-a', None, {}, {})
+        progress = push_task.PushProgress(plan)
+        progress.update({'status': 'Pushing', 'id': 'a',
+                         'progressDetail': {'current': 10, 'total': 100}})
+        progress.update({'status': 'Pushing', 'id': 'b',
+                         'progressDetail': {'current': 50, 'total': 200}})
+        progress.update({'status': 'Layer already exists', 'id': 'c',
+                         'progressDetail': {}})
+        self.assertEqual((1, 4), (plan.status.current, plan.status.total))
+
+        progress.update({'status': 'Pushed', 'id': 'a',
+                         'progressDetail': {}})
+        self.assertEqual((2, 4), (plan.status.current, plan.status.total))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_rebuild_tokens
+----------------------------------
+
+Tests for `dbuild.rebuild_tokens`.
+"""
+
+import os
+
+import fixtures
+
+from dbuild.git_utils import capture_git
+from dbuild.rebuild_tokens import resolve_rebuild_token
+from dbuild.tests import base
+from dbuild.verb import VerbException
+
+
+class TestRebuildTokens(base.TestCase):
+
+    def setUp(self):
+        super(TestRebuildTokens, self).setUp()
+        self.base_path = self.useFixture(fixtures.TempDir()).path
+        os.mkdir(os.path.join(self.base_path, 'module-a'))
+
+    def write(self, name, content):
+        with open(os.path.join(self.base_path, name), 'w') as f:
+            f.write(content)
+
+    def token(self, source):
+        return resolve_rebuild_token(self.base_path, 'module-a', 'deps',
+                                     source)
+
+    def test_file(self):
+        self.write('module-a/requirements.txt', 'six\n')
+        source = {'file': 'requirements.txt'}
+
+        first = self.token(source)
+        self.assertEqual(first, self.token(source))
+
+        self.write('module-a/requirements.txt', 'six\nattrs\n')
+        self.assertNotEqual(first, self.token(source))
+
+    def test_git(self):
+        checkout = os.path.join(self.base_path, 'upstream')
+        os.mkdir(checkout)
+        capture_git(['init', '-q'], checkout)
+        self.write('upstream/setup.py', 'pass\n')
+        capture_git(['add', 'setup.py'], checkout)
+        capture_git(['-c', 'user.name=test', '-c', 'user.email=test@test',
+                     'commit', '-q', '-m', 'initial'], checkout)
+        commit, _ = capture_git(['rev-parse', 'HEAD'], checkout)
+
+        source = {'git': '../upstream'}
+        self.assertEqual('git-%s' % commit.strip(), self.token(source))
+
+        # uncommitted changes count too
+        self.write('upstream/setup.py', 'raise\n')
+        self.assertTrue(self.token(source).startswith(
+            'git-%s-dirty-' % commit.strip()))
+
+    def test_command(self):
+        self.write('module-a/version', '1.0\n')
+
+        first = self.token({'command': 'cat version'})
+        self.write('module-a/version', '1.1\n')
+        self.assertNotEqual(first, self.token({'command': 'cat version'}))
+
+        self.assertRaises(VerbException, self.token, {'command': 'false'})
+        self.assertRaises(VerbException, self.token, {'url': 'x'})
+
+    def test_command_not_run(self):
+        marker = os.path.join(self.base_path, 'module-a', 'ran')
+        token = resolve_rebuild_token(self.base_path, 'module-a', 'deps',
+                                      {'command': 'touch ran'},
+                                      run_commands=False)
+        self.assertEqual('command-unresolved', token)
+        self.assertFalse(os.path.exists(marker))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_render
+----------------------------------
+
+Tests for `dbuild.render`.
+"""
+
+import json
+import sys
+
+from StringIO import StringIO
+from argparse import Namespace
+
+from dbuild import build
+from dbuild.render import JsonRenderer, PlainRenderer, text_stream
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def make_plans(function):
+    plan = Plan('build', 'module', function, {}, {}, variant='master')
+    return {'module': [plan]}, plan
+
+
+class TestRenderers(base.TestCase):
+
+    def test_jsonl_events(self):
+        def build_plan(plan):
+            plan.artifacts.append('me/module:master')
+
+        stream = StringIO()
+        renderer = JsonRenderer(stream)
+        plan_dict, plan = make_plans(build_plan)
+
+        renderer.start(plan_dict)
+        renderer.update(plan_dict)
+
+        # started and finished between two updates
+        build.execute_single_plan(plan)
+        renderer.finish(plan_dict, [plan], [])
+
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(['started', 'finished', 'summary'],
+                         [e['event'] for e in events])
+        self.assertEqual('success', events[1]['result'])
+        self.assertEqual(['me/module:master'], events[1]['artifacts'])
+        self.assertGreaterEqual(events[1]['duration'], 0)
+        self.assertEqual({'success': 1}, events[2]['results'])
+
+    def test_plain_reports_failures(self):
+        def build_plan(plan):
+            plan.status.output.append('Step 1/2 : RUN false')
+            raise Exception('broken')
+
+        stream = StringIO()
+        renderer = PlainRenderer(stream)
+        plan_dict, plan = make_plans(build_plan)
+
+        build.execute_single_plan(plan)
+        renderer.finish(plan_dict, [plan], [plan])
+
+        lines = stream.getvalue().splitlines()
+        self.assertTrue(lines[0].endswith('build module (master): started'))
+        self.assertIn('build module (master): failed', lines[1])
+        self.assertTrue(lines[1].endswith(': broken'))
+        self.assertIn('  | Step 1/2 : RUN false', lines)
+
+    def test_text_stays_off_jsonl_stdout(self):
+        def stream(output, output_file=None):
+            return text_stream(Namespace(output=output,
+                                         output_file=output_file))
+
+        self.assertIs(sys.stderr, stream('jsonl'))
+        self.assertIs(sys.stdout, stream('jsonl', 'events.jsonl'))
+        self.assertIs(sys.stdout, stream('plain'))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_save_task
+----------------------------------
+
+Tests for layer deduplication in `dbuild.tasks.save_task`.
+"""
+
+import datetime
+import io
+import json
+import os
+import tarfile
+
+import fixtures
+
+from argparse import Namespace
+
+from dbuild.tasks import save_task
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def make_tar(members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    return buf.getvalue()
+
+
+# layers are tarballs themselves, large enough to span several reads
+BASE_LAYER = make_tar([('etc/os-release', b'alpine' * 20000)])
+APP_LAYER = make_tar([('app/main.py', b'print 1\n')])
+
+
+def docker_save(*layers):
+    members = []
+    for layer_id, data in layers:
+        members.append(('%s/VERSION' % layer_id, b'1.0'))
+        members.append(('%s/layer.tar' % layer_id, data))
+
+    members.append(('manifest.json', json.dumps([{
+        'Layers': ['%s/layer.tar' % layer_id for layer_id, _ in layers]
+    }]).encode('utf-8')))
+    return make_tar(members)
+
+
+class TestSave(base.TestCase):
+
+    def setUp(self):
+        super(TestSave, self).setUp()
+        self.save_dir = self.useFixture(fixtures.TempDir()).path
+        self.store = save_task.LayerStore(self.save_dir)
+
+    def save(self, module, source, complete=True):
+        plan = Plan('save', module, None, {}, {
+            'file_name': '%s.tar' % module
+        })
+        plan.status.total = len(source)
+        self.store.begin(plan.arguments['file_name'], [module])
+
+        dest = io.BytesIO()
+        skipped = save_task.copy_archive(
+            plan, self.store,
+            save_task.ProgressReader(plan, io.BytesIO(source)), dest)
+        if complete:
+            self.write(plan.arguments['file_name'])
+            self.store.complete(plan.arguments['file_name'])
+
+        dest.seek(0)
+        with tarfile.open(fileobj=dest, mode='r') as tar:
+            contents = dict((m.name, tar.extractfile(m).read())
+                            for m in tar.getmembers())
+
+        return skipped, contents, plan
+
+    def write(self, file_name):
+        # execute_plan() renames the archive into place before completing
+        with open(os.path.join(self.save_dir, file_name), 'w') as f:
+            f.write('archive')
+
+    def index(self):
+        with open(os.path.join(self.save_dir, save_task.INDEX_FILE)) as f:
+            return json.load(f)['archives']
+
+    def test_shared_layers_are_written_once(self):
+        skipped, first, plan = self.save(
+            'module-a', docker_save(('base', BASE_LAYER)))
+        self.assertEqual(0, skipped)
+        self.assertEqual(BASE_LAYER, first['base/layer.tar'])
+        self.assertEqual(plan.status.total - 1, plan.status.current)
+
+        skipped, second, _ = self.save(
+            'module-b', docker_save(('base', BASE_LAYER), ('app', APP_LAYER)))
+        self.assertEqual(1, skipped)
+        self.assertNotIn('base/layer.tar', second)
+        self.assertEqual(APP_LAYER, second['app/layer.tar'])
+        self.assertIn('base/VERSION', second)
+        self.assertIn('manifest.json', second)
+
+        index = self.index()
+        self.assertEqual(['module-a.tar', 'module-b.tar'],
+                         [a['file'] for a in index])
+        self.assertEqual(['module-a.tar'], index[1]['requires'])
+
+    def test_failed_save_is_not_required(self):
+        # module-a is still being written, module-b can't rely on it
+        self.save('module-a', docker_save(('base', BASE_LAYER)),
+                  complete=False)
+        skipped, second, _ = self.save(
+            'module-b', docker_save(('base', BASE_LAYER), ('app', APP_LAYER)))
+        self.assertEqual(0, skipped)
+        self.assertEqual(BASE_LAYER, second['base/layer.tar'])
+
+        self.store.fail('module-a.tar')
+        skipped, _, _ = self.save('module-c',
+                                  docker_save(('base', BASE_LAYER)))
+        self.assertEqual(1, skipped)
+
+        index = self.index()
+        self.assertEqual(['module-b.tar', 'module-c.tar'],
+                         [a['file'] for a in index])
+        self.assertEqual([], index[0]['requires'])
+        self.assertEqual(['module-b.tar'], index[1]['requires'])
+
+    def test_index_of_earlier_runs_is_merged(self):
+        self.save('module-a', docker_save(('base', BASE_LAYER)))
+        self.save('module-b', docker_save(('base', BASE_LAYER),
+                                          ('app', APP_LAYER)))
+
+        # a new run saving only module-b again
+        self.store = save_task.LayerStore(self.save_dir)
+        skipped, _, _ = self.save(
+            'module-b', docker_save(('base', BASE_LAYER), ('app', APP_LAYER)))
+        self.assertEqual(1, skipped)
+
+        index = self.index()
+        self.assertEqual(['module-a.tar', 'module-b.tar'],
+                         [a['file'] for a in index])
+        self.assertEqual(['module-a.tar'], index[1]['requires'])
+
+        # a failed rewrite keeps the archive already on disk
+        self.store = save_task.LayerStore(self.save_dir)
+        self.save('module-a', docker_save(('base', BASE_LAYER)),
+                  complete=False)
+        self.store.fail('module-a.tar')
+        self.save('module-c', docker_save(('app', APP_LAYER)))
+
+        index = self.index()
+        self.assertEqual(['module-a.tar', 'module-b.tar', 'module-c.tar'],
+                         [a['file'] for a in index])
+        self.assertNotIn('missing', index[1])
+
+    def test_build_intents_are_interpolated(self):
+        global_args = Namespace(save_dir=self.save_dir)
+        plans = save_task.save(global_args, [], 'module-a', {
+            'images': {'me/module-a:{date}', 'me/module-a:latest'}
+        })
+
+        date = datetime.datetime.now().strftime('%Y%m%d')
+        images = ['me/module-a:%s' % date, 'me/module-a:latest']
+        self.assertEqual(images, plans[0].arguments['images'])
+        self.assertEqual(set(images), plans[0].intents['images'])
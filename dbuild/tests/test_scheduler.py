@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_scheduler
+----------------------------------
+
+Tests for `dbuild.scheduler`.
+"""
+
+from argparse import ArgumentTypeError
+
+from dbuild import scheduler
+from dbuild.tests import base
+from dbuild.verb import Plan
+
+
+def make_plan(cpu=None, memory=0):
+    plan = Plan('build', 'module', None, {}, {})
+    if cpu is not None:
+        plan.resources = scheduler.Resources(cpu=cpu, memory=memory)
+
+    return plan
+
+
+class TestResources(base.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(512 * 1024 ** 2, scheduler.parse_size('512m'))
+        self.assertEqual(4 * 1024 ** 3, scheduler.parse_size('4G'))
+        self.assertEqual(1536, scheduler.parse_size('1.5kb'))
+        self.assertEqual(100, scheduler.parse_size(100))
+        self.assertRaises(ValueError, scheduler.parse_size, 'lots')
+
+    def test_from_config(self):
+        self.assertIsNone(scheduler.Resources.from_config({}))
+
+        res = scheduler.Resources.from_config({
+            'resources': {'cpu': 2, 'memory': '1g'}
+        })
+        self.assertEqual(scheduler.Resources(2.0, 1024 ** 3), res)
+
+
+class TestArguments(base.TestCase):
+
+    def test_worker_count(self):
+        self.assertEqual(4, scheduler.worker_count('4'))
+        self.assertEqual('auto', scheduler.worker_count('auto'))
+        self.assertRaises(ArgumentTypeError, scheduler.worker_count, '0')
+        self.assertRaises(ArgumentTypeError, scheduler.worker_count, 'many')
+
+    def test_priority_override(self):
+        self.assertEqual(('module-a', 'high'),
+                         scheduler.priority_override('module-a=high'))
+        self.assertRaises(ArgumentTypeError, scheduler.priority_override,
+                          'module-a=urgent')
+        self.assertRaises(ArgumentTypeError, scheduler.priority_override,
+                          '=high')
+
+
+class TestResourceBudget(base.TestCase):
+
+    def test_first_fit(self):
+        budget = scheduler.ResourceBudget(cpu=4, memory=8 * 1024 ** 3)
+        heavy = make_plan(cpu=3, memory=4 * 1024 ** 3)
+        other_heavy = make_plan(cpu=3, memory=4 * 1024 ** 3)
+        light = make_plan(cpu=1, memory=512 * 1024 ** 2)
+
+        self.assertTrue(budget.fits(heavy))
+        budget.reserve(heavy)
+
+        self.assertFalse(budget.fits(other_heavy))
+        self.assertTrue(budget.fits(light))
+        self.assertTrue(budget.fits(make_plan()))
+
+        budget.release(heavy)
+        self.assertTrue(budget.fits(other_heavy))
+
+    def test_oversized_plan_runs_alone(self):
+        budget = scheduler.ResourceBudget(cpu=2, memory=None)
+        huge = make_plan(cpu=8)
+        light = make_plan(cpu=1)
+
+        self.assertTrue(budget.fits(huge))
+        budget.reserve(light)
+        self.assertFalse(budget.fits(huge))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestAutoscaling(base.TestCase):
+
+    def setUp(self):
+        super(TestAutoscaling, self).setUp()
+        self.clock = FakeClock()
+        self.patch(scheduler, 'time', self.clock)
+        self.patch(scheduler, 'cpu_count', lambda: 8)
+        self.patch(scheduler, 'get_docker_root', lambda: None)
+
+        self.limit = scheduler.AutoscalingWorkerLimit()
+        self.pressure = []
+        self.idle = True
+        self.limit.host_pressure = lambda: self.pressure
+        self.limit.host_idle = lambda: self.idle
+
+        self.plans = [make_plan() for _ in range(20)]
+
+    def update(self, progress=0, waiting=1):
+        """Runs one autoscaling interval with every worker busy"""
+        self.clock.now += scheduler.AUTOSCALE_INTERVAL
+        self.plans[0].status.current += progress
+        self.limit.update(self.plans, self.plans[:self.limit.limit],
+                          waiting)
+        return self.limit.limit
+
+    def fail(self, plan, error, attempts=1):
+        plan.status.attempts = attempts
+        plan.status.failed = True
+        plan.status.error = error
+
+    def test_growth(self):
+        self.assertEqual(4, self.limit.limit)
+
+        # not before an interval has passed
+        self.limit.update(self.plans, self.plans[:4], 1)
+        self.assertEqual(4, self.limit.limit)
+
+        self.assertEqual(5, self.update(progress=10))
+        self.assertEqual(6, self.update(progress=10))
+
+        # nothing waiting, or a busy host
+        self.assertEqual(6, self.update(progress=10, waiting=0))
+        self.idle = False
+        self.assertEqual(6, self.update(progress=10))
+
+        # up to twice the cores
+        self.idle = True
+        for _ in range(20):
+            self.update(progress=10)
+        self.assertEqual(16, self.limit.limit)
+
+    def test_shrinks_on_pressure(self):
+        self.pressure = ['memory 5% free']
+        self.assertEqual(3, self.update())
+        self.assertEqual(2, self.update())
+        self.assertEqual(1, self.update())
+        self.assertEqual(1, self.update())
+
+    def test_throughput_drop_rolls_back(self):
+        self.assertEqual(5, self.update(progress=100))
+        self.assertEqual(6, self.update(progress=100))
+
+        # a worker was just added and throughput fell by more than 25%
+        self.idle = False
+        self.assertEqual(5, self.update(progress=50))
+
+        # a drop that didn't follow growth is left alone
+        self.assertEqual(5, self.update(progress=10))
+
+    def test_failures_halve_once(self):
+        root = self.plans[0]
+        child = Plan('push', 'module', None, {}, {}, parent=root)
+        self.plans.append(child)
+
+        self.fail(root, '500 Server Error: Internal Server Error')
+        self.assertEqual(2, self.update())
+
+        # the dead child is marked failed later, without running
+        child.status.failed = True
+        self.assertEqual(3, self.update())
+
+    def test_retried_failures_count_per_attempt(self):
+        plan = self.plans[0]
+        plan.status.attempts = 1
+        plan.status.retry_at = self.clock.now + 60
+        plan.status.error = 'read timed out'
+        self.assertEqual(2, self.update())
+        self.assertEqual(3, self.update())
+
+        self.fail(plan, 'connection reset by peer', attempts=2)
+        self.assertEqual(1, self.update())
+
+    def test_build_errors_are_not_distress(self):
+        self.fail(self.plans[0], "The command '/bin/sh -c make' returned a "
+                                 "non-zero code: 2")
+        self.assertEqual(5, self.update())
+
+        self.fail(self.plans[1], "The command '/bin/sh -c make' returned a "
+                                 "non-zero code: 137")
+        self.assertEqual(2, self.update())
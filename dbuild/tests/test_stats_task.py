@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_stats_task
+----------------------------------
+
+Tests for layer analysis in `dbuild.tasks.stats_task`.
+"""
+
+import datetime
+
+from argparse import Namespace
+
+import fixtures
+import mock
+
+from dbuild import docker_utils
+from dbuild.docker_utils import CachedDockerfileParser
+from dbuild.parse_cache import ParseCache
+from dbuild.tasks import stats_task
+from dbuild.tests import base
+
+# `docker history` of a module built on alpine, newest first
+HISTORY_A = [
+    {'CreatedBy': '/bin/sh -c #(nop)  CMD ["/app"]', 'Size': 0},
+    {'CreatedBy': '/bin/sh -c #(nop) COPY file:abc in /app ', 'Size': 300},
+    {'CreatedBy': '/bin/sh -c apk add --no-cache python', 'Size': 50000},
+    {'CreatedBy': '/bin/sh -c #(nop)  CMD ["/bin/sh"]', 'Size': 0},
+    {'CreatedBy': '/bin/sh -c #(nop) ADD file:def in / ', 'Size': 4000},
+]
+
+# the same module built with BuildKit, whose history has no `#(nop)`
+HISTORY_A_BUILDKIT = [
+    {'CreatedBy': 'CMD ["/app"]', 'Size': 0},
+    {'CreatedBy': 'COPY app /app # buildkit', 'Size': 300},
+    {'CreatedBy': 'ENV APP_HOME=/app', 'Size': 0},
+    {'CreatedBy': 'RUN /bin/sh -c apk add --no-cache python # buildkit',
+     'Size': 50000},
+    {'CreatedBy': '/bin/sh -c #(nop)  CMD ["/bin/sh"]', 'Size': 0},
+    {'CreatedBy': '/bin/sh -c #(nop) ADD file:def in / ', 'Size': 4000},
+]
+
+DOCKERFILE_A = b'''FROM alpine:3.6
+RUN apk add --no-cache python
+COPY app /app
+CMD ["/app"]
+'''
+
+DOCKERFILE_B = b'''FROM me/module-a:latest
+RUN pip install \\
+      big-package
+'''
+
+
+def structure(content):
+    return CachedDockerfileParser(content).structure
+
+
+class TestStats(base.TestCase):
+
+    def module_a(self):
+        layers = stats_task.image_layers(
+            HISTORY_A, ['sha256:base', 'sha256:python', 'sha256:app'])
+        return stats_task.attribute_instructions(layers,
+                                                 structure(DOCKERFILE_A))
+
+    def test_layers_are_matched_to_instructions(self):
+        layers = self.module_a()
+
+        self.assertEqual([4000, 50000, 300], [l['size'] for l in layers])
+        self.assertEqual([
+            'base image: alpine:3.6',
+            'line 2: RUN apk add --no-cache python',
+            'line 3: COPY app /app'
+        ], [l['instruction'] for l in layers])
+
+    def test_buildkit_history(self):
+        layers = stats_task.image_layers(
+            HISTORY_A_BUILDKIT,
+            ['sha256:base', 'sha256:python', 'sha256:app'])
+
+        self.assertEqual([4000, 50000, 300], [l['size'] for l in layers])
+        self.assertEqual('COPY app /app # buildkit', layers[2]['created_by'])
+
+    def test_summary(self):
+        layers_a = self.module_a()
+        layers_b = stats_task.attribute_instructions(
+            [dict(l) for l in layers_a] + [
+                {'digest': 'sha256:pip', 'size': 900000, 'created_by': ''}
+            ], structure(DOCKERFILE_B))
+
+        summary = stats_task.summarize([
+            ('module-a', {'image': 'me/module-a:latest', 'size': 54300,
+                          'layers': layers_a}),
+            ('module-b', {'image': 'me/module-b:latest', 'size': 954300,
+                          'layers': layers_b})
+        ])
+
+        image_a, image_b = summary['images']
+        self.assertEqual((0, 54300), (image_a['unique'], image_a['shared']))
+        self.assertEqual((900000, 54300),
+                         (image_b['unique'], image_b['shared']))
+        self.assertEqual(954300, summary['total'])
+        self.assertEqual(54300, summary['shared'])
+
+        largest = summary['largest']
+        self.assertEqual(('module-b', 'line 2: RUN pip install big-package',
+                          1),
+                         (largest[0]['module'], largest[0]['instruction'],
+                          largest[0]['modules']))
+
+        # attributed to the module that added it, not to module-b's base
+        self.assertEqual(('module-a', 2),
+                         (largest[1]['module'], largest[1]['modules']))
+
+    def test_layer_metadata_is_cached(self):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.patch(docker_utils, 'parse_cache', ParseCache(cache_dir))
+
+        client = mock.Mock()
+        client.api.inspect_image.return_value = {
+            'Id': u'sha256:image-a',
+            'Size': 54300,
+            'RootFS': {'Layers': ['sha256:base', 'sha256:python',
+                                  'sha256:app']}
+        }
+        client.api.history.return_value = HISTORY_A
+
+        first = stats_task.inspect_image(client, 'me/module-a:latest')
+        second = stats_task.inspect_image(client, 'me/module-a:latest')
+
+        self.assertEqual(first, second)
+        self.assertEqual(1, client.api.history.call_count)
+        self.assertEqual(['sha256:base', 'sha256:python', 'sha256:app'],
+                         [l['digest'] for l in second['layers']])
+
+    def test_build_intents_are_interpolated(self):
+        global_args = Namespace(base_path='/nonexistent')
+        plans = stats_task.stats(global_args, [], 'module-a', {
+            'images': {'me/module-a:{date}'}
+        })
+
+        date = datetime.datetime.now().strftime('%Y%m%d')
+        self.assertEqual(['me/module-a:%s' % date],
+                         plans[0].arguments['images'])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_verb
+----------------------------------
+
+Tests for cancellation in `dbuild.verb`.
+"""
+
+from dbuild.tests import base
+from dbuild.verb import CancelToken, CancelledException
+
+
+class TestCancelToken(base.TestCase):
+
+    def test_check(self):
+        token = CancelToken()
+        token.check()
+        self.assertFalse(token.is_set)
+
+        token.cancel()
+        self.assertTrue(token.is_set)
+        self.assertIsNotNone(token.requested_at)
+        self.assertRaises(CancelledException, token.check)
+
+    def test_on_cancel(self):
+        token = CancelToken()
+        calls = []
+        token.on_cancel(lambda: calls.append('first'))
+        token.on_cancel(lambda: calls.append('second'))
+        self.assertEqual([], calls)
+
+        token.cancel()
+        self.assertEqual(['first', 'second'], calls)
+
+        # only once, callbacks added later run right away
+        token.cancel()
+        token.on_cancel(lambda: calls.append('late'))
+        self.assertEqual(['first', 'second', 'late'], calls)
+
+    def test_failing_callbacks_do_not_stop_others(self):
+        token = CancelToken()
+        calls = []
+
+        def fail():
+            raise IOError('socket already closed')
+
+        token.on_cancel(fail)
+        token.on_cancel(lambda: calls.append('closed'))
+        token.cancel()
+        self.assertEqual(['closed'], calls)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_watch
+----------------------------------
+
+Tests for `dbuild.watch`.
+"""
+
+import os
+
+import fixtures
+
+from dbuild import watch
+from dbuild.tests import base
+
+
+class FakeWatcher(object):
+    def __init__(self, *batches):
+        self.batches = list(batches)
+
+    def poll(self):
+        return self.batches.pop(0) if self.batches else set()
+
+
+class TestWatch(base.TestCase):
+
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.base_path = self.useFixture(fixtures.TempDir()).path
+        for module in ('module-a', 'module-b', 'module-c'):
+            os.makedirs(os.path.join(self.base_path, module, 'files'))
+            self.write(module, 'Dockerfile', 'FROM alpine\n')
+
+    def write(self, module, name, content):
+        with open(os.path.join(self.base_path, module, name), 'w') as f:
+            f.write(content)
+
+    def test_polling(self):
+        watcher = watch.PollingWatcher(self.base_path,
+                                       ['module-a', 'module-b'])
+        self.assertEqual(set(), watcher.poll())
+
+        self.write('module-a', 'Dockerfile', 'FROM alpine:3.6\n')
+        self.assertEqual({'module-a'}, watcher.poll())
+        self.assertEqual(set(), watcher.poll())
+
+        # new files in subdirectories, and removed files
+        self.write('module-b', 'files/start.sh', '#!/bin/sh\n')
+        os.remove(os.path.join(self.base_path, 'module-a', 'Dockerfile'))
+        self.assertEqual({'module-a', 'module-b'}, watcher.poll())
+
+        # same size, but a new mtime
+        path = os.path.join(self.base_path, 'module-b', 'files', 'start.sh')
+        os.utime(path, (0, 0))
+        self.assertEqual({'module-b'}, watcher.poll())
+
+        # unwatched modules are ignored
+        self.write('module-c', 'Dockerfile', 'FROM scratch\n')
+        self.assertEqual(set(), watcher.poll())
+
+    def test_changes_are_batched(self):
+        self.patch(watch, 'WATCH_DEBOUNCE', 0.2)
+        self.patch(watch, 'WATCH_POLL_INTERVAL', 0.01)
+
+        watcher = FakeWatcher(set(), {'module-a'}, set(), {'module-b'})
+        self.assertEqual({'module-a', 'module-b'},
+                         watch.wait_for_changes(watcher))
+
+    def test_stop(self):
+        self.assertIsNone(watch.wait_for_changes(FakeWatcher({'module-a'}),
+                                                 stop=lambda: True))
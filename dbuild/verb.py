@@ -13,8 +13,13 @@
 # under the License.
 
 import logging
+import random
+import re
+import time
 
+from collections import deque
 from functools import wraps
+from threading import Lock
 
 import attr
 
@@ -31,6 +36,40 @@ class VerbDefinition(object):
     description = attr.ib()
     priority = attr.ib()
     args = attr.ib()
+    retry = attr.ib(default=None)
+
+    # called after a run with the verb's plans, to print a summary
+    report = attr.ib(default=None)
+
+
+@attr.s
+class RetryPolicy(object):
+    """Describes how plans of a verb are retried after failing
+
+    :param attempts: total number of attempts, including the first
+    :param backoff: delay in seconds before the first retry, doubled for
+                    each following retry
+    :param max_delay: upper bound for the delay between attempts
+    :param jitter: random variation applied to each delay, as a fraction
+    :param pattern: regex matched against the error message; only matching
+                    errors are retried. If unset, all errors are retried.
+    """
+    attempts = attr.ib(default=3)
+    backoff = attr.ib(default=2.0)
+    max_delay = attr.ib(default=60.0)
+    jitter = attr.ib(default=0.25)
+    pattern = attr.ib(default=None)
+
+    def is_retryable(self, error):
+        if self.pattern is None:
+            return True
+
+        return re.search(self.pattern, error or '') is not None
+
+    def delay(self, attempt):
+        """Seconds to wait after the given (1-based) failed attempt"""
+        delay = min(self.max_delay, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
 
 
 @attr.s
@@ -46,13 +85,75 @@ class Value(object):
     groups = attr.ib()
 
 
+# number of recent output lines kept per plan, shown when it fails
+OUTPUT_EXCERPT_LINES = 25
+
 _count = 0
+_count_lock = Lock()
+
+# guards registration; plans are generated from several threads
+verbs_lock = Lock()
 
 
 def inc_count():
     global _count
-    _count += 1
-    return _count
+    with _count_lock:
+        _count += 1
+        return _count
+
+
+class CancelledException(Exception):
+    pass
+
+
+class CancelToken(object):
+    """Lets a running plan be asked to stop
+
+    Tasks should call check() regularly, and register callbacks with
+    on_cancel() to interrupt anything that blocks (e.g. close an HTTP stream
+    or terminate a subprocess) so cancellation takes effect promptly.
+    """
+
+    def __init__(self):
+        self.requested_at = None
+        self.callbacks = []
+        self.lock = Lock()
+
+    @property
+    def is_set(self):
+        return self.requested_at is not None
+
+    def cancel(self):
+        with self.lock:
+            if self.requested_at is not None:
+                return
+
+            self.requested_at = time.time()
+            callbacks = self.callbacks[:]
+
+        for callback in callbacks:
+            run_cancel_callback(callback)
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if self.requested_at is None:
+                self.callbacks.append(callback)
+                return
+
+        # already cancelled, run it right away
+        run_cancel_callback(callback)
+
+    def check(self):
+        if self.is_set:
+            raise CancelledException()
+
+
+# noinspection PyBroadException
+def run_cancel_callback(callback):
+    try:
+        callback()
+    except Exception:
+        logger.debug('cancel callback failed', exc_info=True)
 
 
 @attr.s
@@ -65,9 +166,23 @@ class ExecutionStatus(object):
     finished = attr.ib(default=False)
     failed = attr.ib(default=False)
     cancelled = attr.ib(default=False)
-    cancel_requested = attr.ib(default=False)
+    cancel_token = attr.ib(default=attr.Factory(CancelToken), repr=False)
     future = attr.ib(default=None)
     blocking = attr.ib(default=True)
+    resumed = attr.ib(default=False)
+
+    started_at = attr.ib(default=None)
+    finished_at = attr.ib(default=None)
+
+    error = attr.ib(default=None)
+    output = attr.ib(default=attr.Factory(
+        lambda: deque(maxlen=OUTPUT_EXCERPT_LINES)), repr=False)
+    attempts = attr.ib(default=0)
+    retry_at = attr.ib(default=None)
+
+    @property
+    def cancel_requested(self):
+        return self.cancel_token.is_set
 
     @property
     def success(self):
@@ -97,10 +212,22 @@ class Plan(object):
 
     parent = attr.ib(default=None, repr=False)
     children = attr.ib(default=attr.Factory(list), repr=False)
+    waits_for = attr.ib(default=attr.Factory(list), repr=False)
     status = attr.ib(default=attr.Factory(ExecutionStatus), repr=False)
 
     artifacts = attr.ib(default=attr.Factory(list), repr=False)
 
+    # what this plan operates on, used to recognize it across runs
+    variant = attr.ib(default=None, repr=False)
+    tags = attr.ib(default=attr.Factory(list), repr=False)
+    fingerprint = attr.ib(default=None, repr=False)
+
+    # optional cpu/memory hints used by the scheduler, see Resources
+    resources = attr.ib(default=None, repr=False)
+
+    # numeric priority class of the plan's module, see FairQueue
+    priority = attr.ib(default=0, repr=False)
+
     def is_dead(self):
         if self.parent and self.parent.status.failed:
             return True
@@ -111,6 +238,12 @@ class Plan(object):
         return False
 
     def is_ready(self):
+        # ordering-only dependencies: these need to finish first, but their
+        # outcome doesn't matter
+        for other in self.waits_for:
+            if not other.status.finished:
+                return False
+
         if not self.parent:
             return True
 
@@ -168,10 +301,13 @@ def verb(*names, **kwargs):
             function=func,
             description=kwargs.get('description', None),
             priority=kwargs.get('priority', 0),
-            args=kwargs.get('args', []))
+            args=kwargs.get('args', []),
+            retry=kwargs.get('retry', None),
+            report=kwargs.get('report', None))
 
-        for verb_name in names:
-            verbs[verb_name] = verb_def
+        with verbs_lock:
+            for verb_name in names:
+                verbs[verb_name] = verb_def
 
         @wraps(func)
         def func_wrapper(*args, **kwargs_):
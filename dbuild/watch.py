@@ -0,0 +1,146 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# seconds without further changes before a batch of changes is reported
+WATCH_DEBOUNCE = 1.0
+
+# seconds between checks, for polling and for the stop callback
+WATCH_POLL_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def module_for_path(base_path, path):
+    rel = os.path.relpath(path, base_path)
+    return rel.split(os.sep, 1)[0]
+
+
+class PollingWatcher(object):
+    """Detects changes by comparing file mtimes and sizes"""
+
+    def __init__(self, base_path, modules):
+        self.base_path = base_path
+        self.modules = modules
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for module in self.modules:
+            module_path = os.path.join(self.base_path, module)
+            for root, dirs, files in os.walk(module_path):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+
+                    snapshot[path] = (st.st_mtime, st.st_size)
+
+        return snapshot
+
+    def poll(self):
+        """Returns the set of modules changed since the last poll"""
+        snapshot = self.scan()
+        changed = set()
+        for path in set(snapshot) ^ set(self.snapshot):
+            changed.add(module_for_path(self.base_path, path))
+
+        for path in set(snapshot) & set(self.snapshot):
+            if snapshot[path] != self.snapshot[path]:
+                changed.add(module_for_path(self.base_path, path))
+
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Detects changes with inotify, requires pyinotify"""
+
+    MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_CLOSE_WRITE) if pyinotify else 0
+
+    def __init__(self, base_path, modules):
+        self.base_path = base_path
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.handle,
+                                           timeout=10)
+
+        for module in modules:
+            self.manager.add_watch(os.path.join(base_path, module), self.MASK,
+                                   rec=True, auto_add=True)
+
+    def handle(self, event):
+        self.changed.add(module_for_path(self.base_path, event.pathname))
+
+    def poll(self):
+        while self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def create_watcher(base_path, modules):
+    if pyinotify is not None:
+        try:
+            return InotifyWatcher(base_path, modules)
+        except Exception:
+            logger.debug('inotify unavailable, falling back to polling',
+                         exc_info=True)
+
+    return PollingWatcher(base_path, modules)
+
+
+def wait_for_changes(watcher, stop=None):
+    """Blocks until modules change, then until changes settle down
+
+    :param watcher: a PollingWatcher or InotifyWatcher
+    :param stop: optional callable, waiting is aborted when it returns True
+    :return: the set of changed modules, or None if stopped
+    """
+    changed = set()
+    last_change = None
+    while True:
+        if stop and stop():
+            return None
+
+        new = watcher.poll()
+        if new:
+            logger.debug('changes detected in: %s', ', '.join(sorted(new)))
+            changed.update(new)
+            last_change = time.time()
+        elif changed and time.time() - last_change >= WATCH_DEBOUNCE:
+            return changed
+
+        time.sleep(min(WATCH_POLL_INTERVAL, WATCH_DEBOUNCE / 2))
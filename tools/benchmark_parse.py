@@ -0,0 +1,158 @@
+# (C) Copyright 2017 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks loading build.yml files and Dockerfiles for a large workspace
+
+Generates a workspace of modules (400 by default) and times what planning
+does per module: load the config and Dockerfile, and walk the Dockerfile
+structure a few times. Runs are:
+
+* uncached: a plain DockerfileParser and yaml.safe_load every time, i.e. the
+  behavior before the parse cache
+* cold: with an empty on-disk cache (parsing, plus writing the cache)
+* warm: a new invocation with a populated on-disk cache
+
+Usage: python tools/benchmark_parse.py [--modules N] [--repeat N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from dockerfile_parse import DockerfileParser
+
+from dbuild import docker_utils
+
+DOCKERFILE = """FROM {base}
+ARG REBUILD_CHECKOUT=1
+ARG BRANCH=master
+ENV MODULE={name} \\
+    PYTHONUNBUFFERED=1
+RUN apk add --no-cache --virtual build-dep git make g++ && \\
+    pip install --no-cache-dir -r /requirements.txt && \\
+    apk del build-dep
+{steps}COPY start.sh /start.sh
+CMD ["/start.sh"]
+"""
+
+BUILD_YML = """repository: bench/{name}
+variants:
+  - tag: master
+    aliases:
+      - :latest
+    args:
+      BRANCH: master
+  - tag: stable
+    args:
+      BRANCH: stable/pike
+"""
+
+
+def generate_workspace(path, count):
+    for i in range(count):
+        name = 'module-{:03d}'.format(i)
+        base = 'alpine:3.6' if i % 20 == 0 else 'bench/module-{:03d}'.format(
+            i - 1)
+        steps = ''.join('RUN echo "step {}" > /step-{}\n'.format(n, n)
+                        for n in range(i % 15))
+
+        module_path = os.path.join(path, name)
+        os.mkdir(module_path)
+        with open(os.path.join(module_path, 'Dockerfile'), 'w') as f:
+            f.write(DOCKERFILE.format(base=base, name=name, steps=steps))
+
+        with open(os.path.join(module_path, 'build.yml'), 'w') as f:
+            f.write(BUILD_YML.format(name=name))
+
+
+def plan_module_uncached(path, module):
+    module_path = os.path.join(path, module)
+    with open(os.path.join(module_path, 'build.yml')) as f:
+        yaml.safe_load(f)
+
+    dockerfile = DockerfileParser(module_path, cache_content=True)
+    docker_utils.get_base_images(dockerfile)
+    docker_utils.get_rebuild_targets(dockerfile)
+    len(dockerfile.structure)
+
+
+def plan_module(path, module):
+    docker_utils.load_config(path, module)
+
+    dockerfile = docker_utils.load_dockerfile(path, module)
+    docker_utils.get_base_images(dockerfile)
+    docker_utils.get_rebuild_targets(dockerfile)
+    len(dockerfile.structure)
+
+
+def new_invocation(state_dir):
+    docker_utils.config_cache.clear()
+    docker_utils.dockerfile_cache.clear()
+    if state_dir:
+        docker_utils.enable_parse_cache(state_dir)
+    else:
+        docker_utils.parse_cache = None
+
+
+def timed(func, path, modules):
+    start = time.time()
+    for module in modules:
+        func(path, module)
+
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modules', type=int, default=400)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='dbuild-bench-')
+    try:
+        generate_workspace(path, args.modules)
+        modules = docker_utils.list_modules(path)
+        state_dir = os.path.join(path, '.dbuild')
+
+        results = {'uncached': [], 'cold': [], 'warm': []}
+        for _ in range(args.repeat):
+            new_invocation(None)
+            results['uncached'].append(
+                timed(plan_module_uncached, path, modules))
+
+            shutil.rmtree(state_dir, ignore_errors=True)
+            new_invocation(state_dir)
+            results['cold'].append(timed(plan_module, path, modules))
+
+            new_invocation(state_dir)
+            results['warm'].append(timed(plan_module, path, modules))
+
+        print('{} modules, best of {}:'.format(len(modules), args.repeat))
+        baseline = min(results['uncached'])
+        for name in ('uncached', 'cold', 'warm'):
+            best = min(results[name])
+            print('  {:<10} {:8.3f}s  {:5.2f}x'.format(
+                name, best, baseline / best))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()